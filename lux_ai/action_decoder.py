@@ -0,0 +1,127 @@
+import numpy as np
+
+from lux_gym.envs.lux.action_vectors_new import worker_action_vector, dir_action_vector, res_action_vector
+from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
+
+# action numbers are positions of ones in action vectors
+GENERAL_CODES = {name: int(np.argmax(vector)) for name, vector in worker_action_vector.items()}
+DIRECTION_CODES = {name: int(np.argmax(vector)) for name, vector in dir_action_vector.items()}
+RESOURCE_CODES = {name: int(np.argmax(vector)) for name, vector in res_action_vector.items()}
+ACTIONS_N = len(empty_worker_action_vectors)
+# units are stored as numbers from their ids, "u_12" is 12
+UNIT_PREFIX = "u_"
+# a transfer direction depends on a destination unit position, it is found during simulation
+TRANSFER_DIRECTION = -2
+IDLE_NUMBERS = np.full(ACTIONS_N, -1, dtype=np.int8)
+IDLE_NUMBERS[0] = GENERAL_CODES["idle"]
+
+
+class EpisodeActions:
+    def __init__(self, steps, player_n):
+        """
+        Unit actions of one player in a whole episode, decoded from action strings once.
+
+        Actions are kept in flat arrays sorted by step: unit numbers, action numbers
+        (general, direction, resource; -1 is for none) and transfer destinations,
+        city tile actions are skipped since only worker actions are recorded.
+
+        Args:
+            steps: replay steps, (player 1 actions, player 2 actions, observation updates digest)
+            player_n: 0 or 1
+        """
+        step_indices, units, actions, destinations = [], [], [], []
+        for step, step_data in enumerate(steps):
+            player_actions = step_data[player_n]
+            if player_actions is None:
+                continue
+            for action in player_actions:
+                decoded = decode_action(action)
+                if decoded is None:
+                    continue
+                unit, action_numbers, destination = decoded
+                step_indices.append(step)
+                units.append(unit)
+                actions.append(action_numbers)
+                destinations.append(destination)
+
+        self._units = np.array(units, dtype=np.int32)
+        self._actions = np.array(actions, dtype=np.int8).reshape([-1, ACTIONS_N])
+        self._destinations = np.array(destinations, dtype=np.int32)
+        # rows of a step are from offsets[step] to offsets[step + 1]
+        self._offsets = np.searchsorted(np.array(step_indices, dtype=np.int32), np.arange(len(steps) + 1))
+
+    def get_worker_actions(self, step, units_active, units_all):
+        """
+        Returns action numbers of active workers on a step, arrays are shared and not to be modified.
+
+        Actions of units which are not active workers are skipped, active workers without actions are idle.
+
+        Args:
+            step: a step of replay steps
+            units_active: a dict of active units of the player
+            units_all: a dict of all units of the player, transfer destinations
+        """
+        actions = {}
+        for row in range(self._offsets[step], self._offsets[step + 1]):
+            unit_id = f"{UNIT_PREFIX}{self._units[row]}"
+            unit = units_active.get(unit_id)
+            if unit is None or not unit.is_worker():
+                continue
+            action_numbers = self._actions[row]
+            if action_numbers[1] == TRANSFER_DIRECTION:
+                destination = units_all.get(f"{UNIT_PREFIX}{self._destinations[row]}")
+                if destination is None:  # there is no such destination unit
+                    action_numbers = IDLE_NUMBERS
+                else:
+                    action_numbers = action_numbers.copy()
+                    action_numbers[1] = DIRECTION_CODES[unit.pos.direction_to(destination.pos)]
+            actions[unit_id] = action_numbers
+
+        for unit_id, unit in units_active.items():
+            if unit_id not in actions and unit.is_worker():
+                actions[unit_id] = IDLE_NUMBERS
+        return actions
+
+
+def get_unit_number(unit_id):
+    if not unit_id.startswith(UNIT_PREFIX):
+        raise ValueError
+    return int(unit_id[len(UNIT_PREFIX):])
+
+
+def decode_action(action):
+    """
+    Decodes a unit action string.
+
+    Returns:
+        (unit number, action numbers, transfer destination unit number or -1),
+        None for city tile actions, annotations and malformed actions
+    """
+    action_list = action.split(" ")
+    action_type = action_list[0]
+    action_numbers = [-1] * ACTIONS_N
+    destination = -1
+    try:
+        unit = get_unit_number(action_list[1])
+        if action_type == "m":  # "m {id} {direction}"
+            direction = action_list[2]
+            if direction == "c":
+                action_numbers[0] = GENERAL_CODES["idle"]
+            else:
+                action_numbers[0] = GENERAL_CODES["m"]
+                action_numbers[1] = DIRECTION_CODES[direction]
+        elif action_type == "t":  # "t {id} {dest_id} {resourceType} {amount}"
+            if action_list[2].startswith(UNIT_PREFIX):
+                destination = get_unit_number(action_list[2])
+            action_numbers[0] = GENERAL_CODES["t"]
+            action_numbers[1] = TRANSFER_DIRECTION
+            action_numbers[2] = RESOURCE_CODES[action_list[3]]
+        elif action_type == "bcity":  # "bcity {id}"
+            action_numbers[0] = GENERAL_CODES["bcity"]
+        elif action_type == "p":  # "p {id}"
+            action_numbers[0] = GENERAL_CODES["idle"]  # REPLACEMENT
+        else:
+            return None
+    except (IndexError, KeyError, ValueError):
+        return None
+    return unit, action_numbers, destination
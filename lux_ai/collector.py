@@ -10,7 +10,7 @@ def collect(config_out, input_data_out, data_path_out, collector_n_out, global_v
     # import ray
 
     import lux_gym.agents.agents as agents
-    from lux_ai import tools, tfrecords_storage
+    from lux_ai import tools, tfrecords_storage, inference
     from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
 
     physical_devices = tf.config.list_physical_devices('GPU')
@@ -38,11 +38,15 @@ def collect(config_out, input_data_out, data_path_out, collector_n_out, global_v
             self._env_name = config["environment"]
             self._n_points = config["n_points"]
             self._model_name = config["model_name"]
-            if data is None:
-                print("Collecting from a random agent.")
-            self._agent = agents.get_processing_agent(self._model_name, data)
-
             self._feature_maps_shape = tools.get_feature_maps_shape(config["environment"])
+            if config["shared_trunk"]:
+                # the trunk runs once per player and turn, unit heads are gathered at unit positions
+                self._agent = inference.Agent(self._model_name, data, self._feature_maps_shape,
+                                              shared_trunk=True, precision=config["inference_precision"])
+            else:
+                if data is None:
+                    print("Collecting from a random agent.")
+                self._agent = agents.get_processing_agent(self._model_name, data)
             self._actions_shape = [item.shape for item in empty_worker_action_vectors]
 
             # self._table_names = buffer_table_names
@@ -54,135 +58,12 @@ def collect(config_out, input_data_out, data_path_out, collector_n_out, global_v
             self._only_wins = config["only_wins"]
             self._is_for_rl = config["is_for_rl"]
             self._is_pg_rl = config["is_pg_rl"]
+            self._storage_format = config["storage_format"]
+            self._shard_size = config["shard_size"]
+            self._compression = config["tfrecord_compression"]
 
         def _collect(self, agent):
-            """
-            Collects trajectories from an episode. Episodes consists of n_points.
-
-            One n_point contains (action, action_probs, action_mask, observation,
-                                  total reward, temporal_mask, progress);
-            action is a response for the current observation,
-            reward, done are for the current observation.
-            """
-
-            player1_data = {}
-            player2_data = {}
-
-            environment = gym.make(self._env_name)
-            observations = environment.reset()
-            configuration = environment.configuration
-            game_states = environment.game_states
-            actions_1, actions_1_dict, actions_1_probs, proc_obs1, reward1 = agent(observations[0],
-                                                                                   configuration, game_states[0])
-            actions_2, actions_2_dict, actions_2_probs, proc_obs2, reward2 = agent(observations[1],
-                                                                                   configuration, game_states[1])
-
-            step = 0
-            player1_data = tools.add_point(player1_data, actions_1_dict, actions_1_probs, proc_obs1, step)
-            player2_data = tools.add_point(player2_data, actions_2_dict, actions_2_probs, proc_obs2, step)
-
-            #  for step in range(1, configuration.episodeSteps):
-            while True:
-                step += 1
-                player1_prev_alive_units = [item.id for item in game_states[0].player.units]
-                player2_prev_alive_units = [item.id for item in game_states[1].player.units]
-                dones, observations = environment.step((actions_1, actions_2))
-                game_states = environment.game_states
-                if any(dones):
-                    player1_alive_units_ids = []
-                    player1_died_on_last_step_units_ids = []
-                    player1_alive_units = [item.id for item in game_states[0].player.units]
-                    for unit in player1_prev_alive_units:
-                        if unit in player1_alive_units:
-                            player1_alive_units_ids.append(unit)
-                        else:
-                            player1_died_on_last_step_units_ids.append(unit)
-
-                    player2_alive_units_ids = []
-                    player2_died_on_last_step_units_ids = []
-                    player2_alive_units = [item.id for item in game_states[1].player.units]
-                    for unit in player2_prev_alive_units:
-                        if unit in player2_alive_units:
-                            player2_alive_units_ids.append(unit)
-                        else:
-                            player2_died_on_last_step_units_ids.append(unit)
-
-                    break
-                actions_1, actions_1_dict, actions_1_probs, proc_obs1, reward1 = agent(observations[0],
-                                                                                       configuration, game_states[0])
-                actions_2, actions_2_dict, actions_2_probs, proc_obs2, reward2 = agent(observations[1],
-                                                                                       configuration, game_states[1])
-
-                player1_data = tools.add_point(player1_data, actions_1_dict, actions_1_probs, proc_obs1, step)
-                player2_data = tools.add_point(player2_data, actions_2_dict, actions_2_probs, proc_obs2, step)
-
-            reward1 = observations[0]["reward"]
-            reward2 = observations[1]["reward"]
-            unit_rewards = {}
-            if reward1 != reward2:
-                if reward1 > reward2:  # 1 player won
-                    win_data = player1_data
-                    win_died_on_last_step_units_ids = player1_died_on_last_step_units_ids
-                    # win_alive_units_ids = player1_alive_units_ids
-                    lose_data = player2_data
-                    lose_died_on_last_step_units_ids = player2_died_on_last_step_units_ids
-                    lose_alive_units_ids = player2_alive_units_ids
-                else:
-                    win_data = player2_data
-                    win_died_on_last_step_units_ids = player2_died_on_last_step_units_ids
-                    # win_alive_units_ids = player2_alive_units_ids
-                    lose_data = player1_data
-                    lose_died_on_last_step_units_ids = player1_died_on_last_step_units_ids
-                    lose_alive_units_ids = player1_alive_units_ids
-
-                for unit_id in win_data.keys():
-                    if unit_id in win_died_on_last_step_units_ids:
-                        unit_rewards[unit_id] = tf.constant(-0.33, dtype=tf.float16)
-                    else:
-                        unit_rewards[unit_id] = tf.constant(1, dtype=tf.float16)
-                for unit_id in lose_data.keys():
-                    if unit_id in lose_died_on_last_step_units_ids:
-                        unit_rewards[unit_id] = tf.constant(-1, dtype=tf.float16)
-                    elif unit_id in lose_alive_units_ids:
-                        unit_rewards[unit_id] = tf.constant(0.33, dtype=tf.float16)
-                    else:
-                        unit_rewards[unit_id] = tf.constant(0, dtype=tf.float16)
-            else:
-                players_data = {**player1_data, **player2_data}
-                for unit_id in players_data.keys():
-                    if unit_id in player1_died_on_last_step_units_ids + player2_died_on_last_step_units_ids:
-                        unit_rewards[unit_id] = tf.constant(-1, dtype=tf.float16)
-                    else:
-                        unit_rewards[unit_id] = tf.constant(0.33, dtype=tf.float16)
-
-            progress = tf.linspace(0., 1., step + 2)[:-1]
-            progress = tf.cast(progress, dtype=tf.float16)
-
-            # if reward1 > reward2:
-            #     final_reward_1 = tf.constant(1, dtype=tf.float16)
-            #     final_reward_2 = tf.constant(-1, dtype=tf.float16)
-            # elif reward1 < reward2:
-            #     final_reward_2 = tf.constant(1, dtype=tf.float16)
-            #     final_reward_1 = tf.constant(-1, dtype=tf.float16)
-            # else:
-            #     final_reward_1 = final_reward_2 = tf.constant(0, dtype=tf.float16)
-
-            # final_reward_1 = reward1 / REWARD_CAP if reward1 != -1 else 0
-            # final_reward_1 = 2 * final_reward_1 - 1
-            # final_reward_2 = reward2 / REWARD_CAP if reward2 != -1 else 0
-            # final_reward_2 = 2 * final_reward_2 - 1
-
-            if self._only_wins:
-                if reward1 > reward2:
-                    output = (player1_data, None), unit_rewards, progress
-                elif reward1 < reward2:
-                    output = (None, player2_data), unit_rewards, progress
-                else:
-                    output = (player1_data, player2_data), unit_rewards, progress
-            else:
-                output = (player1_data, player2_data), unit_rewards, progress
-
-            return output
+            return play_episode(agent, gym.make(self._env_name), self._only_wins)
 
         def collect_once(self):
             return self._collect(self._agent)
@@ -193,11 +74,15 @@ def collect(config_out, input_data_out, data_path_out, collector_n_out, global_v
                                      self._feature_maps_shape, self._actions_shape, collect_n,
                                      collect_n, progress,
                                      is_for_rl=self._is_for_rl, save_path=data_path, collector_n=collector_n,
-                                     is_pg_rl=self._is_pg_rl)
+                                     is_pg_rl=self._is_pg_rl, storage_format=self._storage_format,
+                                     shard_size=self._shard_size, compression=self._compression,
+                                     metadata={"episode": collect_n})
 
     def collect_and_store(iteration, conf, in_data, data_path, collector_n):
         collect_agent = Agent(conf, in_data)
         collect_agent.collect_and_store(iteration, data_path, collector_n)
+        # atexit hooks do not run in a multiprocessing child
+        tfrecords_storage.flush_writes()
 
     # collect_and_store(0, config_out, input_data_out, data_path_out, collector_n_out)
 
@@ -211,3 +96,318 @@ def collect(config_out, input_data_out, data_path_out, collector_n_out, global_v
 
     print("Collecting is done.")
     time.sleep(1)
+
+
+def collect_vectorized(config_out, input_data_out, data_path_out, collector_n_out, global_var_actor_out=None,
+                       steps=10):
+    import abc
+    import time
+    from multiprocessing import Process
+
+    import tensorflow as tf
+    import gym
+
+    from lux_ai import tools, tfrecords_storage
+    from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
+
+    physical_devices = tf.config.list_physical_devices('GPU')
+    if len(physical_devices) > 0:
+        tf.config.experimental.set_memory_growth(physical_devices[0], True)
+
+    class Agent(abc.ABC):
+        def __init__(self, config, data):
+            """
+            Args:
+                config: A configuration dictionary
+                data: a neural net weights
+            """
+            self._env_name = config["environment"]
+            self._model_name = config["model_name"]
+            self._n_envs = config["n_envs"]
+
+            self._feature_maps_shape = tools.get_feature_maps_shape(config["environment"])
+            self._actions_shape = [item.shape for item in empty_worker_action_vectors]
+            self._agent = make_agent(config, data, self._feature_maps_shape)
+            self._environments = [gym.make(self._env_name) for _ in range(self._n_envs)]
+
+            self._only_wins = config["only_wins"]
+            self._is_for_rl = config["is_for_rl"]
+            self._is_pg_rl = config["is_pg_rl"]
+            self._storage_format = config["storage_format"]
+            self._shard_size = config["shard_size"]
+            self._compression = config["tfrecord_compression"]
+
+        def _collect(self, n_envs):
+            return play_episodes(self._agent, self._environments[:n_envs], self._only_wins)
+
+        def collect_and_store(self, collect_round, n_envs, data_path, collector_n):
+            outputs = self._collect(n_envs)
+            for j, ((player1_data, player2_data), rewards, progress) in enumerate(outputs):
+                collect_n = collect_round * self._n_envs + j
+                tfrecords_storage.record(player1_data, player2_data, rewards,
+                                         self._feature_maps_shape, self._actions_shape, collect_n,
+                                         collect_n, progress,
+                                         is_for_rl=self._is_for_rl, save_path=data_path, collector_n=collector_n,
+                                         is_pg_rl=self._is_pg_rl, storage_format=self._storage_format,
+                                         shard_size=self._shard_size, compression=self._compression,
+                                         metadata={"episode": collect_n})
+
+    def collect_and_store(conf, in_data, data_path, collector_n, episodes):
+        # the model and environments are made once, rounds of n_envs games reuse them
+        collect_agent = Agent(conf, in_data)
+        envs_per_round = conf["n_envs"]
+        for i, start in enumerate(range(0, episodes, envs_per_round)):
+            collect_agent.collect_and_store(i, min(envs_per_round, episodes - start), data_path, collector_n)
+        # atexit hooks do not run in a multiprocessing child
+        tfrecords_storage.flush_writes()
+
+    # steps is a total amount of episodes, they are played by n_envs games at once
+    p = Process(target=collect_and_store,
+                args=(config_out, input_data_out, data_path_out, collector_n_out, steps))
+    p.start()
+    p.join()
+
+    print("Collecting is done.")
+    time.sleep(1)
+
+
+def make_agent(config, data, feature_maps_shape):
+    """
+    Makes an inference agent, which plays several games in lockstep with one forward pass per turn,
+    or a lux_gym processing agent for one game at a time, as collect does.
+
+    The inference agent processes observations with lux_gym tools and runs the same model,
+    its forward pass is batched over all units of all games, with a shared trunk over all players.
+    """
+    if config["shared_trunk"] or config["n_envs"] > 1:
+        from lux_ai import inference
+
+        return inference.Agent(config["model_name"], data, feature_maps_shape,
+                               shared_trunk=config["shared_trunk"], precision=config["inference_precision"])
+
+    import lux_gym.agents.agents as agents
+
+    if data is None:
+        print("Collecting from a random agent.")
+    return agents.get_processing_agent(config["model_name"], data)
+
+
+def play_episodes(agent, environments, only_wins):
+    from lux_ai import inference
+
+    if isinstance(agent, inference.Agent):
+        return play_lockstep(agent, environments, only_wins)
+    return [play_episode(agent, environment, only_wins) for environment in environments]
+
+
+def play_episode(agent, environment, only_wins):
+    """
+    Collects trajectories from an episode. Episodes consists of n_points.
+
+    One n_point contains (action, action_probs, action_mask, observation,
+                          total reward, temporal_mask, progress);
+    action is a response for the current observation,
+    reward, done are for the current observation.
+    """
+    from lux_ai import tools
+
+    player1_data = tools.TrajectoryBuffer()
+    player2_data = tools.TrajectoryBuffer()
+
+    observations = environment.reset()
+    configuration = environment.configuration
+    game_states = environment.game_states
+    actions_1, actions_1_dict, actions_1_probs, proc_obs1, reward1 = agent(observations[0],
+                                                                           configuration, game_states[0])
+    actions_2, actions_2_dict, actions_2_probs, proc_obs2, reward2 = agent(observations[1],
+                                                                           configuration, game_states[1])
+
+    step = 0
+    player1_data = tools.add_point(player1_data, actions_1_dict, actions_1_probs, proc_obs1, step)
+    player2_data = tools.add_point(player2_data, actions_2_dict, actions_2_probs, proc_obs2, step)
+
+    #  for step in range(1, configuration.episodeSteps):
+    while True:
+        step += 1
+        player1_prev_alive_units = [item.id for item in game_states[0].player.units]
+        player2_prev_alive_units = [item.id for item in game_states[1].player.units]
+        dones, observations = environment.step((actions_1, actions_2))
+        game_states = environment.game_states
+        if any(dones):
+            break
+        actions_1, actions_1_dict, actions_1_probs, proc_obs1, reward1 = agent(observations[0],
+                                                                               configuration, game_states[0])
+        actions_2, actions_2_dict, actions_2_probs, proc_obs2, reward2 = agent(observations[1],
+                                                                               configuration, game_states[1])
+
+        player1_data = tools.add_point(player1_data, actions_1_dict, actions_1_probs, proc_obs1, step)
+        player2_data = tools.add_point(player2_data, actions_2_dict, actions_2_probs, proc_obs2, step)
+
+    output = tools.get_episode_output(player1_data, player2_data,
+                                      (player1_prev_alive_units, player2_prev_alive_units),
+                                      game_states, observations, step, only_wins)
+    return output
+
+
+def play_lockstep(agent, environments, only_wins):
+    """
+    Plays an episode in every environment, all of them in lockstep.
+
+    On every turn observations of all units from all games and both players
+    go through one batched forward pass of the agent, and actions are scattered back.
+    Outputs are the same as for a single episode collector, one per environment.
+    """
+    from lux_ai import tools
+
+    n_envs = len(environments)
+    observations = [environment.reset() for environment in environments]
+    game_states = [environment.game_states for environment in environments]
+    players_data = [[tools.TrajectoryBuffer(), tools.TrajectoryBuffer()] for _ in range(n_envs)]
+    current_steps = [0 for _ in range(n_envs)]
+    outputs = [None for _ in range(n_envs)]
+
+    active_envs = list(range(n_envs))
+    while active_envs:
+        proc_obsns = [agent.process(observations[i][player], game_states[i][player])
+                      for i in active_envs for player in range(2)]
+        workers_probs = agent.predict(proc_obsns)
+
+        next_active_envs = []
+        for n, i in enumerate(active_envs):
+            players_actions = []
+            for player in range(2):
+                k = 2 * n + player
+                actions, actions_dict, actions_probs = agent.act(observations[i][player], game_states[i][player],
+                                                                 workers_probs[k])
+                players_data[i][player] = tools.add_point(players_data[i][player], actions_dict,
+                                                          actions_probs, proc_obsns[k], current_steps[i])
+                players_actions.append(actions)
+
+            current_steps[i] += 1
+            prev_alive_units = tuple([item.id for item in game_states[i][player].player.units]
+                                     for player in range(2))
+            dones, observations[i] = environments[i].step(tuple(players_actions))
+            game_states[i] = environments[i].game_states
+            if any(dones):
+                outputs[i] = tools.get_episode_output(players_data[i][0], players_data[i][1],
+                                                      prev_alive_units, game_states[i], observations[i],
+                                                      current_steps[i], only_wins)
+            else:
+                next_active_envs.append(i)
+        active_envs = next_active_envs
+
+    return outputs
+
+
+class Worker:
+    def __init__(self, config, data, collector_n, weights_store=None):
+        """
+        A long-lived collector, it keeps a model and environments alive between episodes
+        and cycles; new weights are swapped in with set_weights or taken from a weights store.
+
+        Args:
+            config: A configuration dictionary
+            data: a neural net weights
+            collector_n: to identify a current collector if there are several ones
+            weights_store: a weights store actor to check for new weights before collecting
+        """
+        import tensorflow as tf
+        import gym
+
+        from lux_ai import tools
+        from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
+
+        physical_devices = tf.config.list_physical_devices('GPU')
+        if len(physical_devices) > 0:
+            tf.config.experimental.set_memory_growth(physical_devices[0], True)
+
+        self._feature_maps_shape = tools.get_feature_maps_shape(config["environment"])
+        self._actions_shape = [item.shape for item in empty_worker_action_vectors]
+        self._config = config
+        self._agent = make_agent(config, data, self._feature_maps_shape)
+        self._environments = [gym.make(config["environment"]) for _ in range(config["n_envs"])]
+
+        self._only_wins = config["only_wins"]
+        self._is_for_rl = config["is_for_rl"]
+        self._is_pg_rl = config["is_pg_rl"]
+        self._storage_format = config["storage_format"]
+        self._shard_size = config["shard_size"]
+        self._compression = config["tfrecord_compression"]
+        self._collector_n = collector_n
+        self._episodes_n = 0
+        self._weights_store = weights_store
+        self._weights_version = None
+
+    def set_weights(self, data):
+        from lux_ai import inference
+
+        if data is None:
+            return
+        if isinstance(self._agent, inference.Agent):
+            self._agent.set_weights(data)
+        else:
+            # a lux_gym processing agent is built around its weights
+            self._agent = make_agent(self._config, data, self._feature_maps_shape)
+
+    def collect(self, steps, data_path, replay_buffer=None, cycle=None, flush=True):
+        """
+        Plays steps episodes and stores them to data_path and / or sends them to a replay buffer actor.
+        Episodes are not stored if data_path is None, cycle goes to the manifest of data_path.
+        With flush shards are written when it returns, so a trainer can read them.
+        """
+        from lux_ai import tools, tfrecords_storage
+
+        if self._weights_store is not None:
+            self._weights_version, data = tools.get_new_weights(self._weights_store, self._weights_version)
+            self.set_weights(data)
+
+        storage_format = self._storage_format if data_path is not None else None
+        n_envs = len(self._environments)
+        for start in range(0, steps, n_envs):
+            environments = self._environments[:min(n_envs, steps - start)]
+            outputs = play_episodes(self._agent, environments, self._only_wins)
+            for (player1_data, player2_data), rewards, progress in outputs:
+                tfrecords_storage.record(player1_data, player2_data, rewards,
+                                         self._feature_maps_shape, self._actions_shape, self._episodes_n,
+                                         self._episodes_n, progress,
+                                         is_for_rl=self._is_for_rl, save_path=data_path,
+                                         collector_n=self._collector_n, is_pg_rl=self._is_pg_rl,
+                                         storage_format=storage_format, replay_buffer=replay_buffer,
+                                         shard_size=self._shard_size, compression=self._compression,
+                                         metadata={"episode": self._episodes_n, "cycle": cycle})
+                self._episodes_n += 1
+        if flush:
+            # shards are written in background threads
+            tfrecords_storage.flush_writes()
+
+        print(f"Collector {self._collector_n}: collecting is done.")
+
+    def collect_until_done(self, data_path, replay_buffer, global_var_actor, pieces_n=10, piece_episodes=100):
+        """
+        Collects until the done flag is set, weights are refreshed from the weights store before every round of games.
+
+        Stored episodes rotate over pieces_n directories of data_path with piece_episodes episodes each,
+        a directory is cleared before it is written again, as storage directories of cycles are.
+        """
+        import os
+        import shutil
+
+        import ray
+
+        from lux_ai import tfrecords_storage
+
+        piece = None
+        piece_path = None
+        while not ray.get(global_var_actor.get_done.remote()):
+            if data_path is not None:
+                next_piece = (self._episodes_n // piece_episodes) % pieces_n
+                if next_piece != piece:
+                    piece = next_piece
+                    piece_path = f"{data_path}{self._collector_n}_{piece}/"
+                    tfrecords_storage.flush_writes()
+                    if os.path.exists(piece_path):
+                        shutil.rmtree(piece_path)
+                    os.makedirs(piece_path)
+            # shards are renamed into place when written, a reader does not wait for them
+            self.collect(len(self._environments), piece_path, replay_buffer, flush=False)
+        tfrecords_storage.flush_writes()
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+import tensorflow as tf
+
+from lux_ai import shard_manifest
+
+# a columnar shard is a directory with one .npy file per column, all columns have the same length
+SHARD_SUFFIX = ".cols"
+
+PG_COLUMNS = ("action_numbers", "action_probs_1", "action_probs_2", "action_probs_3",
+              "observation", "reward", "progress_value")
+IMITATOR_COLUMNS = ("observation", "action_probs_1", "action_probs_2", "action_probs_3", "reward")
+
+# a packed shard stores observations as bit planes of binary channels and uint8 quantized scalar channels
+PACKED_LAYOUT = "layout.json"
+# six actions probs of the frozen supervised model, added to pg shards after writing,
+# rows of shards without the column are read as -1
+TEACHER_COLUMN = "teacher_probs"
+TEACHER_MISSING = -1.
+
+
+def is_columnar(filename):
+    return filename.rstrip("/").endswith(SHARD_SUFFIX)
+
+
+def pack_observations(observations):
+    """
+    Splits observations [n, height, width, channels] into packed columns.
+
+    Channels with only 0 and 1 values in the shard go to bit planes, 8 channels per byte,
+    the rest is quantized to uint8 between per channel minimum and maximum of the shard.
+    Bit planes are exact, quantization is lossy: an unpacked scalar value is off by up to
+    (maximum - minimum) / 510 of its channel in the shard, before the float16 rounding of unpacking.
+    """
+    channels_n = observations.shape[-1]
+    flat = observations.reshape((-1, channels_n))
+    is_binary = np.all(np.logical_or(flat == 0, flat == 1), axis=0)
+    bits_channels = np.flatnonzero(is_binary)
+    scalar_channels = np.flatnonzero(np.logical_not(is_binary))
+
+    bits = np.packbits(observations[..., bits_channels].astype(np.uint8), axis=-1)
+    scalars = observations[..., scalar_channels].astype(np.float32)
+    if scalar_channels.size:
+        low = scalars.min(axis=(0, 1, 2))
+        high = scalars.max(axis=(0, 1, 2))
+    else:
+        low = high = np.zeros(0, dtype=np.float32)
+    scale = np.where(high > low, (high - low) / 255, 1.)
+    scalars = np.round((scalars - low) / scale).astype(np.uint8)
+
+    layout = {
+        "channels_n": int(channels_n),
+        "bits_channels": bits_channels.tolist(),
+        "scalar_channels": scalar_channels.tolist(),
+        "scalar_low": low.tolist(),
+        "scalar_scale": scale.tolist(),
+    }
+    return {"observation_bits": bits, "observation_scalars": scalars}, layout
+
+
+def unpack_observations(bits, scalars, layout, dtype=np.float16):
+    observations = np.empty(bits.shape[:-1] + (layout["channels_n"],), dtype=dtype)
+    bits_channels = layout["bits_channels"]
+    observations[..., bits_channels] = np.unpackbits(bits, axis=-1, count=len(bits_channels))
+    observations[..., layout["scalar_channels"]] = scalars * np.array(layout["scalar_scale"], dtype=np.float32) + \
+        np.array(layout["scalar_low"], dtype=np.float32)
+    return observations
+
+
+class PackedColumn:
+    # a read only observation column of a packed shard, slices are unpacked on access
+    def __init__(self, bits, scalars, layout):
+        self._bits = bits
+        self._scalars = scalars
+        self._layout = layout
+
+    @property
+    def shape(self):
+        return self._bits.shape[:-1] + (self._layout["channels_n"],)
+
+    def __getitem__(self, item):
+        return unpack_observations(self._bits[item], self._scalars[item], self._layout)
+
+
+def write_shard(columns, filename, pack=False):
+    # write to a temporary directory first, so readers never see a partial shard
+    tmp_filename = filename + ".tmp"
+    if os.path.exists(tmp_filename):
+        shutil.rmtree(tmp_filename)
+    os.makedirs(tmp_filename)
+    if pack:
+        columns = columns.copy()
+        packed_columns, layout = pack_observations(columns.pop("observation"))
+        columns.update(packed_columns)
+        with open(os.path.join(tmp_filename, PACKED_LAYOUT), "w") as layout_file:
+            json.dump(layout, layout_file)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_filename, name + ".npy"), values)
+    if os.path.exists(filename):
+        shutil.rmtree(filename)
+    os.rename(tmp_filename, filename)
+
+
+def has_column(filename, name):
+    return os.path.exists(os.path.join(filename, name + ".npy"))
+
+
+def load_column(filename, name):
+    if name == TEACHER_COLUMN and not has_column(filename, name):
+        return None
+    return np.load(os.path.join(filename, name + ".npy"), mmap_mode="r")
+
+
+def load_shard(filename, columns):
+    # memory mapped, slicing does not read the whole column
+    layout_path = os.path.join(filename, PACKED_LAYOUT)
+    if "observation" in columns and os.path.exists(layout_path):
+        with open(layout_path, "r") as layout_file:
+            layout = json.load(layout_file)
+        observation = PackedColumn(load_column(filename, "observation_bits"),
+                                   load_column(filename, "observation_scalars"),
+                                   layout)
+        return {name: observation if name == "observation" else load_column(filename, name) for name in columns}
+    return {name: load_column(filename, name) for name in columns}
+
+
+def add_column(filename, name, values):
+    # a column is renamed into place, readers see a shard with or without it
+    tmp_filename = os.path.join(filename, name + ".tmp")
+    with open(tmp_filename, "wb") as column_file:
+        np.save(column_file, values)
+    os.replace(tmp_filename, os.path.join(filename, name + ".npy"))
+
+
+def add_teacher_probs(filenames, model, batch_size=500):
+    """
+    Adds probs of a frozen teacher model to pg columnar shards which do not have them yet.
+
+    A forward pass is done once per record, a trainer reads the probs instead of running the teacher.
+    TFRecord files in filenames are skipped. Shards are changed in place, pass only shards of a cache
+    which are keyed by the teacher weights, see shard_cache.ShardCache.
+    """
+    t1 = time.time()
+    annotated_n = 0
+    for filename in filenames:
+        if not is_columnar(filename) or has_column(filename, TEACHER_COLUMN):
+            continue
+        observation = load_shard(filename, ("observation",))["observation"]
+        probs = []
+        for start in range(0, observation.shape[0], batch_size):
+            batch = np.asarray(observation[start: start + batch_size], dtype=np.float32)
+            batch_probs, _ = model(batch, training=False)
+            probs.append(batch_probs.numpy())
+        add_column(filename, TEACHER_COLUMN, np.concatenate(probs).astype(np.float16))
+        annotated_n += 1
+    t2 = time.time()
+    if annotated_n:
+        print(f"Teacher probs: {annotated_n} shards annotated in {t2 - t1:.2f}s.")
+
+
+def shard_length(filename, columns):
+    return load_shard(filename, columns[:1])[columns[0]].shape[0]
+
+
+def iterate_columns(ds, is_pg_rl, chunk_size=3000):
+    """
+    Collects records of a record() dataset to columns.
+
+    Yields (an index of the first record, {column name: stacked values}) for every chunk_size records.
+    """
+    if is_pg_rl:
+        columns_names = PG_COLUMNS
+    else:
+        columns_names = IMITATOR_COLUMNS
+
+    def to_numpy(item):
+        if isinstance(item, tf.SparseTensor):
+            item = tf.sparse.to_dense(item)
+        return item.numpy()
+
+    columns = {name: [] for name in columns_names}
+    n_first = 0
+    for n, record in enumerate(ds):
+        if is_pg_rl:
+            action_numbers, action_probs, observation, reward, progress_value = record
+            values = (action_numbers, *action_probs, observation, reward, progress_value)
+        else:
+            observation, action_probs, reward = record
+            values = (observation, *action_probs, reward)
+        for name, value in zip(columns_names, values):
+            columns[name].append(to_numpy(value))
+        if len(columns[columns_names[0]]) == chunk_size:
+            yield n_first, {name: np.stack(values) for name, values in columns.items()}
+            columns = {name: [] for name in columns_names}
+            n_first = n + 1
+    if columns[columns_names[0]]:
+        yield n_first, {name: np.stack(values) for name, values in columns.items()}
+
+
+def get_shard_filename(save_path, record_name, n_first, collector_n=None):
+    if collector_n is not None:
+        return f"{save_path}{collector_n}_{record_name}_{n_first}{SHARD_SUFFIX}"
+    return f"{save_path}{record_name}_{n_first}{SHARD_SUFFIX}"
+
+
+def write_columnar(ds, record_number, record_name, is_pg_rl, save_path, collector_n=None, shard_size=3000,
+                   pack=False, metadata=None):
+    """
+    Writes records of a record() dataset to fixed shape columnar shards.
+
+    Only per step records (pg and imitator) are supported,
+    full trajectories for rl are written as TFRecords.
+    With pack=True observations are stored as bit planes and quantized scalars, see pack_observations;
+    binary channels are exact and scalar channels are lossy.
+    Written shards are added to the manifest of save_path with episode metadata.
+    """
+    n = 0
+    for n_first, columns in iterate_columns(ds, is_pg_rl, shard_size):
+        shard_filename = get_shard_filename(save_path, record_name, n_first, collector_n)
+        write_shard(columns, shard_filename, pack)
+        records_n = len(columns["observation"])
+        shard_manifest.add_shard(shard_filename, records_n,
+                                 {**(metadata or {}), "reward": float(np.mean(columns["reward"]))})
+        n = n_first + records_n
+    print(f"Wrote group #{record_number} {record_name} columnar shards containing {n} records")
+
+
+def read_columnar(filenames, columns, output_signature, chunk_size=256, shuffle_buffer=None, seed=None):
+    """
+    Makes a dataset of single records from columnar shards.
+
+    Shards are visited in a random order, contiguous chunks are sliced from memory mapped columns
+    and unbatched, so there is no per record decoding. Packed observations are unpacked per chunk,
+    their scalar channels are quantized values, see pack_observations.
+    With shuffle_buffer records are shuffled as they are stored, in float16, before any casting.
+    Shard order and chunk offsets are tf.data datasets, only chunk loading is a python function,
+    so an iterator of the dataset can be saved with tf.train.Checkpoint.
+    Chunks are unbatched on purpose: readers merge them record by record with tfrecord datasets,
+    filter and augment records, and a chunk is a run of one episode, which should not make a batch.
+    """
+    filenames = list(filenames)
+    lengths = [shard_length(filename, columns) for filename in filenames]
+    dtypes = [spec.dtype for spec in output_signature]
+
+    def load_chunk(filename, start):
+        shard = load_shard(filename.decode(), columns)
+        chunk = []
+        for name, spec in zip(columns, output_signature):
+            if shard[name] is None:
+                # a missing teacher column, it goes after data columns
+                chunk.append(np.full([len(chunk[0])] + list(spec.shape), TEACHER_MISSING,
+                                     dtype=spec.dtype.as_numpy_dtype))
+            else:
+                chunk.append(np.asarray(shard[name][start: start + chunk_size]))
+        return tuple(chunk)
+
+    def read_chunk(filename, start):
+        chunk = tf.numpy_function(load_chunk, [filename, start], dtypes)
+        for item, spec in zip(chunk, output_signature):
+            item.set_shape([None] + list(spec.shape))
+        return tuple(chunk)
+
+    ds = tf.data.Dataset.from_tensor_slices((filenames, tf.constant(lengths, dtype=tf.int64)))
+    ds = ds.shuffle(len(filenames), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.flat_map(lambda filename, length: tf.data.Dataset.range(0, length, chunk_size).map(
+        lambda start: (filename, start)))
+    ds = ds.map(read_chunk, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.unbatch()
+    if shuffle_buffer:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    return ds
@@ -10,6 +10,7 @@ import kaggle_environments as kaggle
 import ray
 
 import lux_gym.agents.agents as agents
+from lux_ai import tools
 
 physical_devices = tf.config.list_physical_devices('GPU')
 if len(physical_devices) > 0:
@@ -17,7 +18,7 @@ if len(physical_devices) > 0:
 
 
 class Agent(abc.ABC):
-    def __init__(self, config, data, global_var_actor=None):
+    def __init__(self, config, data, global_var_actor=None, weights_store=None):
         self._model_name = config["model_name"]
         self._compare_agent = agents.get_agent(config["eval_compare_agent"], is_gym=False)
         if data:
@@ -26,25 +27,36 @@ class Agent(abc.ABC):
             self._agent = None
 
         self._global_var_actor = global_var_actor if global_var_actor else None
+        # with a weights store new weights are taken from it instead of files
+        self._weights_store = weights_store
+        self._weights_version = None
 
     def evaluate(self):
         prev_files_n = 0
         summary = [0, 0]
 
         while True:
-            files = glob.glob("./data/weights/*.pickle")
-            files_n = len(files)
-            if files_n > prev_files_n:
-                raw_names = [int(pathlib.Path(file_name).stem) for file_name in files]
-                np_names = np.array(raw_names)
-                last_file_arg_number = np.argmax(np_names)
-                last_file = files[last_file_arg_number]
-                with open(last_file, 'rb') as file:
-                    data = pickle.load(file)
-                    raw_name = raw_names[last_file_arg_number]
-                self._agent = agents.get_agent(self._model_name, data, is_gym=False)
-                summary = [0, 0]
-                print(f"Evaluating {raw_name}.pickle weights.")
+            if self._weights_store is not None:
+                self._weights_version, data = tools.get_new_weights(self._weights_store, self._weights_version)
+                if data is not None:
+                    self._agent = agents.get_agent(self._model_name, data, is_gym=False)
+                    summary = [0, 0]
+                    print(f"Evaluating weights version {self._weights_version}.")
+            else:
+                files = glob.glob("./data/weights/*.pickle")
+                files_n = len(files)
+                if files_n > prev_files_n:
+                    raw_names = [int(pathlib.Path(file_name).stem) for file_name in files]
+                    np_names = np.array(raw_names)
+                    last_file_arg_number = np.argmax(np_names)
+                    last_file = files[last_file_arg_number]
+                    with open(last_file, 'rb') as file:
+                        data = pickle.load(file)
+                        raw_name = raw_names[last_file_arg_number]
+                    self._agent = agents.get_agent(self._model_name, data, is_gym=False)
+                    summary = [0, 0]
+                    print(f"Evaluating {raw_name}.pickle weights.")
+                prev_files_n = files_n
             if self._agent is not None:
                 environment = kaggle.make("lux_ai_2021", configuration={"loglevel": 2}, debug=False)
                 steps = environment.run([self._compare_agent, self._agent])
@@ -64,7 +76,5 @@ class Agent(abc.ABC):
                 if is_done:
                     break
 
-            prev_files_n = files_n
-
         print("Evaluation is done.")
         time.sleep(1)
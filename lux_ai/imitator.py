@@ -20,6 +20,7 @@ class Agent(abc.ABC):
         self._actions_shape = [item.shape for item in empty_worker_action_vectors]
         self._model_name = config["model_name"]
         self._batch_size = config["batch_size"]
+        self._shuffle_buffer = config["shuffle_buffer"]
         if self._model_name == "actor_critic_residual_shrub":
             self._model = models.actor_critic_residual_shrub()
             self._loss_function_movements = tools.LossFunction2()
@@ -38,10 +39,10 @@ class Agent(abc.ABC):
             self._loss_function2 = tools.LossFunction2(tf.constant([self._batch_size], dtype=tf.int64))
             self._loss_function3 = tools.LossFunction3(tf.constant([self._batch_size], dtype=tf.int64))
         elif self._model_name == "actor_critic_residual_six_actions":
-            self._model = models.actor_critic_residual_six_actions(6)
+            self._model = models.actor_critic_residual_six_actions(6, shared_trunk=config["shared_trunk"])
             self._loss_function = tools.LossFunctionSixActions()
         elif self._model_name == "actor_critic_sep_residual_six_actions":
-            self._model = models.actor_critic_sep_residual_six_actions(6)
+            self._model = models.actor_critic_sep_residual_six_actions(6, shared_trunk=config["shared_trunk"])
             self._loss_function = tools.LossFunctionSixActions()
         elif self._model_name == "actor_critic_efficient_six_actions":
             self._model = models.actor_critic_efficient_six_actions(6)
@@ -72,8 +73,10 @@ class Agent(abc.ABC):
     def imitate(self):
         ds_train = tfrecords_storage.read_records_for_imitator(self._feature_maps_shape, self._actions_shape,
                                                                self._model_name,
-                                                               "data/tfrecords/imitator/train/")
-        ds_train = ds_train.batch(self._batch_size).prefetch(1)  # , drop_remainder=True)
+                                                               "data/tfrecords/imitator/train/",
+                                                               batch_size=self._batch_size,
+                                                               shuffle_buffer=self._shuffle_buffer)
+        ds_train = ds_train.prefetch(1)
 
         # for sample in ds_train:
         #     observations = sample[0].numpy()
@@ -248,8 +251,10 @@ class Agent(abc.ABC):
                                                                self._model_name,
                                                                "_0^0_",
                                                                filenames=self._filenames,
-                                                               amplify_probs=True)
-        ds_train = ds_train.batch(self._batch_size).prefetch(1)  # , drop_remainder=True)
+                                                               amplify_probs=True,
+                                                               batch_size=self._batch_size,
+                                                               shuffle_buffer=self._shuffle_buffer)
+        ds_train = ds_train.prefetch(1)
 
         # for sample in ds_train.take(10):
         #     observations = sample[0].numpy()
@@ -0,0 +1,213 @@
+import numpy as np
+
+from lux_ai import models
+from lux_gym.envs.lux.action_vectors_new import worker_action_vector, dir_action_vector
+from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
+import lux_gym.envs.tools as env_tools
+
+# six actions model outputs: 4 movements ordered as the direction vectors, idle, build a city
+DIRECTIONS = sorted(dir_action_vector.keys(), key=lambda key: np.argmax(dir_action_vector[key]))
+MOVE_IDX = np.argmax(worker_action_vector["m"])
+IDLE_IDX = np.argmax(worker_action_vector["idle"])
+BCITY_IDX = np.argmax(worker_action_vector["bcity"])
+
+
+def get_model(model_name, feature_maps_shape, data=None, precision=None, shared_trunk=False):
+    import tensorflow as tf
+
+    precision = models.get_precision(precision)
+    if model_name == "actor_critic_residual_six_actions":
+        model = models.actor_critic_residual_six_actions(6, precision, shared_trunk)
+    elif model_name == "actor_critic_sep_residual_six_actions":
+        model = models.actor_critic_sep_residual_six_actions(6, precision, shared_trunk)
+    else:
+        raise NotImplementedError
+
+    # launch a model once to define structure
+    dummy_feature_maps = np.zeros(feature_maps_shape, dtype=np.float32)
+    dummy_feature_maps[6, 6, :1] = 1
+    dummy_input = tf.convert_to_tensor(dummy_feature_maps, dtype=tf.float32)
+    dummy_input = tf.nest.map_structure(lambda x: tf.expand_dims(x, axis=0), dummy_input)
+    model(dummy_input)
+    if data is not None:
+        model.set_weights(data['weights'])
+    return model
+
+
+def get_shared_inputs(units_obs):
+    """
+    Splits per unit observations of one player into a shared map and unit positions.
+
+    Units observations have to differ only by the unit mask in the 0 channel,
+    the shared map is the first unit observation with the mask zeroed.
+    """
+    unit_ids = list(units_obs.keys())
+    shared_map = np.array(units_obs[unit_ids[0]], dtype=np.float32)
+    shared_map[:, :, 0] = 0
+    positions = []
+    for unit_id in unit_ids:
+        observation = units_obs[unit_id]
+        if not np.array_equal(observation[:, :, 1:], shared_map[:, :, 1:]):
+            raise ValueError(f"Observation of {unit_id} differs from other units not only by the unit mask.")
+        mask = observation[:, :, 0]
+        positions.append(np.unravel_index(np.argmax(mask), mask.shape))
+    return unit_ids, shared_map, np.array(positions, dtype=np.int32).reshape((-1, 2))
+
+
+def predict(model, players_units_obs, shared_trunk=False):
+    """
+    Gets action probabilities for the units of several players in one forward pass.
+
+    Args:
+        model: a six actions residual model
+        players_units_obs: a list of {unit_id: observation} dicts, one per player (and game)
+        shared_trunk: run the trunk once per player instead of once per unit
+
+    Returns:
+        a list of {unit_id: probs} dicts in the order of players_units_obs
+    """
+    import tensorflow as tf
+
+    players_units_obs = [units_obs if units_obs else {} for units_obs in players_units_obs]
+    if not any(players_units_obs):
+        return [{} for _ in players_units_obs]
+
+    unit_ids = []
+    if shared_trunk:
+        shared_maps = []
+        positions = []
+        for units_obs in players_units_obs:
+            if not units_obs:
+                unit_ids.append([])
+                continue
+            ids, shared_map, unit_positions = get_shared_inputs(units_obs)
+            map_idx = np.full((len(ids), 1), len(shared_maps), dtype=np.int32)
+            positions.append(np.concatenate([map_idx, unit_positions], axis=1))
+            shared_maps.append(shared_map)
+            unit_ids.append(ids)
+        probs, _ = model.call_shared(tf.convert_to_tensor(np.stack(shared_maps)),
+                                     tf.convert_to_tensor(np.concatenate(positions)))
+    else:
+        observations = []
+        for units_obs in players_units_obs:
+            unit_ids.append(list(units_obs.keys()))
+            observations.extend(units_obs.values())
+        probs, _ = model(tf.convert_to_tensor(np.stack(observations), dtype=tf.float32))
+    probs = probs.numpy()
+
+    output = []
+    start = 0
+    for ids in unit_ids:
+        output.append(dict(zip(ids, probs[start: start + len(ids)])))
+        start += len(ids)
+    return output
+
+
+def get_workers_actions(workers_probs, rng):
+    """
+    Samples worker actions from six actions probabilities.
+
+    Returns action strings and action vectors / action vectors probs dicts
+    in the format used by tools.add_point and tfrecords_storage.record.
+    """
+    actions = []
+    actions_dict = {}
+    actions_probs = {}
+    for unit_id, probs in workers_probs.items():
+        probs = probs.astype(np.float64)
+        action = rng.choice(6, p=probs / np.sum(probs))
+
+        action_vectors = empty_worker_action_vectors.copy()
+        if action < 4:
+            direction = DIRECTIONS[action]
+            actions.append(f"m {unit_id} {direction}")
+            action_vectors[0] = worker_action_vector["m"]
+            action_vectors[1] = dir_action_vector[direction]
+        elif action == 4:
+            actions.append(f"m {unit_id} c")
+            action_vectors[0] = worker_action_vector["idle"]
+        else:
+            actions.append(f"bcity {unit_id}")
+            action_vectors[0] = worker_action_vector["bcity"]
+        actions_dict[unit_id] = action_vectors
+
+        movements = probs[:4]
+        movements_sum = np.sum(movements)
+        general_probs = np.zeros_like(empty_worker_action_vectors[0], dtype=np.float32)
+        general_probs[MOVE_IDX] = movements_sum
+        general_probs[IDLE_IDX] = probs[4]
+        general_probs[BCITY_IDX] = probs[5]
+        dir_probs = movements / movements_sum if movements_sum > 0 else np.zeros_like(movements)
+        res_probs = np.zeros_like(empty_worker_action_vectors[2], dtype=np.float32)
+        actions_probs[unit_id] = [general_probs, dir_probs.astype(np.float32), res_probs]
+    return actions, actions_dict, actions_probs
+
+
+def get_city_tiles_actions(player):
+    # build workers while there are less units than city tiles, research otherwise
+    actions = []
+    units_n = len(player.units)
+    for city in player.cities.values():
+        for citytile in city.citytiles:
+            if citytile.cooldown >= 1:
+                continue
+            x, y = citytile.pos.x, citytile.pos.y
+            if units_n < player.city_tile_count:
+                actions.append(f"bw {x} {y}")
+                units_n += 1
+            elif player.research_points < 200:
+                actions.append(f"r {x} {y}")
+    return actions
+
+
+class Agent:
+    def __init__(self, model_name, data, feature_maps_shape, shared_trunk=False, seed=None, precision=None):
+        """
+        A processing agent with the same outputs as lux_gym processing agents,
+        which exposes processing and the model call separately to batch inference.
+
+        Args:
+            model_name: a six actions residual model name
+            data: a neural net weights
+            feature_maps_shape: a shape of one unit observation
+            shared_trunk: a model without the unit mask in the trunk, it runs once per player instead of once per unit
+            seed: a seed for actions sampling
+            precision: None for float32, "mixed_float16" or "mixed_bfloat16"
+        """
+        import tensorflow as tf
+
+        physical_devices = tf.config.list_physical_devices('GPU')
+        if len(physical_devices) > 0:
+            tf.config.experimental.set_memory_growth(physical_devices[0], True)
+
+        if data is None:
+            print("Acting with initial weights.")
+        self._model = get_model(model_name, feature_maps_shape, data, precision, shared_trunk)
+        self._shared_trunk = shared_trunk
+        self._rng = np.random.default_rng(seed)
+
+    def set_weights(self, data):
+        self._model.set_weights(data['weights'])
+
+    @staticmethod
+    def process(observation, game_state):
+        proc_obs = env_tools.get_separate_outputs(observation, game_state)
+        # process only workers data
+        proc_obs.pop("carts")
+        proc_obs.pop("city_tiles")
+        return proc_obs
+
+    def predict(self, proc_obsns):
+        return predict(self._model, [proc_obs["workers"] for proc_obs in proc_obsns], self._shared_trunk)
+
+    def act(self, observation, game_state, workers_probs):
+        player = game_state.players[observation.player]
+        workers_actions, workers_dict, workers_probs = get_workers_actions(workers_probs, self._rng)
+        actions = workers_actions + get_city_tiles_actions(player)
+        return actions, {"workers": workers_dict}, {"workers": workers_probs}
+
+    def __call__(self, observation, configuration, game_state):
+        proc_obs = self.process(observation, game_state)
+        workers_probs = self.predict([proc_obs])[0]
+        actions, actions_dict, actions_probs = self.act(observation, game_state, workers_probs)
+        return actions, actions_dict, actions_probs, proc_obs, observation["reward"]
@@ -1,7 +1,40 @@
 # move all imports inside functions to use ray.remote multitasking
 
 
-def actor_critic_residual_six_actions(actions_shape):
+def get_precision(precision):
+    """
+    Returns a precision policy name for residual models, None for float32.
+
+    mixed_float16 needs a GPU, on a CPU it is replaced with mixed_bfloat16.
+    """
+    import tensorflow as tf
+
+    if not precision or precision == "float32":
+        return None
+    if precision not in ("mixed_float16", "mixed_bfloat16"):
+        raise NotImplementedError
+    if precision == "mixed_float16" and not tf.config.list_physical_devices('GPU'):
+        return "mixed_bfloat16"
+    return precision
+
+
+def build_with_precision(model_class, precision, *args):
+    # layers take the global policy when they are created, it is set only for this model
+    if not precision:
+        return model_class(*args)
+    import tensorflow as tf
+
+    import lux_ai.utils as utils
+
+    policy = tf.keras.mixed_precision.global_policy()
+    utils.set_precision_policy(precision)
+    try:
+        return model_class(*args)
+    finally:
+        tf.keras.mixed_precision.set_global_policy(policy)
+
+
+def actor_critic_residual_six_actions(actions_shape, precision=None, shared_trunk=False):
     import tensorflow as tf
     import tensorflow.keras as keras
 
@@ -24,9 +57,12 @@ def actor_critic_residual_six_actions(actions_shape):
             return [batch, x, y, self._filters]
 
     class ResidualModel(keras.Model):
-        def __init__(self, actions_number, **kwargs):
+        def __init__(self, actions_number, shared_trunk, **kwargs):
             super().__init__(**kwargs)
 
+            # with a shared trunk the unit mask is not a trunk input, units are told apart at the heads
+            self._shared_trunk = shared_trunk
+
             filters = 200
             layers = 10
 
@@ -46,18 +82,19 @@ def actor_critic_residual_six_actions(actions_shape):
             # self._city_tiles_probs0 = keras.layers.Dense(128, activation=activation, kernel_initializer=initializer)
             # self._city_tiles_probs1 = keras.layers.Dense(4, activation="softmax",
             #                                              kernel_initializer=initializer_random)
+            # outputs are float32 with mixed precision
             self._workers_probs0 = keras.layers.Dense(128, activation=activation, kernel_initializer=initializer)
             self._workers_probs1 = keras.layers.Dense(actions_number, activation="softmax",
-                                                      kernel_initializer=initializer_random)
+                                                      kernel_initializer=initializer_random, dtype="float32")
             # self._carts_probs0 = keras.layers.Dense(128, activation=activation, kernel_initializer=initializer)
             # self._carts_probs1 = keras.layers.Dense(17, activation="softmax", kernel_initializer=initializer_random)
 
             self._baseline = keras.layers.Dense(1, kernel_initializer=initializer_random,
-                                                activation=keras.activations.tanh)
+                                                activation=keras.activations.tanh, dtype="float32")
 
         def call(self, inputs, training=False, mask=None):
             features = inputs
-            x = features
+            x = features[:, :, :, 1:] if self._shared_trunk else features
 
             x = self._conv(x)
             x = self._norm(x, training=training)
@@ -70,7 +107,7 @@ def actor_critic_residual_six_actions(actions_shape):
             y = tf.reshape(x, (shape_x[0], -1, shape_x[-1]))
             y = tf.reduce_mean(y, axis=1)
 
-            z1 = (x * features[:, :, :, :1])
+            z1 = (x * tf.cast(features[:, :, :, :1], x.dtype))
             shape_z = tf.shape(z1)
             z1 = tf.reshape(z1, (shape_z[0], -1, shape_z[-1]))
             z1 = tf.reduce_sum(z1, axis=1)
@@ -92,14 +129,49 @@ def actor_critic_residual_six_actions(actions_shape):
 
             return probs, baseline
 
+        def call_shared(self, features, positions, training=False):
+            # features are per player maps, the 0 channel is not used,
+            # positions are [units, 3] (map index in the batch, row, column) of the units to get outputs for;
+            # the trunk runs once per map and the heads are gathered at the unit positions,
+            # outputs are the same as call outputs for unit observations of the maps
+            if not self._shared_trunk:
+                raise ValueError("The model trunk takes the unit mask, build it with shared_trunk.")
+            x = features[:, :, :, 1:]
+
+            x = self._conv(x)
+            x = self._norm(x, training=training)
+            x = self._activation(x)
+
+            for layer in self._residual_block:
+                x = layer(x, training=training)
+
+            shape_x = tf.shape(x)
+            y = tf.reshape(x, (shape_x[0], -1, shape_x[-1]))
+            y = tf.reduce_mean(y, axis=1)
+            y = tf.gather(y, positions[:, 0])
+
+            z1 = tf.gather_nd(x, positions)
+            z2 = self._depthwise(x)
+            z2 = self._flatten(z2)
+            z2 = tf.gather(z2, positions[:, 0])
+            z = tf.concat([z1, z2], axis=1)
+
+            w = self._workers_probs0(z)
+            w = self._workers_probs1(w)
+            probs = w
+
+            baseline = self._baseline(tf.concat([y, z], axis=1))
+
+            return probs, baseline
+
         def get_config(self):
             pass
 
-    model = ResidualModel(actions_shape)
+    model = build_with_precision(ResidualModel, precision, actions_shape, shared_trunk)
     return model
 
 
-def actor_critic_sep_residual_six_actions(actions_shape):
+def actor_critic_sep_residual_six_actions(actions_shape, precision=None, shared_trunk=False):
     import tensorflow as tf
     import tensorflow.keras as keras
 
@@ -151,6 +223,26 @@ def actor_critic_sep_residual_six_actions(actions_shape):
 
             return z
 
+        def call_shared(self, inputs, training=False):
+            x, positions = inputs
+
+            for layer in self._residual_block:
+                x = layer(x, training=training)
+
+            shape_x = tf.shape(x)
+            y = tf.reshape(x, (shape_x[0], -1, shape_x[-1]))
+            y = tf.reduce_mean(y, axis=1)
+            y = tf.gather(y, positions[:, 0])
+
+            z1 = tf.gather_nd(x, positions)
+            z2 = self._depthwise(x)
+            z2 = self._flatten(z2)
+            z2 = tf.gather(z2, positions[:, 0])
+            z = tf.concat([y, z1, z2], axis=1)
+            z = self._fc_128(z)
+
+            return z
+
     class ActorBranch(keras.layers.Layer):
         def __init__(self, filters, initializer, activation, layers, **kwargs):
             super().__init__(**kwargs)
@@ -176,10 +268,27 @@ def actor_critic_sep_residual_six_actions(actions_shape):
             z = self._fc_128(z)
             return z
 
+        def call_shared(self, inputs, training=False):
+            x, positions = inputs
+
+            for layer in self._residual_block:
+                x = layer(x, training=training)
+
+            z1 = tf.gather_nd(x, positions)
+            z2 = self._depthwise(x)
+            z2 = self._flatten(z2)
+            z2 = tf.gather(z2, positions[:, 0])
+            z = tf.concat([z1, z2], axis=1)
+            z = self._fc_128(z)
+            return z
+
     class ResidualModel(keras.Model):
-        def __init__(self, actions_number, **kwargs):
+        def __init__(self, actions_number, shared_trunk, **kwargs):
             super().__init__(**kwargs)
 
+            # with a shared trunk the unit mask is not a trunk input, units are told apart at the heads
+            self._shared_trunk = shared_trunk
+
             initializer = keras.initializers.VarianceScaling(scale=2.0, mode='fan_in', distribution='truncated_normal')
             initializer_random = keras.initializers.random_uniform(minval=-0.03, maxval=0.03)
             activation = keras.activations.relu
@@ -192,24 +301,25 @@ def actor_critic_sep_residual_six_actions(actions_shape):
             actor_filters = 200
             actor_layers = 10
             self._actor_branch = ActorBranch(actor_filters, initializer, activation, actor_layers)
+            # outputs are float32 with mixed precision
             self._action_type = keras.layers.Dense(actions_number, activation="softmax",
-                                                   kernel_initializer=initializer_random)
+                                                   kernel_initializer=initializer_random, dtype="float32")
             # critic
             critic_filters = 200
             critic_layers = 10
             self._critic_branch = CriticBranch(critic_filters, initializer, activation, critic_layers)
             self._baseline = keras.layers.Dense(1, kernel_initializer=initializer_random,
-                                                activation=keras.activations.tanh)
+                                                activation=keras.activations.tanh, dtype="float32")
 
         def call(self, inputs, training=False, mask=None):
             features = inputs
-            x = features
+            x = features[:, :, :, 1:] if self._shared_trunk else features
 
             x = self._root(x)
             x = self._root_norm(x, training=training)
             x = self._root_activation(x)
 
-            center = features[:, :, :, :1]
+            center = tf.cast(features[:, :, :, :1], x.dtype)
             z = (x, center)
 
             w1 = self._actor_branch(z, training=training)
@@ -220,10 +330,33 @@ def actor_critic_sep_residual_six_actions(actions_shape):
 
             return action_probs, baseline
 
+        def call_shared(self, features, positions, training=False):
+            # features are per player maps, the 0 channel is not used,
+            # positions are [units, 3] (map index in the batch, row, column) of the units to get outputs for;
+            # the root and branch trunks run once per map and the heads are gathered at the unit positions,
+            # outputs are the same as call outputs for unit observations of the maps
+            if not self._shared_trunk:
+                raise ValueError("The model trunk takes the unit mask, build it with shared_trunk.")
+            x = features[:, :, :, 1:]
+
+            x = self._root(x)
+            x = self._root_norm(x, training=training)
+            x = self._root_activation(x)
+
+            z = (x, positions)
+
+            w1 = self._actor_branch.call_shared(z, training=training)
+            action_probs = self._action_type(w1)
+
+            w2 = self._critic_branch.call_shared(z, training=training)
+            baseline = self._baseline(w2)
+
+            return action_probs, baseline
+
         def get_config(self):
             pass
 
-    model = ResidualModel(actions_shape)
+    model = build_with_precision(ResidualModel, precision, actions_shape, shared_trunk)
     return model
 
 
@@ -0,0 +1,224 @@
+import os
+import glob
+import pickle
+import shutil
+import random
+import pathlib
+import itertools
+import collections
+
+import numpy as np
+import ray
+
+from lux_ai import collector, evaluator, tools, tfrecords_storage, replay, shard_manifest
+
+ASYNC_WEIGHTS_PATH = "data/weights/async/"
+AC_MC_CHECKPOINT_PATH = "data/checkpoints/ac_mc/"  # checkpoints of the ac mc trainer
+
+
+class Trainer:
+    def __init__(self, config, data, replay_buffer=None, weights_store=None, global_var_actor=None):
+        """
+        A long-lived ac mc trainer, the model, the optimizer and traced training steps
+        are kept between cycles.
+
+        Args:
+            config: A configuration dictionary
+            data: a neural net weights
+            replay_buffer: a replay buffer actor to sample from instead of files
+            weights_store: a weights store actor to publish trained weights to
+            global_var_actor: a done flag to set after asynchronous training
+        """
+        from lux_ai import trainer_ac_mc
+
+        self._agent = trainer_ac_mc.ac_mc_agent(config, data, global_var_actor_in=global_var_actor,
+                                                replay_buffer_in=replay_buffer, weights_store_in=weights_store)
+
+    def train_async(self, steps, publish_steps, snapshot_steps):
+        self._agent.do_train_async(steps, publish_steps, snapshot_steps)
+
+    def train(self, filenames, current_cycle):
+        # weights go to the weights store, they are not returned
+        self._agent.set_cycle(filenames, current_cycle)
+        self._agent.do_train()
+
+
+def get_cycle_filenames(current_n, previous_pieces):
+    # fixed scraped files are mixed with collected files, twice less of them
+    fnames_fixed = tfrecords_storage.glob_records("data/tfrecords/rl/storage/")
+    fnames_curr = tfrecords_storage.glob_records(f"data/tfrecords/rl/storage_{current_n}/")
+    fnames_prev_list = [tfrecords_storage.glob_records(f"data/tfrecords/rl/storage_{i}/")
+                        for i in previous_pieces]
+    fnames_prev_list = list(itertools.chain.from_iterable(fnames_prev_list))
+    fixed_counts = shard_manifest.get_record_counts(fnames_fixed)
+    self_exp_counts = shard_manifest.get_record_counts(fnames_prev_list + fnames_curr)
+    if fnames_fixed and fixed_counts is not None and self_exp_counts is not None:
+        # with manifests fixed records are twice less than collected records, not files
+        records_to_take = sum(self_exp_counts) / 2
+        fixed_indices = []
+        while records_to_take > 0 and len(fixed_indices) < len(fnames_fixed):
+            idx = random.randrange(len(fnames_fixed))
+            fixed_indices.append(idx)
+            records_to_take -= fixed_counts[idx]
+        fnames_fixed = [fnames_fixed[idx] for idx in fixed_indices]
+    else:
+        self_exp_n = len(fnames_curr) + len(fnames_prev_list)
+        n_fixed = min(int(self_exp_n / 2), len(fnames_fixed))
+        fnames_fixed = random.choices(fnames_fixed, k=n_fixed)
+    return fnames_fixed + fnames_prev_list + fnames_curr
+
+
+def load_last_weights(data):
+    # the latest weights saved by a trainer, or data if there are none
+    files = glob.glob("./data/weights/*.pickle")
+    if len(files) > 0:
+        raw_names = [int(pathlib.Path(file_name).stem) for file_name in files]
+        np_names = np.array(raw_names)
+        last_file_arg_number = np.argmax(np_names)
+        last_file = files[last_file_arg_number]
+        with open(last_file, 'rb') as datafile:
+            data = pickle.load(datafile)
+            raw_name = raw_names[last_file_arg_number]
+            print(f"Training and collecting from {raw_name}.pickle weights.")
+    return data
+
+
+def get_start_cycle(config):
+    """
+    Returns a cycle to continue from: an interrupted cycle with a checkpoint,
+    a cycle after the latest cycle weights, or 0.
+    """
+    checkpoint_steps = 0 if config["replay_stream"] else config["checkpoint_steps"]
+    saved_cycle = tools.TrainingCheckpoint(AC_MC_CHECKPOINT_PATH, checkpoint_steps).get_saved_cycle()
+    if saved_cycle is not None:
+        return saved_cycle
+    files = glob.glob("./data/weights/*.pickle")
+    if files:
+        return max(int(pathlib.Path(file_name).stem) for file_name in files) + 1
+    return 0
+
+
+def clear_storage(data_path):
+    files_to_delete = glob.glob(data_path + "*")
+    for f in files_to_delete:
+        if os.path.isdir(f):
+            shutil.rmtree(f)
+        else:
+            os.remove(f)
+
+
+class Orchestrator:
+    def __init__(self, config, data, collectors_n=2, amount_of_pieces=10):
+        """
+        Runs continuous ac mc cycles in one Ray session.
+
+        A trainer, an evaluator and collector actors are created once;
+        on every cycle the trainer gets new files and publishes new weights to a weights store,
+        collectors and the evaluator take them from the store, there are no restarts between cycles.
+
+        Args:
+            config: A configuration dictionary
+            data: initial neural net weights
+            collectors_n: an amount of collector actors
+            amount_of_pieces: an amount of storage directories in rotation
+        """
+        self._config = config
+        self._data = load_last_weights(data)
+        self._collectors_n = collectors_n
+        self._amount_of_pieces = amount_of_pieces
+
+    def run(self, cycles):
+        config = self._config
+        ray.init(num_gpus=1, include_dashboard=False)
+
+        # with a replay stream collected records go to the learner through memory, disk storage is optional
+        if config["replay_stream"]:
+            replay_buffer = replay.ReplayBuffer.remote(config["replay_capacity"])
+        else:
+            replay_buffer = None
+        persist_collected = replay_buffer is None or config["persist_collected"]
+
+        workers_info = tools.GlobalVarActor.remote()
+        weights_store = tools.WeightsStore.remote()
+        if self._data is not None:
+            # initial weights are already on disk
+            ray.get(weights_store.publish.remote([ray.put(self._data)], "initial", save=False))
+        trainer = ray.remote(num_gpus=1)(Trainer).remote(config, self._data, replay_buffer, weights_store)
+        eval_agent = ray.remote(evaluator.Agent).remote(config, self._data, workers_info, weights_store)
+        workers = [ray.remote(collector.Worker).remote(config, self._data, j, weights_store)
+                   for j in range(self._collectors_n)]
+        # the evaluator runs through all cycles, it stops when the done flag is set
+        eval_future = eval_agent.evaluate.remote()
+
+        previous_pieces = collections.deque([i + 2 for i in range(self._amount_of_pieces - 2)])
+        start_cycle = get_start_cycle(config)
+        for i in range(start_cycle):
+            # storage pieces of a restarted run are where cycles before it left them
+            previous_pieces.rotate(-1)
+            previous_pieces[-1] = i % self._amount_of_pieces
+        if start_cycle:
+            print(f"Continue from cycle {start_cycle}.")
+        for i in range(start_cycle, cycles):
+            print(f"PG learning, cycle {i}.")
+            current_n = i % self._amount_of_pieces  # current and prev to use
+            next_n = (i + 1) % self._amount_of_pieces  # next to collect
+            data_path = f"data/tfrecords/rl/storage_{next_n}/"  # path to save in
+            clear_storage(data_path)
+            filenames = get_cycle_filenames(current_n, previous_pieces)
+
+            # collectors take weights of the previous cycle from the weights store
+            trainer_future = trainer.train.remote(filenames, i)
+            col_futures = [worker.collect.remote(10, data_path if persist_collected else None, replay_buffer, i)
+                           for worker in workers]
+            _ = ray.get(col_futures)
+            _ = ray.get(trainer_future)
+
+            previous_pieces.rotate(-1)
+            previous_pieces[-1] = current_n
+
+        ray.get(workers_info.set_done.remote(True))
+        _ = ray.get(eval_future)
+        ray.get(weights_store.flush.remote())
+        ray.shutdown()
+
+    def run_async(self, steps):
+        """
+        IMPALA like training: collectors play all the time with weights from the weights store,
+        the learner trains all the time from the replay buffer and publishes weights every few steps.
+        Behaviour policy probabilities of slightly stale weights are corrected by clipped importance ratios
+        in the training step.
+        """
+        config = self._config
+        ray.init(num_gpus=1, include_dashboard=False)
+
+        replay_buffer = replay.ReplayBuffer.remote(config["replay_capacity"])
+        if config["persist_collected"]:
+            data_path = "data/tfrecords/rl/storage_async/"
+            os.makedirs(data_path, exist_ok=True)
+        else:
+            data_path = None
+
+        workers_info = tools.GlobalVarActor.remote()
+        # snapshots are named by learner steps, they are kept apart from cycle numbered weights
+        weights_store = tools.WeightsStore.remote(ASYNC_WEIGHTS_PATH)
+        if self._data is not None:
+            ray.get(weights_store.publish.remote([ray.put(self._data)], "initial", save=False))
+        trainer = ray.remote(num_gpus=1)(Trainer).remote(config, self._data, replay_buffer, weights_store,
+                                                         workers_info)
+        eval_agent = ray.remote(evaluator.Agent).remote(config, self._data, workers_info, weights_store)
+        workers = [ray.remote(collector.Worker).remote(config, self._data, j, weights_store)
+                   for j in range(self._collectors_n)]
+
+        # everything runs until the trainer sets the done flag
+        eval_future = eval_agent.evaluate.remote()
+        col_futures = [worker.collect_until_done.remote(data_path, replay_buffer, workers_info,
+                                                        config["async_storage_pieces"],
+                                                        config["async_piece_episodes"])
+                       for worker in workers]
+        trainer_future = trainer.train_async.remote(steps, config["weights_refresh_steps"],
+                                                    config["weights_snapshot_steps"])
+        _ = ray.get(trainer_future)
+        _ = ray.get(col_futures)
+        _ = ray.get(eval_future)
+        ray.get(weights_store.flush.remote())
+        ray.shutdown()
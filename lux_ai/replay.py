@@ -0,0 +1,57 @@
+import numpy as np
+import ray
+
+
+@ray.remote
+class ReplayBuffer:
+    def __init__(self, capacity, seed=None):
+        """
+        An in memory buffer of pg records, collectors add them and learners sample from it.
+
+        Records are kept in chunks of columns with packed observations as they arrive from collectors,
+        the oldest chunks are dropped when there are more than capacity records.
+
+        Args:
+            capacity: a maximum amount of records
+            seed: a seed for sampling
+        """
+        self._capacity = capacity
+        self._chunks = []
+        self._size = 0
+        self._added_n = 0
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, columns, layout):
+        chunk_size = len(next(iter(columns.values())))
+        self._chunks.append((columns, layout, chunk_size))
+        self._size += chunk_size
+        self._added_n += chunk_size
+        while self._size > self._capacity and len(self._chunks) > 1:
+            _, _, dropped_size = self._chunks.pop(0)
+            self._size -= dropped_size
+
+    def size(self):
+        return self._size
+
+    def added_n(self):
+        return self._added_n
+
+    def sample(self, n):
+        """
+        Samples n records uniformly, with replacement.
+
+        Returns:
+            a list of (columns, layout) pieces, one per chunk with sampled records
+        """
+        if self._size == 0:
+            return []
+        sizes = np.array([chunk_size for _, _, chunk_size in self._chunks])
+        ends = np.cumsum(sizes)
+        indices = np.sort(self._rng.integers(0, self._size, size=n))
+        chunk_indices = np.searchsorted(ends, indices, side="right")
+        pieces = []
+        for chunk_idx in np.unique(chunk_indices):
+            columns, layout, _ = self._chunks[chunk_idx]
+            rows = indices[chunk_indices == chunk_idx] - (ends[chunk_idx] - sizes[chunk_idx])
+            pieces.append(({name: values[rows] for name, values in columns.items()}, layout))
+        return pieces
@@ -0,0 +1,100 @@
+import os
+import gzip
+import json
+import zlib
+import pickle
+import pathlib
+
+# parsed kaggle replays are kept here, one file per json replay
+CACHE_PATH = "data/cache/jsons/"
+CACHE_SUFFIX = ".pickle.gz"
+
+
+def get_updates_digest(updates):
+    # observation updates are checked against a re-simulated episode, a checksum is enough for it
+    return zlib.crc32("\n".join(updates).encode())
+
+
+def prune_replay(data):
+    """
+    Keeps the parts of a kaggle replay which are used by the scraper.
+
+    Returns:
+        header: version, team names, rewards, a seed and a length of an episode
+        steps: (player 1 actions, player 2 actions, observation updates digest) for every step
+    """
+    header = {
+        "version": data["version"],
+        "info": {"TeamNames": data["info"]["TeamNames"]},
+        "rewards": data["rewards"],
+        "configuration": {"seed": data["configuration"]["seed"]},
+        "episode_length": len(data["steps"]),
+    }
+    steps = [(step[0]["action"], step[1]["action"], get_updates_digest(step[0]["observation"]["updates"]))
+             for step in data["steps"]]
+    return header, steps
+
+
+def get_cache_filename(file_name, cache_path=CACHE_PATH):
+    return os.path.join(cache_path, pathlib.Path(file_name).stem + CACHE_SUFFIX)
+
+
+def write_cache(header, steps, cache_filename):
+    # a header goes first, so it can be read without steps
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    tmp_filename = cache_filename + ".tmp"
+    with gzip.open(tmp_filename, "wb", compresslevel=3) as cache_file:
+        pickle.dump(header, cache_file, protocol=4)
+        pickle.dump(steps, cache_file, protocol=4)
+    # parallel scrapers can parse the same file, a reader never sees a partial one
+    os.replace(tmp_filename, cache_filename)
+
+
+def read_cache(file_name, cache_filename, with_steps):
+    if not os.path.exists(cache_filename):
+        return None
+    stat = os.stat(file_name)
+    with gzip.open(cache_filename, "rb") as cache_file:
+        header = pickle.load(cache_file)
+        if header["source_size"] != stat.st_size or header["source_mtime"] != stat.st_mtime_ns:
+            return None
+        steps = pickle.load(cache_file) if with_steps else None
+    return header, steps
+
+
+def parse_replay(file_name, cache_filename):
+    with open(file_name, "r") as read_file:
+        data = json.load(read_file)
+    header, steps = prune_replay(data)
+    stat = os.stat(file_name)
+    header["source_size"] = stat.st_size
+    header["source_mtime"] = stat.st_mtime_ns
+    write_cache(header, steps, cache_filename)
+    return header, steps
+
+
+def load_header(file_name, cache_path=CACHE_PATH):
+    """
+    Returns a replay header, a json replay is parsed only if it is not cached yet.
+    """
+    cache_filename = get_cache_filename(file_name, cache_path)
+    cached = read_cache(file_name, cache_filename, with_steps=False)
+    if cached is None:
+        cached = parse_replay(file_name, cache_filename)
+    header, _ = cached
+    return header
+
+
+def load_replay(file_name, cache_path=CACHE_PATH):
+    """
+    Returns a pruned replay, a header with steps, for the scrape function.
+
+    The first load parses a json replay and writes its parsed actions to the cache,
+    next loads read the cache while the json file is not modified.
+    """
+    cache_filename = get_cache_filename(file_name, cache_path)
+    cached = read_cache(file_name, cache_filename, with_steps=True)
+    if cached is None:
+        cached = parse_replay(file_name, cache_filename)
+    header, steps = cached
+    return {**header, "steps": steps}
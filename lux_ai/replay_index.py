@@ -0,0 +1,85 @@
+import os
+import time
+import sqlite3
+import pathlib
+
+from lux_ai import replay_cache
+
+# headers of downloaded kaggle replays to filter them without loading
+INDEX_PATH = "data/cache/replays.sqlite"
+
+
+class ReplayIndex:
+    def __init__(self, index_path=INDEX_PATH):
+        """
+        A SQLite index of replay headers.
+
+        A row keeps a replay id, a version, team names, rewards, a seed and an episode length,
+        rows are updated only for new or modified json files.
+
+        Args:
+            index_path: a path to a database file
+        """
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self._connection = sqlite3.connect(index_path)
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS replays (
+                   file_name TEXT PRIMARY KEY,
+                   replay_id TEXT,
+                   size INTEGER,
+                   mtime INTEGER,
+                   version TEXT,
+                   team_0 TEXT,
+                   team_1 TEXT,
+                   reward_0 REAL,
+                   reward_1 REAL,
+                   seed INTEGER,
+                   episode_length INTEGER
+               )"""
+        )
+        self._connection.commit()
+
+    def update(self, file_names):
+        """
+        Adds headers of new and modified files, removes rows of files which are not in file_names.
+        """
+        t1 = time.time()
+        known = {row[0]: (row[1], row[2])
+                 for row in self._connection.execute("SELECT file_name, size, mtime FROM replays")}
+        rows = []
+        for file_name in file_names:
+            stat = os.stat(file_name)
+            if known.get(file_name) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            header = replay_cache.load_header(file_name)
+            team_0, team_1 = header["info"]["TeamNames"]
+            reward_0, reward_1 = header["rewards"]
+            rows.append((file_name, pathlib.Path(file_name).stem, stat.st_size, stat.st_mtime_ns,
+                         header["version"], team_0, team_1, reward_0, reward_1,
+                         header["configuration"]["seed"], header["episode_length"]))
+        self._connection.executemany("INSERT OR REPLACE INTO replays VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        missing = set(known.keys()) - set(file_names)
+        self._connection.executemany("DELETE FROM replays WHERE file_name = ?", [(name,) for name in missing])
+        self._connection.commit()
+        t2 = time.time()
+        print(f"Replay index: {len(rows)} headers added, {len(missing)} removed in {t2 - t1:.2f}s.")
+
+    def select(self, lux_version, team_name=None, top_teams=None):
+        """
+        Returns file names of replays for the lux version,
+        with the team if team_name is given, with only top teams if top_teams are given.
+        """
+        query = "SELECT file_name, team_0, team_1 FROM replays WHERE version = ?"
+        parameters = [lux_version]
+        if team_name:
+            query += " AND (team_0 = ? OR team_1 = ?)"
+            parameters += [team_name, team_name]
+        query += " ORDER BY file_name"
+        rows = self._connection.execute(query, parameters).fetchall()
+        if top_teams is not None:
+            rows = [row for row in rows if {row[1], row[2]}.issubset(top_teams)]
+        return [row[0] for row in rows]
+
+    def close(self):
+        self._connection.close()
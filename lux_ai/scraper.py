@@ -1,6 +1,7 @@
+import os
 import abc
 import glob
-import json
+import time
 import random
 import pathlib
 
@@ -8,12 +9,9 @@ import tensorflow as tf
 import gym
 # import reverb
 
-from lux_ai import tools, tfrecords_storage
+from lux_ai import tools, tfrecords_storage, replay_cache, replay_index, action_decoder, shard_manifest
 # from lux_ai.dm_reverb_storage import send_data
-from lux_gym.envs.lux.action_vectors_new import worker_action_vector, cart_action_vector
-from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors, empty_cart_action_vectors
-from lux_gym.envs.lux.action_vectors_new import dir_action_vector, res_action_vector
-from lux_gym.envs.lux.action_vectors_new import action_vector_ct
+from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
 import lux_gym.envs.tools as env_tools
 
 physical_devices = tf.config.list_physical_devices('GPU')
@@ -22,12 +20,21 @@ if len(physical_devices) > 0:
 
 
 REWARD_CAP = 2000000
+TOP_TEAMS = {'Toad Brigade', 'RL is all you need', 'ironbar', 'Team Durrett', 'A.Saito'}
+# record formats: (is_for_rl, is_pg_rl)
+TARGET_FLAGS = {
+    "imitator": (False, False),  # data_gen_all
+    "rl": (True, False),  # data_gen_all_for_rl
+    "pg": (True, True),  # data_gen_soft_for_pg_no_transfers
+}
 
 
 def scrape(env_name, data, team_name=None, only_wins=False):
     """
     Collects trajectories from an episode to the buffer.
 
+    data is a pruned replay from replay_cache.load_replay.
+
     A buffer contains items, each item consists of several n_points;
     One n_point contains (action, action_probs, action_mask, observation,
                           total reward, temporal_mask, progress);
@@ -72,222 +79,47 @@ def scrape(env_name, data, team_name=None, only_wins=False):
         else:
             team_of_interest = -1
 
-    player1_data = {}
-    player2_data = {}
+    player1_data = tools.TrajectoryBuffer()
+    player2_data = tools.TrajectoryBuffer()
 
     environment = gym.make(env_name, seed=data["configuration"]["seed"])
     observations, proc_obsns = environment.reset_process()
     configuration = environment.configuration
     current_game_states = environment.game_states
-    width, height = current_game_states[0].map.width, current_game_states[0].map.height
-    shift = int((32 - width) / 2)  # to make all feature maps 32x32
-
-    def check_actions(actions, player_units_dict, player_cts_list):
-        new_actions = []
-        for action in actions:
-            action_list = action.split(" ")
-            if action_list[0] not in ["r", "bw", "bc"]:
-                if action_list[1] in player_units_dict.keys():
-                    new_actions.append(action)
-            else:
-                x, y = action_list[1], action_list[2]
-                if [int(x), int(y)] in player_cts_list:
-                    new_actions.append(action)
-        return new_actions
-
-    def update_units_actions(actions, player_units_dict):
-        units_with_actions = []
-        for action in actions:
-            action_list = action.split(" ")
-            if action_list[0] not in ["r", "bw", "bc"]:
-                units_with_actions.append(action_list[1])
-        for key in player_units_dict.keys():
-            if key not in units_with_actions:
-                actions.append(f"m {key} c")
-        return actions
-
-    def update_cts_actions(actions, player_cts_list):
-        units_with_actions = []
-        for action in actions:
-            action_list = action.split(" ")
-            if action_list[0] in ["r", "bw", "bc"]:
-                x, y = int(action_list[1]), int(action_list[2])
-                units_with_actions.append([x, y])
-        for ct in player_cts_list:
-            if ct not in units_with_actions:
-                actions.append(f"idle {ct[0]} {ct[1]}")
-        return actions
-
-    def get_actions_dict(player_actions, player_units_dict_active, player_units_dict_all):
-        actions_dict = {"workers": {}, "carts": {}, "city_tiles": {}}
-        for action in player_actions:
-            action_list = action.split(" ")
-            # units
-            action_type = action_list[0]
-            if action_type == "m":  # "m {id} {direction}"
-                unit_name = action_list[1]  # "{id}"
-                direction = action_list[2]
-                if direction == "c":
-                    action_type = "idle"
-                try:
-                    unit_type = "w" if player_units_dict_active[unit_name].is_worker() else "c"
-                except KeyError:  # it occurs when there is not valid action proposed
-                    continue
-                if unit_type == "w":
-                    action_vectors = empty_worker_action_vectors.copy()
-                    action_vectors[0] = worker_action_vector[action_type]
-                    if action_type != "idle":
-                        action_vectors[1] = dir_action_vector[direction]
-                    actions_dict["workers"][unit_name] = action_vectors
-                else:
-                    action_vectors = empty_cart_action_vectors.copy()
-                    action_vectors[0] = cart_action_vector[action_type]
-                    if action_type != "idle":
-                        action_vectors[1] = dir_action_vector[direction]
-                    actions_dict["carts"][unit_name] = action_vectors
-            elif action_type == "t":  # "t {id} {dest_id} {resourceType} {amount}"
-                unit_name = action_list[1]
-                dest_name = action_list[2]
-                resource_type = action_list[3]
-                try:
-                    unit_type = "w" if player_units_dict_active[unit_name].is_worker() else "c"
-                except KeyError:  # these is no such active unit to take action
-                    continue
-                try:
-                    direction = player_units_dict_active[unit_name].pos.direction_to(player_units_dict_all[
-                                                                                         dest_name].pos)
-                except KeyError:  # there is no such destination unit
-                    action_type = "idle"
-                    direction = None
-                if unit_type == "w":
-                    action_vectors = empty_worker_action_vectors.copy()
-                    action_vectors[0] = worker_action_vector[action_type]
-                    if action_type == "t":
-                        action_vectors[1] = dir_action_vector[direction]
-                        action_vectors[2] = res_action_vector[resource_type]
-                    actions_dict["workers"][unit_name] = action_vectors
-                else:
-                    action_vectors = empty_cart_action_vectors.copy()
-                    action_vectors[0] = cart_action_vector[action_type]
-                    if action_type == "t":
-                        action_vectors[1] = dir_action_vector[direction]
-                        action_vectors[2] = res_action_vector[resource_type]
-                    actions_dict["carts"][unit_name] = action_vectors
-            elif action_type == "bcity":  # "bcity {id}"
-                unit_name = action_list[1]
-                action_vectors = empty_worker_action_vectors.copy()
-                action_vectors[0] = worker_action_vector[action_type]
-                actions_dict["workers"][unit_name] = action_vectors
-            elif action_type == "p":  # "p {id}"
-                action_type = "idle"  # REPLACEMENT
-                unit_name = action_list[1]
-                action_vectors = empty_worker_action_vectors.copy()
-                action_vectors[0] = worker_action_vector[action_type]
-                actions_dict["workers"][unit_name] = action_vectors
-            # city tiles
-            elif action_type == "r":  # "r {pos.x} {pos.y}"
-                x, y = int(action_list[1]), int(action_list[2])
-                unit_name = f"ct_{y + shift}_{x + shift}"
-                action_vector_name = "ct_research"
-                actions_dict["city_tiles"][unit_name] = action_vector_ct[action_vector_name]
-            elif action_type == "bw":  # "bw {pos.x} {pos.y}"
-                x, y = int(action_list[1]), int(action_list[2])
-                unit_name = f"ct_{y + shift}_{x + shift}"
-                action_vector_name = "ct_build_worker"
-                actions_dict["city_tiles"][unit_name] = action_vector_ct[action_vector_name]
-            elif action_type == "bc":  # "bc {pos.x} {pos.y}"
-                x, y = int(action_list[1]), int(action_list[2])
-                unit_name = f"ct_{y + shift}_{x + shift}"
-                action_vector_name = "ct_build_cart"
-                actions_dict["city_tiles"][unit_name] = action_vector_ct[action_vector_name]
-            elif action_type == "idle":  # "idle {pos.x} {pos.y}"
-                x, y = int(action_list[1]), int(action_list[2])
-                unit_name = f"ct_{y + shift}_{x + shift}"
-                action_vector_name = "ct_idle"
-                actions_dict["city_tiles"][unit_name] = action_vector_ct[action_vector_name]
-            else:
-                raise ValueError
-        return actions_dict
+    # action strings of the whole episode are decoded once, actions for an obs are in the next step of data
+    player1_actions = action_decoder.EpisodeActions(data["steps"][1:], 0)
+    player2_actions = action_decoder.EpisodeActions(data["steps"][1:], 1)
+    actions_shape = [item.shape for item in empty_worker_action_vectors]
+
+    def add_player_points(player_data, player_actions, player, proc_obs, current_step):
+        # get units to know their types etc.
+        player_units_dict_active = {}
+        player_units_dict_all = {}
+        for unit in player.units:
+            player_units_dict_all[unit.id] = unit
+            if unit.can_act():
+                player_units_dict_active[unit.id] = unit
+        # process only workers data, if no action and unit can act, it is idle
+        workers_actions = player_actions.get_worker_actions(current_step, player_units_dict_active,
+                                                            player_units_dict_all)
+        for unit_id, action_numbers in workers_actions.items():
+            # probs are similar to actions
+            player_data.add_numbers(unit_id, action_numbers, proc_obs["workers"][unit_id], current_step,
+                                    actions_shape)
+        return player_data
 
     step = 0
     for step in range(0, configuration.episodeSteps):
-        assert observations[0]["updates"] == observations[1]["updates"] == data["steps"][step][0]["observation"][
-            "updates"]
+        assert observations[0]["updates"] == observations[1]["updates"]
+        assert replay_cache.get_updates_digest(observations[0]["updates"]) == data["steps"][step][2]
         # get actions from a record, action for the current obs is in the next step of data
-        actions_1 = data["steps"][step + 1][0]["action"]
-        actions_2 = data["steps"][step + 1][1]["action"]
+        actions_1, actions_2, _ = data["steps"][step + 1]
         if team_of_interest == 1 or team_of_interest == -1:
-            # get units to know their types etc.
             player1 = current_game_states[0].players[observations[0].player]
-            player1_units_dict_active = {}
-            player1_units_dict_all = {}
-            for unit in player1.units:
-                player1_units_dict_all[unit.id] = unit
-                if unit.can_act():
-                    player1_units_dict_active[unit.id] = unit
-            # get citytiles
-            player1_ct_list_active = []
-            for city in player1.cities.values():
-                for citytile in city.citytiles:
-                    if citytile.cooldown < 1:
-                        x_coord, y_coord = citytile.pos.x, citytile.pos.y
-                        player1_ct_list_active.append([x_coord, y_coord])
-            # copy actions since we need preprocess them before recording
-            if actions_1 is None:
-                actions_1_vec = []
-            else:
-                actions_1_vec = actions_1.copy()
-            # check actions and erase invalid ones
-            actions_1_vec = check_actions(actions_1_vec, player1_units_dict_active, player1_ct_list_active)
-            # if no action and unit can act, add "m {id} c"
-            actions_1_vec = update_units_actions(actions_1_vec, player1_units_dict_active)
-            # in no action and ct can act, add "idle {x} {y}"
-            # actions_1_vec = update_cts_actions(actions_1_vec, player1_ct_list_active)
-            # get actions vector representation
-            actions_1_dict = get_actions_dict(actions_1_vec, player1_units_dict_active, player1_units_dict_all)
-            # process only workers data
-            actions_1_dict.pop("carts")
-            actions_1_dict.pop("city_tiles")
-            proc_obsns[0].pop("carts")
-            proc_obsns[0].pop("city_tiles")
-            # probs are similar to actions
-            player1_data = tools.add_point(player1_data, actions_1_dict, actions_1_dict, proc_obsns[0], step)
+            player1_data = add_player_points(player1_data, player1_actions, player1, proc_obsns[0], step)
         if team_of_interest == 2 or team_of_interest == -1:
-            # get units to know their types etc.
             player2 = current_game_states[1].players[(observations[0].player + 1) % 2]
-            player2_units_dict_active = {}
-            player2_units_dict_all = {}
-            for unit in player2.units:
-                player2_units_dict_all[unit.id] = unit
-                if unit.can_act():
-                    player2_units_dict_active[unit.id] = unit
-            # get citytiles
-            player2_ct_list_active = []
-            for city in player2.cities.values():
-                for citytile in city.citytiles:
-                    if citytile.cooldown < 1:
-                        x_coord, y_coord = citytile.pos.x, citytile.pos.y
-                        player2_ct_list_active.append([x_coord, y_coord])
-            # copy actions since we need preprocess them before recording
-            if actions_2 is None:
-                actions_2_vec = []
-            else:
-                actions_2_vec = actions_2.copy()
-            # check actions and erase invalid ones
-            actions_2_vec = check_actions(actions_2_vec, player2_units_dict_active, player2_ct_list_active)
-            # if no action and unit can act, add "m {id} c"
-            actions_2_vec = update_units_actions(actions_2_vec, player2_units_dict_active)
-            # in no action and ct can act, add "idle {x} {y}"
-            # actions_2_vec = update_cts_actions(actions_2_vec, player2_ct_list_active)
-            # get actions vector representation
-            actions_2_dict = get_actions_dict(actions_2_vec, player2_units_dict_active, player2_units_dict_all)
-            # process only workers data
-            actions_2_dict.pop("carts")
-            actions_2_dict.pop("city_tiles")
-            proc_obsns[1].pop("carts")
-            proc_obsns[1].pop("city_tiles")
-            # probs are similar to actions
-            player2_data = tools.add_point(player2_data, actions_2_dict, actions_2_dict, proc_obsns[1], step)
+            player2_data = add_player_points(player2_data, player2_actions, player2, proc_obsns[1], step)
 
         # dones, observations, proc_obsns = environment.step_process((actions_1, actions_2))
         dones, (obs1, obs2) = environment.step((actions_1, actions_2))
@@ -328,19 +160,19 @@ def scrape(env_name, data, team_name=None, only_wins=False):
 
 
 def scrape_file(env_name, file_name, team_name, lux_version, only_wins,
-                feature_maps_shape, acts_shape, record_number, is_for_rl, is_pg_rl):
-    with open(file_name, "r") as read_file:
-        raw_name = pathlib.Path(file_name).stem
-        data = json.load(read_file)
-        if data["version"] != lux_version:
-            print(f"File {file_name}; is for an inappropriate lux version.")
-            return
+                feature_maps_shape, acts_shape, record_number, is_for_rl, is_pg_rl, storage_format="tfrecord",
+                targets=None, shard_size=None, compression=None):
+    raw_name = pathlib.Path(file_name).stem
+    if replay_cache.load_header(file_name)["version"] != lux_version:
+        print(f"File {file_name}; is for an inappropriate lux version.")
+        return False
+    data = replay_cache.load_replay(file_name)
 
     output = scrape(env_name, data, team_name, only_wins)
     (player1_data, player2_data), (final_reward_1, final_reward_2), progress = output
     if player1_data == player2_data is None:
         print(f"File {file_name}; does not have a required team.")
-        return
+        return False
     else:
         print(f"File {file_name}; {record_number}; recording.")
 
@@ -358,11 +190,127 @@ def scrape_file(env_name, file_name, team_name, lux_version, only_wins,
         else:
             team_name = 'Draw'
 
-    tfrecords_storage.record(player1_data, player2_data, final_reward_1, final_reward_2,
-                             feature_maps_shape, acts_shape, record_number,
-                             raw_name + "_" + team_name, progress,
-                             is_for_rl,
-                             is_pg_rl=is_pg_rl)
+    if targets is None:
+        targets = [(is_for_rl, is_pg_rl, None)]
+    # one simulated episode is written in all target formats
+    for target_is_for_rl, target_is_pg_rl, save_path in targets:
+        tfrecords_storage.record(player1_data, player2_data, (final_reward_1, final_reward_2),
+                                 feature_maps_shape, acts_shape, record_number,
+                                 raw_name + "_" + team_name, progress,
+                                 target_is_for_rl, save_path=save_path,
+                                 is_pg_rl=target_is_pg_rl, storage_format=storage_format,
+                                 shard_size=shard_size, compression=compression,
+                                 metadata={"episode": raw_name, "team": team_name})
+    return True
+
+
+def get_targets(config):
+    """
+    Returns (is_for_rl, is_pg_rl, save_path) of every record format to scrape to.
+
+    Without scrape_targets in config there is one target defined by is_for_rl and is_pg_rl.
+    Every target needs its own path, shards of two targets in one path would have the same names.
+    """
+    if not config["scrape_targets"]:
+        if config["is_for_rl"]:
+            data_path = "./data/tfrecords/rl/storage/"
+        else:
+            data_path = "./data/tfrecords/imitator/train/"
+        return [(config["is_for_rl"], config["is_pg_rl"], data_path)]
+
+    targets = []
+    paths = set()
+    for target_name, data_path in config["scrape_targets"].items():
+        if target_name not in TARGET_FLAGS:
+            raise NotImplementedError
+        if os.path.abspath(data_path) in paths:
+            raise ValueError(f"Scrape targets share the path {data_path}.")
+        paths.add(os.path.abspath(data_path))
+        os.makedirs(data_path, exist_ok=True)
+        targets.append(TARGET_FLAGS[target_name] + (data_path,))
+    return targets
+
+
+def get_saved_submissions(data_path):
+    # replay ids of recorded files from the manifest, a file name starts with an id for files without entries
+    file_names = tfrecords_storage.glob_records(data_path)
+    saved_submissions = set()
+    for file_name, entry in zip(file_names, shard_manifest.get_entries(file_names)):
+        if entry is not None and entry["episode"] is not None:
+            saved_submissions.add(str(entry["episode"]))
+        else:
+            raw_name = pathlib.Path(file_name).stem
+            saved_submissions.add(raw_name.split("_")[0])
+    return saved_submissions
+
+
+def get_saved_targets_submissions(targets):
+    # a submission is saved when it is recorded for all targets
+    submissions = [get_saved_submissions(data_path) for _, _, data_path in targets]
+    return set.intersection(*submissions)
+
+
+class ScrapeWorker:
+    def __init__(self, config):
+        """
+        A scraper actor, tensorflow and gym are imported once and the actor takes replays one by one.
+
+        Args:
+            config: A configuration dictionary
+        """
+        self._env_name = config["environment"]
+        self._feature_maps_shape = tools.get_feature_maps_shape(config["environment"])
+        self._actions_shape = [item.shape for item in empty_worker_action_vectors]
+        self._lux_version = config["lux_version"]
+        self._team_name = config["team_name"]
+        self._only_wins = config["only_wins"]
+        self._is_for_rl = config["is_for_rl"]
+        self._is_pg_rl = config["is_pg_rl"]
+        self._storage_format = config["storage_format"]
+        self._shard_size = config["shard_size"]
+        self._compression = config["tfrecord_compression"]
+        self._targets = get_targets(config)
+
+    def scrape(self, file_name, record_number):
+        is_recorded = scrape_file(self._env_name, file_name, self._team_name, self._lux_version, self._only_wins,
+                                  self._feature_maps_shape, self._actions_shape, record_number,
+                                  self._is_for_rl, self._is_pg_rl, self._storage_format, self._targets,
+                                  self._shard_size, self._compression)
+        return file_name, is_recorded
+
+    def flush(self):
+        # shards of all scraped files are written
+        tfrecords_storage.flush_writes()
+
+
+def scrape_pool(config, file_names, parallel_calls):
+    """
+    Scrapes files with a pool of parallel_calls actors in a running ray session.
+
+    Actors take a next file as soon as they are free, so one slow replay does not hold the others.
+    Files of saved submissions are skipped, an interrupted run continues from the files left.
+    """
+    import ray
+    from ray.util import ActorPool
+
+    saved_submissions = get_saved_targets_submissions(get_targets(config))
+    file_names = [file_name for file_name in file_names
+                  if pathlib.Path(file_name).stem not in saved_submissions]
+    print(f"{len(saved_submissions)} submissions are already saved, {len(file_names)} files to scrape.")
+
+    workers = [ray.remote(ScrapeWorker).remote(config) for _ in range(parallel_calls)]
+    pool = ActorPool(workers)
+    t1 = time.time()
+    recorded_n = 0
+    results = pool.map_unordered(lambda worker, item: worker.scrape.remote(*item),
+                                 [(file_name, i) for i, file_name in enumerate(file_names)])
+    for done_n, (file_name, is_recorded) in enumerate(results, 1):
+        recorded_n += int(bool(is_recorded))
+        elapsed = time.time() - t1
+        print(f"Scraped {done_n}/{len(file_names)}, recorded {recorded_n}; "
+              f"{elapsed / done_n:.1f}s per file; last {file_name}.")
+    ray.get([worker.flush.remote() for worker in workers])
+    return recorded_n
 
 
 class Agent(abc.ABC):
@@ -403,18 +351,14 @@ class Agent(abc.ABC):
         self._team_name = config["team_name"]
         self._only_wins = config["only_wins"]
         self._only_top_teams = config["only_top_teams"]
-        self._top_teams = {'Toad Brigade', 'RL is all you need', 'ironbar', 'Team Durrett', 'A.Saito'}
+        self._storage_format = config["storage_format"]
+        self._shard_size = config["shard_size"]
+        self._compression = config["tfrecord_compression"]
+        self._top_teams = TOP_TEAMS
 
         self._files = glob.glob("./data/jsons/*.json")
-        if self._is_for_rl:
-            self._data_path = "./data/tfrecords/rl/storage/"
-        else:
-            self._data_path = "./data/tfrecords/imitator/train/"
-        already_saved_files = glob.glob(self._data_path + "*.tfrec")
-        self._saved_submissions = set()
-        for file_name in already_saved_files:
-            raw_name = pathlib.Path(file_name).stem
-            self._saved_submissions.add(raw_name.split("_")[0])
+        self._targets = get_targets(config)
+        self._saved_submissions = get_saved_targets_submissions(self._targets)
 
     def _scrape(self, data, team_name=None, only_wins=False):
         output = scrape(self._env_name, data, team_name, only_wins)
@@ -439,30 +383,26 @@ class Agent(abc.ABC):
 
     def scrape_once(self):
         file_name = random.sample(self._files, 1)[0]
-        with open(file_name, "r") as read_file:
-            data = json.load(read_file)
+        data = replay_cache.load_replay(file_name)
         self._scrape(data)
 
     def scrape_all(self, files_to_save=3):
+        # version and team filters are applied to the index, only matching replays are loaded
+        index = replay_index.ReplayIndex()
+        index.update(self._files)
+        file_names = index.select(self._lux_version, self._team_name,
+                                  self._top_teams if self._only_top_teams else None)
+        index.close()
+
         j = 0
-        for i, file_name in enumerate(self._files):
-            with open(file_name, "r") as read_file:
-                raw_name = pathlib.Path(file_name).stem
-                # if f"{self._data_path}{raw_name}_{self._team_name}.tfrec" in self._already_saved_files:
-                if raw_name in self._saved_submissions:
-                    print(f"File {file_name} for {self._team_name}; {i}; is already saved.")
-                    # data = json.load(read_file)
-                    # print(f"Team 0: {data['info']['TeamNames'][0]}, Team 1: {data['info']['TeamNames'][1]}")
-                    continue
-                data = json.load(read_file)
-                if data["version"] != self._lux_version:
-                    print(f"File {file_name}; {i}; is for an inappropriate lux version.")
-                    continue
-
-            if self._only_top_teams:
-                team_names = set(data['info']['TeamNames'])
-                if not team_names.issubset(self._top_teams):
-                    continue
+        for i, file_name in enumerate(file_names):
+            raw_name = pathlib.Path(file_name).stem
+            # if f"{self._data_path}{raw_name}_{self._team_name}.tfrec" in self._already_saved_files:
+            if raw_name in self._saved_submissions:
+                print(f"File {file_name} for {self._team_name}; {i}; is already saved.")
+                continue
+
+            data = replay_cache.load_replay(file_name)
 
             (player1_data, player2_data), (final_reward_1, final_reward_2), progress = self._scrape(data,
                                                                                                     self._team_name,
@@ -489,12 +429,17 @@ class Agent(abc.ABC):
                 else:
                     team_name = 'Draw'
 
-            tfrecords_storage.record(player1_data, player2_data, final_reward_1, final_reward_2,
-                                     self._feature_maps_shape, self._actions_shape, i,
-                                     raw_name + "_" + team_name, progress,
-                                     self._is_for_rl,
-                                     is_pg_rl=self._is_pg_rl)
+            for is_for_rl, is_pg_rl, save_path in self._targets:
+                tfrecords_storage.record(player1_data, player2_data, (final_reward_1, final_reward_2),
+                                         self._feature_maps_shape, self._actions_shape, i,
+                                         raw_name + "_" + team_name, progress,
+                                         is_for_rl, save_path=save_path,
+                                         is_pg_rl=is_pg_rl, storage_format=self._storage_format,
+                                         shard_size=self._shard_size, compression=self._compression,
+                                         metadata={"episode": raw_name, "team": team_name})
             j += 1
             if j == files_to_save:
+                tfrecords_storage.flush_writes()
                 print(f"{files_to_save} files saved, exit.")
                 return
+        tfrecords_storage.flush_writes()
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import pathlib
+
+import numpy as np
+import tensorflow as tf
+
+from lux_ai import columnar_storage, tfrecords_storage
+
+physical_devices = tf.config.list_physical_devices('GPU')
+if len(physical_devices) > 0:
+    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+
+# decoded pg shards are kept here between training cycles as columnar shards
+CACHE_PATH = "data/cache/"
+# content hashes of source files, to skip hashing of files which are not changed
+INDEX_NAME = "index.json"
+
+
+def get_digest(filename):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_size(shard_path):
+    return sum(entry.stat().st_size for entry in os.scandir(shard_path))
+
+
+class ShardCache:
+    def __init__(self, feature_maps_shape, actions_shape, budget, cache_path=CACHE_PATH,
+                 teacher=None, teacher_digest=None):
+        """
+        A disk cache of decoded pg TFRecord files, which are read as columnar shards;
+        observations are packed, see columnar_storage.pack_observations.
+
+        Entries are keyed by the file name and a content hash of the file,
+        least recently used entries are removed when the cache is larger than the budget.
+        With a teacher its probs are stored in decoded shards and a digest of its weights is a part of keys,
+        so probs of other teacher weights are never read.
+
+        Args:
+            feature_maps_shape: a shape of one observation
+            actions_shape: shapes of action vectors
+            budget: a maximum size of the cache in bytes
+            cache_path: a directory to keep decoded shards in
+            teacher: a frozen supervised model
+            teacher_digest: a digest of the teacher weights file
+        """
+        self._feature_maps_shape = feature_maps_shape
+        self._actions_shape = actions_shape
+        self._budget = budget
+        self._cache_path = cache_path
+        self._teacher = teacher
+        self._teacher_digest = teacher_digest
+        os.makedirs(cache_path, exist_ok=True)
+
+        self._index_path = os.path.join(cache_path, INDEX_NAME)
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r") as index_file:
+                self._index = json.load(index_file)
+        else:
+            self._index = {}
+
+    def _get_key(self, filename):
+        # file name and content hash, the hash is recomputed only for modified files
+        stat = os.stat(filename)
+        entry = self._index.get(filename)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "digest": get_digest(filename)}
+            self._index[filename] = entry
+        key = f"{pathlib.Path(filename).stem}_{entry['digest']}"
+        if self._teacher is not None:
+            key += f"_{self._teacher_digest}"
+        return key
+
+    def _decode(self, filename, shard_path):
+        ds = tfrecords_storage.read_tfrecord_file(filename)
+        ds = ds.batch(3000)  # the size of written pg files
+        ds = ds.map(lambda x: tfrecords_storage.decode_rl_pg_examples(x, self._feature_maps_shape,
+                                                                      self._actions_shape))
+        batches = [[item.numpy() for item in batch] for batch in ds]
+        columns = {name: np.concatenate([batch[i] for batch in batches])
+                   for i, name in enumerate(columnar_storage.PG_COLUMNS)}
+        columnar_storage.write_shard(columns, shard_path, pack=True)
+
+    def _evict(self, in_use):
+        shards = [entry.path for entry in os.scandir(self._cache_path)
+                  if columnar_storage.is_columnar(entry.name)]
+        sizes = {shard: get_size(shard) for shard in shards}
+        total = sum(sizes.values())
+        for shard in sorted(shards, key=os.path.getmtime):
+            if total <= self._budget:
+                break
+            if shard in in_use:
+                continue
+            shutil.rmtree(shard)
+            total -= sizes[shard]
+        if total > self._budget:
+            print(f"Decoded shards in use take {total / 2 ** 30:.1f} GB, it is over the cache budget.")
+
+    def get_filenames(self, filenames):
+        """
+        Replaces pg TFRecord file names with cached columnar shards, decoding new files.
+
+        Columnar shards in filenames are returned as they are, teacher probs are added to cached shards only.
+        """
+        t1 = time.time()
+        cached_filenames = []
+        cache_filenames = []
+        decoded_n = 0
+        for filename in filenames:
+            if columnar_storage.is_columnar(filename):
+                cached_filenames.append(filename)
+                continue
+            shard_path = os.path.join(self._cache_path, self._get_key(filename) + columnar_storage.SHARD_SUFFIX)
+            if os.path.exists(shard_path):
+                os.utime(shard_path)
+            else:
+                self._decode(filename, shard_path)
+                decoded_n += 1
+            cached_filenames.append(shard_path)
+            cache_filenames.append(shard_path)
+        if self._teacher is not None:
+            columnar_storage.add_teacher_probs(cache_filenames, self._teacher)
+
+        self._index = {name: entry for name, entry in self._index.items() if os.path.exists(name)}
+        with open(self._index_path, "w") as index_file:
+            json.dump(self._index, index_file)
+        self._evict(set(cached_filenames))
+        t2 = time.time()
+        print(f"Shard cache: {decoded_n} of {len(cached_filenames)} files decoded in {t2 - t1:.2f}s.")
+        return cached_filenames
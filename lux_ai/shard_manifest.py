@@ -0,0 +1,82 @@
+import os
+import json
+import time
+import threading
+
+# one manifest per storage directory, a json line per written shard
+MANIFEST_NAME = "manifest.jsonl"
+
+_lock = threading.Lock()
+
+
+def get_manifest_filename(path):
+    return os.path.join(path, MANIFEST_NAME)
+
+
+def add_shard(filename, records_n, metadata=None):
+    """
+    Adds a shard to the manifest of its directory.
+
+    An entry keeps a shard name, an amount of records, a mean record reward
+    and metadata of a recorded episode: a source episode, a team and a creation cycle.
+    Lines are appended with one write, so parallel writers do not mix entries.
+    """
+    entry = {
+        "shard": os.path.basename(filename),
+        "records": records_n,
+        "created": time.time(),
+        "episode": None,
+        "team": None,
+        "reward": None,
+        "cycle": None,
+    }
+    if metadata is not None:
+        entry.update(metadata)
+    line = json.dumps(entry) + "\n"
+    with _lock:
+        with open(get_manifest_filename(os.path.dirname(filename)), "a") as manifest_file:
+            manifest_file.write(line)
+
+
+def read_manifest(path):
+    """
+    Returns manifest entries of existing shards in a directory, keyed by shard paths.
+
+    A shard written again replaces its previous entry.
+    """
+    manifest_filename = get_manifest_filename(path)
+    entries = {}
+    if not os.path.exists(manifest_filename):
+        return entries
+    with open(manifest_filename, "r") as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # a line of an interrupted writer
+                continue
+            entries[os.path.join(path, entry["shard"])] = entry
+    return {filename: entry for filename, entry in entries.items() if os.path.exists(filename)}
+
+
+def get_entries(filenames):
+    """
+    Returns manifest entries of shards from several directories, None for shards without entries.
+    """
+    manifests = {}
+    entries = []
+    for filename in filenames:
+        path = os.path.dirname(filename)
+        if path not in manifests:
+            manifests[path] = {os.path.normpath(name): entry for name, entry in read_manifest(path).items()}
+        entries.append(manifests[path].get(os.path.normpath(filename)))
+    return entries
+
+
+def get_record_counts(filenames):
+    """
+    Returns amounts of records in shards, or None if some shards are not in manifests.
+    """
+    entries = get_entries(filenames)
+    if any(entry is None for entry in entries):
+        return None
+    return [entry["records"] for entry in entries]
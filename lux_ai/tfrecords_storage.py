@@ -1,14 +1,57 @@
+import atexit
 import random
+import collections
+import concurrent.futures
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import backend
+import ray
+
+from lux_ai import columnar_storage, shard_manifest
 
 physical_devices = tf.config.list_physical_devices('GPU')
 if len(physical_devices) > 0:
     tf.config.experimental.set_memory_growth(physical_devices[0], True)
 
 AUTO = tf.data.experimental.AUTOTUNE
+# teacher probs are six actions probs: n, e, s, w, idle, bcity
+TEACHER_SHAPE = [6]
+
+
+TFRECORD_SUFFIX = ".tfrec"
+COMPRESSION_SUFFIXES = {"ZLIB": ".zlib.tfrec", "GZIP": ".gz.tfrec"}
+TMP_SUFFIX = ".tmp"
+# shards are serialized and written in background threads
+WRITER_THREADS = 4
+MAX_PENDING_WRITES = 2 * WRITER_THREADS
+_writer_pool = None
+_pending_writes = collections.deque()
+
+
+def glob_records(path):
+    # TFRecord files, compressed ones too, and columnar shards
+    return (tf.io.gfile.glob(path + "*" + TFRECORD_SUFFIX) +
+            tf.io.gfile.glob(path + "*" + columnar_storage.SHARD_SUFFIX))
+
+
+def get_tfrecord_suffix(compression):
+    if not compression:
+        return TFRECORD_SUFFIX
+    if compression not in COMPRESSION_SUFFIXES:
+        raise NotImplementedError
+    return COMPRESSION_SUFFIXES[compression]
+
+
+def get_compression_type(filename):
+    # a compression type from a file name, a python string or a string tensor
+    is_zlib = tf.strings.regex_full_match(filename, r".*\.zlib\.tfrec")
+    is_gzip = tf.strings.regex_full_match(filename, r".*\.gz\.tfrec")
+    return tf.where(is_zlib, "ZLIB", tf.where(is_gzip, "GZIP", ""))
+
+
+def read_tfrecord_file(filename):
+    return tf.data.TFRecordDataset(filename, compression_type=get_compression_type(filename))
 
 
 # Three data types can be stored in TFRecords: bytestrings, integers and floats
@@ -64,113 +107,170 @@ def to_tfrecord_for_rl_pg(action_numbers, action_probs, observation, reward, pro
     return tf.train.Example(features=tf.train.Features(feature=feature))
 
 
+def serialize_pg(action_numbers, action_probs, observation, reward, progress_value):
+    s_action_numbers = tf.io.serialize_tensor(action_numbers)
+    serial_action_probs = [tf.io.serialize_tensor(item).numpy() for item in action_probs]
+    serial_observation = tf.io.serialize_tensor(tf.io.serialize_sparse(observation))
+    example = to_tfrecord_for_rl_pg(
+        s_action_numbers.numpy(),
+        serial_action_probs,
+        serial_observation.numpy(),
+        reward.numpy().astype(np.float32),
+        progress_value.numpy().astype(np.float32),
+    )
+    return example.SerializeToString()
+
+
+def serialize_rl(actions_numbers, actions_probs, observations, rewards, masks, progress_array, final_idx):
+    s_actions_numbers = tf.io.serialize_tensor(actions_numbers)
+    serial_action_probs = [tf.io.serialize_tensor(item).numpy() for item in actions_probs]
+    s_observations = tf.io.serialize_tensor(tf.io.serialize_sparse(observations))
+    s_rewards = tf.io.serialize_tensor(rewards)
+    s_masks = tf.io.serialize_tensor(masks)
+    s_progress_array = tf.io.serialize_tensor(progress_array)
+    example = to_tfrecord_for_rl(
+        s_actions_numbers.numpy(),
+        serial_action_probs,
+        s_observations.numpy(),
+        s_rewards.numpy(),
+        s_masks.numpy(),
+        s_progress_array.numpy(),
+        final_idx.numpy().astype(np.int64),
+    )
+    return example.SerializeToString()
+
+
+def serialize_imitator(observation, action_probs, reward):
+    serial_action_probs = [tf.io.serialize_tensor(item).numpy() for item in action_probs]
+    serial_observation = tf.io.serialize_tensor(tf.io.serialize_sparse(observation))
+    example = to_tfrecord(reward.numpy().astype(np.float32),
+                          serial_action_probs,
+                          serial_observation.numpy())
+    return example.SerializeToString()
+
+
+def get_writer_pool():
+    global _writer_pool
+    if _writer_pool is None:
+        _writer_pool = concurrent.futures.ThreadPoolExecutor(WRITER_THREADS)
+    return _writer_pool
+
+
+def write_tfrecord_shard(elements, serialize, filename, compression, reward_index, metadata):
+    # a shard is written to a temporary file and renamed, readers never see partial shards
+    tmp_filename = filename + TMP_SUFFIX
+    options = tf.io.TFRecordOptions(compression_type=compression or "")
+    with tf.io.TFRecordWriter(tmp_filename, options) as out_file:
+        for element in elements:
+            out_file.write(serialize(*element))
+    tf.io.gfile.rename(tmp_filename, filename, overwrite=True)
+    # a trajectory has the same reward in all steps
+    reward = np.mean([np.ravel(element[reward_index].numpy())[0] for element in elements])
+    shard_manifest.add_shard(filename, len(elements), {**(metadata or {}), "reward": float(reward)})
+
+
+def flush_writes():
+    # waits for shards in the writer pool, call it before a process exits
+    while _pending_writes:
+        _pending_writes.popleft().result()
+
+
+atexit.register(flush_writes)
+
+
 def write_tfrecord(ds, record_number, record_name, is_for_rl, save_path=None, collector_n=None,
-                   is_pg_rl=False):
+                   is_pg_rl=False, shard_size=None, compression=None, metadata=None):
+    """
+    Writes records of a record() dataset to TFRecord shards.
+
+    Records are serialized and written by a thread pool while the dataset is generated,
+    the function returns before shards are written, see flush_writes.
+    Written shards are added to the manifest of save_path.
+
+    Args:
+        shard_size: records per file, 3000 per step records or 10 trajectories by default
+        compression: None, "ZLIB" or "GZIP", compressed files get a compression suffix
+        metadata: episode metadata for the manifest
+    """
     if is_pg_rl:
-        if save_path is None:
-            save_path = "data/tfrecords/rl/storage/"
-        out_file = None
-        for n, (action_numbers, action_probs, observation, reward, progress_value) in enumerate(ds):
-            if out_file is None or n % 3000 == 0:
-                if out_file is not None:
-                    out_file.close()
-                if collector_n is not None:
-                    filename = f"{save_path}{collector_n}_{record_name}_{n}.tfrec"
-                else:
-                    filename = f"{save_path}{record_name}_{n}.tfrec"
-                out_file = tf.io.TFRecordWriter(filename)
-            s_action_numbers = tf.io.serialize_tensor(action_numbers)
-            serial_action_probs = [tf.io.serialize_tensor(item).numpy() for item in action_probs]
-            serial_observation = tf.io.serialize_tensor(tf.io.serialize_sparse(observation))
-            example = to_tfrecord_for_rl_pg(
-                s_action_numbers.numpy(),
-                serial_action_probs,
-                serial_observation.numpy(),
-                reward.numpy().astype(np.float32),
-                progress_value.numpy().astype(np.float32),
-            )
-            out_file.write(example.SerializeToString())
-        out_file.close()
-        print(f"Wrote group #{record_number} {record_name} tfrec files containing {n} records")
+        default_path, default_size, serialize, reward_index = "data/tfrecords/rl/storage/", 3000, serialize_pg, 3
     elif is_for_rl:
-        if save_path is None:
-            save_path = "data/tfrecords/rl/storage/"
-        out_file = None
-        for n, (actions_numbers, actions_probs, observations, rewards,
-                masks, progress_array, final_idx) in enumerate(ds):
-            if out_file is None or n % 10 == 0:
-                if out_file is not None:
-                    out_file.close()
-                if collector_n is not None:
-                    filename = f"{save_path}{collector_n}_{record_name}_{n}.tfrec"
-                else:
-                    filename = f"{save_path}{record_name}_{n}.tfrec"
-                out_file = tf.io.TFRecordWriter(filename)
-            s_actions_numbers = tf.io.serialize_tensor(actions_numbers)
-            serial_action_probs = [tf.io.serialize_tensor(item).numpy() for item in actions_probs]
-            s_observations = tf.io.serialize_tensor(tf.io.serialize_sparse(observations))
-            s_rewards = tf.io.serialize_tensor(rewards)
-            s_masks = tf.io.serialize_tensor(masks)
-            s_progress_array = tf.io.serialize_tensor(progress_array)
-            example = to_tfrecord_for_rl(
-                s_actions_numbers.numpy(),
-                serial_action_probs,
-                s_observations.numpy(),
-                s_rewards.numpy(),
-                s_masks.numpy(),
-                s_progress_array.numpy(),
-                final_idx.numpy().astype(np.int64),
-            )
-            out_file.write(example.SerializeToString())
-        out_file.close()
-        print(f"Wrote group #{record_number} {record_name} tfrec files containing {n} records")
+        default_path, default_size, serialize, reward_index = "data/tfrecords/rl/storage/", 10, serialize_rl, 3
     else:
-        if save_path is None:
-            save_path = "data/tfrecords/imitator/train/"
-        out_file = None
-        # with tf.io.TFRecordWriter(filename) as out_file:
-        for n, (observation, action_probs, reward) in enumerate(ds):
-            if out_file is None or n % 3000 == 0:
-                if out_file is not None:
-                    out_file.close()
-                if collector_n is not None:
-                    filename = f"{save_path}{collector_n}_{record_name}_{n}.tfrec"
-                else:
-                    filename = f"{save_path}{record_name}_{n}.tfrec"
-                out_file = tf.io.TFRecordWriter(filename)
-            serial_action_probs = [tf.io.serialize_tensor(item).numpy() for item in action_probs]
-            serial_observation = tf.io.serialize_tensor(tf.io.serialize_sparse(observation))
-            example = to_tfrecord(reward.numpy().astype(np.float32),
-                                  serial_action_probs,
-                                  serial_observation.numpy())
-            out_file.write(example.SerializeToString())
-        out_file.close()
-        print(f"Wrote group #{record_number} {record_name} tfrec files containing {n} records")
+        default_path, default_size, serialize, reward_index = ("data/tfrecords/imitator/train/", 3000,
+                                                               serialize_imitator, 2)
+    if save_path is None:
+        save_path = default_path
+    if shard_size is None:
+        shard_size = default_size
+    suffix = get_tfrecord_suffix(compression)
+    pool = get_writer_pool()
+
+    def submit(shard_elements, n_first):
+        if collector_n is not None:
+            filename = f"{save_path}{collector_n}_{record_name}_{n_first}{suffix}"
+        else:
+            filename = f"{save_path}{record_name}_{n_first}{suffix}"
+        # generation waits when the pool is behind
+        while len(_pending_writes) >= MAX_PENDING_WRITES:
+            _pending_writes.popleft().result()
+        _pending_writes.append(pool.submit(write_tfrecord_shard, shard_elements, serialize, filename, compression,
+                                           reward_index, metadata))
+
+    n = 0
+    elements = []
+    for element in ds:
+        elements.append(element)
+        n += 1
+        if len(elements) == shard_size:
+            submit(elements, n - shard_size)
+            elements = []
+    if elements:
+        submit(elements, n - len(elements))
+    print(f"Wrote group #{record_number} {record_name} tfrec files containing {n} records")
+
+
+def send_records(ds, replay_buffer, is_pg_rl, chunk_size=3000):
+    # columns with packed observations go to a replay buffer actor
+    n = 0
+    for n_first, columns in columnar_storage.iterate_columns(ds, is_pg_rl, chunk_size):
+        observation_columns, layout = columnar_storage.pack_observations(columns.pop("observation"))
+        columns.update(observation_columns)
+        ray.get(replay_buffer.add.remote(columns, layout))
+        n = n_first + len(columns["reward"])
+    print(f"Sent {n} records to the replay buffer")
 
 
 def record(player1_data, player2_data, rewards,
            feature_maps_shape, actions_shape, record_number, record_name,
-           progress=None, is_for_rl=False, save_path=None, collector_n=None, is_pg_rl=False):
+           progress=None, is_for_rl=False, save_path=None, collector_n=None, is_pg_rl=False,
+           storage_format="tfrecord", replay_buffer=None, shard_size=None, compression=None, metadata=None):
+    def get_reward(player_n, unit_id):
+        # collectors provide per unit rewards, the scraper provides (player 1, player 2) rewards
+        if isinstance(rewards, dict):
+            return rewards[unit_id]
+        return rewards[player_n]
+
+    if progress is not None:
+        progress_values = np.asarray(progress)
+
     def data_gen_all():
         for j, player_data in enumerate((player1_data, player2_data)):
             if player_data is None:
                 continue
-            final_reward = final_reward_1 if j == 0 else final_reward_2
             for key, unit in player_data.items():
                 unit_type = key.split("_")[0]
                 if unit_type != "u":
                     continue
-                actions = unit.actions
-                counters = np.zeros_like(actions)  # for debug, shows points with actions yielded
-                for point in unit.data:
-                    # point [action, action_probs, observation]
-                    action = point[0]
+                final_reward = get_reward(j, key)
+                observations = unit.observations
+                units_actions_probs = unit.actions_probs
+                for i in range(len(unit)):
                     # store observation, action_probs, reward
-                    observation = tf.sparse.from_dense(tf.constant(point[2], dtype=tf.float16))
-                    actions_probs = tuple([tf.constant(item, dtype=tf.float16) for item in point[1]])
+                    observation = tf.sparse.from_dense(tf.constant(observations[i], dtype=tf.float16))
+                    actions_probs = tuple([tf.constant(item[i], dtype=tf.float16) for item in units_actions_probs])
                     reward = tf.constant(final_reward, dtype=tf.float16)
                     yield observation, actions_probs, reward
-                    counters += action[0]
 
     episode_length = 360
     trajectory_steps = 40
@@ -180,29 +280,26 @@ def record(player1_data, player2_data, rewards,
         for j, player_data in enumerate((player1_data, player2_data)):
             if player_data is None:
                 continue
-            final_reward = final_reward_1 if j == 0 else final_reward_2
             for key, unit in player_data.items():
                 unit_type = key.split("_")[0]
                 if unit_type != "u":
                     continue
-                actions_numbers = -np.ones([total_len] + [len(unit.data[0][1])])
-                actions_probs = [np.zeros([total_len] + list(item.shape)) for item in unit.data[0][1]]
-                observations = np.zeros([total_len] + list(unit.data[0][2].shape))
+                final_reward = get_reward(j, key)
+                unit_length = len(unit)
+                units_actions_probs = unit.actions_probs
+                actions_numbers = -np.ones([total_len, len(actions_shape)])
+                actions_numbers[:unit_length] = unit.action_numbers
+                actions_probs = [np.zeros([total_len] + list(item.shape[1:])) for item in units_actions_probs]
+                for n, prob_item in enumerate(units_actions_probs):
+                    actions_probs[n][:unit_length] = prob_item
+                observations = np.zeros([total_len] + list(feature_maps_shape))
+                observations[:unit_length] = unit.observations
                 rewards = np.zeros([total_len])
+                rewards[:unit_length] = final_reward
                 masks = np.zeros([total_len])
+                masks[:unit_length] = 1
                 progress_array = np.zeros([total_len])
-                i = 0
-                for i, point in enumerate(unit.data):
-                    for n, item in enumerate(point[0]):
-                        non_zeros = np.count_nonzero(item)
-                        if non_zeros:
-                            actions_numbers[i][n] = np.argmax(item)
-                    for n, prob_item in enumerate(point[1]):
-                        actions_probs[n][i] = prob_item
-                    observations[i] = point[2]
-                    rewards[i] = final_reward
-                    masks[i] = 1
-                    progress_array[i] = progress[unit.step[i]].numpy()
+                progress_array[:unit_length] = progress_values[unit.steps]
                 # cast to tf tensors
                 actions_numbers = tf.constant(actions_numbers, dtype=tf.int16)
                 actions_probs = tuple([tf.constant(item, dtype=tf.float16) for item in actions_probs])
@@ -210,7 +307,7 @@ def record(player1_data, player2_data, rewards,
                 rewards = tf.constant(rewards, dtype=tf.float16)
                 masks = tf.constant(masks, dtype=tf.int16)
                 progress_array = tf.constant(progress_array, dtype=tf.float16)
-                final_idx = tf.constant(i, dtype=tf.int16)
+                final_idx = tf.constant(unit_length - 1, dtype=tf.int16)
 
                 yield actions_numbers, actions_probs, observations, rewards, masks, progress_array, final_idx
 
@@ -218,28 +315,35 @@ def record(player1_data, player2_data, rewards,
         for j, player_data in enumerate((player1_data, player2_data)):
             if player_data is None:
                 continue
-            final_reward = final_reward_1 if j == 0 else final_reward_2
             for key, unit in player_data.items():
                 unit_type = key.split("_")[0]
                 if unit_type != "u":
                     continue
+                final_reward = get_reward(j, key)
                 # median = np.median(unit.actions[np.nonzero(unit.actions)])
                 mean = np.mean(unit.actions[np.nonzero(unit.actions)])
                 actions = unit.actions
                 # multipliers = np.divide(median, actions, out=np.zeros_like(actions), where=actions != 0)
                 multipliers = np.divide(mean, actions, out=np.zeros_like(actions), where=actions != 0)
-                final_idx = len(unit.data)
-                counters = np.zeros_like(actions)  # for debug, shows points with actions yielded
+                general_actions = unit.action_numbers[:, 0]
+                observations = unit.observations
+                units_actions_probs = unit.actions_probs
+                final_idx = len(unit)
                 if np.nonzero(unit.actions)[0].shape[0] == 1:
                     # if only one possible action in unit episode trajectory, add only the last one (issue?)
                     idx = final_idx - 1
                 else:
                     idx = 0
                 while True:
-                    # point [action, action_probs, observation]
-                    point = unit.data[idx]
-                    action = point[0]
-                    multiplier = multipliers[np.nonzero(action)][0]
+                    point_idx = idx
+                    general_action = general_actions[point_idx]
+                    if general_action < 0:
+                        # a point without a general action, -1 would index the last multiplier
+                        idx += 1
+                        if idx == final_idx:
+                            break
+                        continue
+                    multiplier = multipliers[general_action]
 
                     if multiplier > 1.01 and random.random() > 1 / multiplier:
                         # repeat point
@@ -252,11 +356,11 @@ def record(player1_data, player2_data, rewards,
                         continue
 
                     # store observation, action_probs, reward
-                    observation = tf.sparse.from_dense(tf.constant(point[2], dtype=tf.float16))
-                    actions_probs = tf.constant(point[1], dtype=tf.float16)
+                    observation = tf.sparse.from_dense(tf.constant(observations[point_idx], dtype=tf.float16))
+                    actions_probs = tuple([tf.constant(item[point_idx], dtype=tf.float16)
+                                           for item in units_actions_probs])
                     reward = tf.constant(final_reward, dtype=tf.float16)
                     yield observation, actions_probs, reward
-                    counters += action
 
                     idx += 1
                     if idx == final_idx:
@@ -266,29 +370,28 @@ def record(player1_data, player2_data, rewards,
         for j, player_data in enumerate((player1_data, player2_data)):
             if player_data is None:
                 continue
-            # final_reward = final_reward_1 if j == 0 else final_reward_2
             for key, unit in player_data.items():
-                final_reward = rewards[key]
                 unit_type = key.split("_")[0]
                 if unit_type != "u":
                     continue
+                final_reward = get_reward(j, key)
                 actions = unit.actions
                 movements_average = actions[0] / 4 if actions[0] > 0 else 1.
                 idle_prob = movements_average / actions[2] if actions[2] > 0 else 1.
                 build_multiplier = movements_average / actions[3] if actions[3] > 0 else 1.
-                counters = np.zeros_like(actions)  # for debug, shows points with actions yielded
+                units_action_numbers = unit.action_numbers
+                units_actions_probs = unit.actions_probs
+                observations = unit.observations
+                steps = unit.steps
                 build_repeat_counter = 0
-                final_idx = len(unit.data)
+                final_idx = len(unit)
                 idx = 0
                 while True:
-                    # point [action_vectors, action_vectors_probs, observation]
-                    point = unit.data[idx]
-                    progress_value = progress[unit.step[idx]].numpy()
+                    point_idx = idx
+                    progress_value = progress_values[steps[point_idx]]
 
-                    action_vectors = point[0]
                     # choice
-                    general_actions = action_vectors[0]
-                    act_index = np.argmax(general_actions)
+                    act_index = units_action_numbers[point_idx][0]
                     if act_index == 1:  # transfer to skip
                         idx += 1
                         if idx == final_idx:
@@ -313,23 +416,18 @@ def record(player1_data, player2_data, rewards,
                                 build_repeat_counter = 0
 
                     #
-                    actions_numbers = -np.ones(len(action_vectors))
-                    for n, item in enumerate(action_vectors):
-                        non_zeros = np.count_nonzero(item)
-                        if non_zeros:
-                            actions_numbers[n] = np.argmax(item)
-                    actions_numbers = tf.constant(actions_numbers, dtype=tf.int16)
+                    actions_numbers = tf.constant(units_action_numbers[point_idx], dtype=tf.int16)
                     #
-                    actions_probs = tuple([tf.constant(item, dtype=tf.float16) for item in point[1]])
+                    actions_probs = tuple([tf.constant(item[point_idx], dtype=tf.float16)
+                                           for item in units_actions_probs])
                     #
-                    observation = tf.sparse.from_dense(tf.constant(point[2], dtype=tf.float16))
+                    observation = tf.sparse.from_dense(tf.constant(observations[point_idx], dtype=tf.float16))
                     #
                     reward = tf.constant(final_reward, dtype=tf.float16)
                     #
                     progress_value = tf.constant(progress_value, dtype=tf.float16)
                     #
                     yield actions_numbers, actions_probs, observation, reward, progress_value
-                    counters += general_actions
 
                     idx += 1
                     if idx == final_idx:
@@ -374,7 +472,22 @@ def record(player1_data, player2_data, rewards,
             ))
 
     # foo = list(dataset.take(1))
-    write_tfrecord(dataset, record_number, record_name, is_for_rl, save_path, collector_n, is_pg_rl)
+    if replay_buffer is not None and is_pg_rl:
+        # records are sampled again for storage, so stored and sent records may differ
+        send_records(dataset, replay_buffer, is_pg_rl)
+    if storage_format is None:  # no disk storage
+        return
+    elif storage_format in ("columnar", "packed") and (is_pg_rl or not is_for_rl):
+        if save_path is None:
+            save_path = "data/tfrecords/rl/storage/" if is_for_rl else "data/tfrecords/imitator/train/"
+        columnar_storage.write_columnar(dataset, record_number, record_name, is_pg_rl, save_path, collector_n,
+                                        shard_size=shard_size or 3000, pack=storage_format == "packed",
+                                        metadata=metadata)
+    elif storage_format in ("tfrecord", "columnar", "packed"):
+        write_tfrecord(dataset, record_number, record_name, is_for_rl, save_path, collector_n, is_pg_rl,
+                       shard_size, compression, metadata)
+    else:
+        raise NotImplementedError
 
 
 def up_down(obs, probs):
@@ -469,6 +582,84 @@ def random_reverse_pg(act_numbers, act_probs, dir_probs, res_probs, observations
     return new_act_numbers, act_probs, dir_probs, res_probs, observations, reward, progress
 
 
+# direction vectors (row, column) in the order of direction probs: n, e, s, w
+DIRECTIONS = ((-1, 0), (0, 1), (1, 0), (0, -1))
+
+
+def get_d4_tables(size):
+    """
+    Makes gather tables for the 8 symmetries of a square map: 4 rotations, each with and without a flip.
+
+    Returns:
+        cells: [8, size * size], a source cell for every cell of a transformed map
+        dir_sources: [8, 4], a source direction for every transformed direction, to permute probs
+        dir_targets: [8, 4], a transformed direction for every source direction, to map action numbers
+    """
+    cells = []
+    dir_sources = []
+    dir_targets = []
+    for k in range(4):
+        for flip in (False, True):
+            def transform(grid):
+                grid = np.rot90(grid, k)  # the same as tf.image.rot90
+                return grid[:, ::-1] if flip else grid
+
+            cells.append(transform(np.arange(size * size).reshape(size, size)).ravel())
+            # a step from the center of a 3x3 grid goes where the transformed step goes
+            small = transform(np.arange(9).reshape(3, 3))
+            targets = []
+            for dy, dx in DIRECTIONS:
+                new_y, new_x = np.argwhere(small == (1 + dy) * 3 + (1 + dx))[0]
+                targets.append(DIRECTIONS.index((new_y - 1, new_x - 1)))
+            dir_targets.append(targets)
+            dir_sources.append([targets.index(j) for j in range(len(DIRECTIONS))])
+    return (tf.constant(np.array(cells), dtype=tf.int32),
+            tf.constant(dir_sources, dtype=tf.int32),
+            tf.constant(dir_targets, dtype=tf.int32))
+
+
+def random_symmetry_batch(observations, dir_probs, act_numbers, tables):
+    """
+    Applies a random symmetry of the dihedral group to every example of a batch with gathers, no branching.
+
+    act_numbers can be None, directions of -1 are kept.
+    """
+    cells, dir_sources, dir_targets = tables
+    shape = tf.shape(observations)
+    symmetries = tf.random.uniform(shape=[shape[0]], minval=0, maxval=8, dtype=tf.int32)
+
+    flat_observations = tf.reshape(observations, [shape[0], -1, shape[-1]])
+    flat_observations = tf.gather(flat_observations, tf.gather(cells, symmetries), batch_dims=1)
+    observations = tf.reshape(flat_observations, shape)
+    dir_probs = tf.gather(dir_probs, tf.gather(dir_sources, symmetries), batch_dims=1)
+    if act_numbers is not None:
+        directions = act_numbers[:, 1]
+        new_directions = tf.gather(tf.gather(dir_targets, symmetries), tf.maximum(directions, 0), batch_dims=1)
+        new_directions = tf.where(directions >= 0, new_directions, directions)
+        act_numbers = tf.concat([act_numbers[:, :1], new_directions[:, None], act_numbers[:, 2:]], axis=1)
+    return observations, dir_probs, act_numbers
+
+
+def augment_records(ds, augment, augment_batch_size):
+    # symmetries are applied to batches of records, records can be parsed one by one or in batches
+    ds = ds.batch(augment_batch_size)
+    ds = ds.map(augment, num_parallel_calls=AUTO)
+    return ds.unbatch()
+
+
+def random_symmetry_imitator(observations, inputs, tables):
+    # random_reverse and random_rotate for a batch
+    act_probs, dir_probs, res_probs, reward = inputs
+    observations, dir_probs, _ = random_symmetry_batch(observations, dir_probs, None, tables)
+    return observations, (act_probs, dir_probs, res_probs, reward)
+
+
+def random_symmetry_pg(act_numbers, act_probs, dir_probs, res_probs, observations, reward, progress, tables):
+    # random_reverse_pg with rotations for a batch
+    observations, dir_probs, act_numbers = random_symmetry_batch(observations, dir_probs, act_numbers, tables)
+    return act_numbers, act_probs, dir_probs, res_probs, observations, reward, progress
+
+
 def split_for_shrub(observation, inputs):
     action_probs_1, action_probs_2, action_probs_3, reward = inputs
     if action_probs_1[1] == 1:  # transfer action
@@ -594,38 +785,133 @@ def merge_actions_amplify(observation, inputs):
 
 
 def merge_actions_rl(act_numbers, act_probs, dir_probs, res_probs, observation, reward, mask, progress):
-    # steps = act_probs.shape[0]
-    steps = 40
-    ta = tf.TensorArray(dtype=tf.float32, size=steps, dynamic_size=False)
-    for i in tf.range(steps):
-        movements = dir_probs[i] * act_probs[i][0]
-        idle = act_probs[i][1:2] + act_probs[i][2:3]  # transfer + idle
-        bcity = act_probs[i][3:]
-        row_probs = tf.concat([movements, idle, bcity], axis=0)
-        row_logs = tf.math.log(row_probs)  # it produces infs, but softmax seems to be fine with it
-        row = tf.nn.softmax(row_logs)  # normalize action probs
-        if tf.reduce_any(tf.math.is_nan(row)):
-            row = row_probs
-        ta = ta.write(i, row)
-    new_probs = ta.stack()
-    act_numbers = tf.argmax(new_probs, axis=1)
+    # all steps of a trajectory at once, see merge_actions_rl_batch for batches of trajectories
+    new_probs = merge_probs_batch(act_probs, dir_probs, clip=False)
+    act_numbers = tf.argmax(new_probs, axis=-1)
+    return act_numbers, new_probs, observation, reward, mask, progress
+
+
+def merge_probs_batch(act_probs, dir_probs, amplify=1., clip=True):
+    """
+    Merges action and direction heads to six actions probs, over the last axis of a batch or of trajectories.
+
+    Rows with NaNs after the softmax fall back to merged probs, as in merge_actions.
+    """
+    movements = dir_probs * act_probs[..., 0:1]
+    idle = act_probs[..., 1:2] + act_probs[..., 2:3]  # transfer + idle
+    bcity = act_probs[..., 3:]
+    row_probs = tf.concat([movements, idle, bcity], axis=-1)
+    if clip:
+        row_probs = backend.clip(row_probs, backend.epsilon(), 1)
+    row_logs = tf.math.log(row_probs)  # without a clip it produces infs, but softmax seems to be fine with it
+    new_probs = tf.nn.softmax(row_logs * amplify)
+    is_nan = tf.reduce_any(tf.math.is_nan(new_probs), axis=-1, keepdims=True)
+    return tf.where(is_nan, row_probs, new_probs)
+
+
+def merge_actions_batch(observation, inputs):
+    # merge_actions after .batch()
+    act_probs, dir_probs, res_probs, reward = inputs
+    return observation, (merge_probs_batch(act_probs, dir_probs), reward)
+
+
+def merge_actions_amplify_batch(observation, inputs):
+    # merge_actions_amplify after .batch()
+    act_probs, dir_probs, res_probs, reward = inputs
+    return observation, (merge_probs_batch(act_probs, dir_probs, amplify=2., clip=False), reward)
+
+
+def merge_actions_pg_batch(act_numbers, act_probs, dir_probs, res_probs, observations, reward, progress):
+    # merge_actions_pg after .batch(), action numbers are n, e, s, w, idle, bcity or -1
+    new_probs = merge_probs_batch(act_probs, dir_probs)
+    general_actions = act_numbers[:, 0]
+    directions = act_numbers[:, 1]
+    movements = tf.where((directions >= 0) & (directions <= 3), directions, -1)
+    act_number = tf.where(general_actions == 0, movements,
+                          tf.where(general_actions == 2, 4,
+                                   tf.where(general_actions == 3, 5, -1)))
+    return tf.cast(act_number, dtype=tf.int32), new_probs, observations, reward, progress
+
+
+def merge_actions_rl_batch(act_numbers, act_probs, dir_probs, res_probs, observation, reward, mask, progress):
+    # merge_actions_rl after .batch(), for all steps of all trajectories at once
+    new_probs = merge_probs_batch(act_probs, dir_probs, clip=False)
+    act_numbers = tf.argmax(new_probs, axis=-1)
     return act_numbers, new_probs, observation, reward, mask, progress
 
 
+def split_filenames(filenames):
+    tfrecord_filenames = [name for name in filenames if not columnar_storage.is_columnar(name)]
+    columnar_filenames = [name for name in filenames if columnar_storage.is_columnar(name)]
+    return tfrecord_filenames, columnar_filenames
+
+
+def merge_datasets(datasets, seed=None):
+    # datasets is a list of (dataset, number of shards), shards of both formats hold up to 3000 records
+    if len(datasets) == 1:
+        return datasets[0][0]
+    shards_n = sum([shards for _, shards in datasets])
+    return tf.data.experimental.sample_from_datasets([ds for ds, _ in datasets],
+                                                     weights=[shards / shards_n for _, shards in datasets],
+                                                     seed=seed)
+
+
+def parse_tensors(serialized, out_type, shape):
+    # serialize_tensor writes numeric tensors with their bytes at the end of the proto,
+    # tensors of one dtype and shape have bytes of the same length, they are sliced for a whole batch
+    content_size = int(np.prod(shape)) * out_type.size
+    content = tf.strings.substr(serialized, tf.strings.length(serialized) - content_size, content_size)
+    values = tf.io.decode_raw(content, out_type)
+    return tf.reshape(values, [-1] + list(shape))
+
+
+def parse_string_tensors(serialized, shape):
+    # string tensors have no fixed layout, parse_tensor is mapped over a batch in the graph
+    return tf.map_fn(lambda x: tf.io.parse_tensor(x, tf.string), serialized,
+                     fn_output_signature=tf.TensorSpec(shape=shape, dtype=tf.string))
+
+
+def parse_sparse_tensors(serialized, shape):
+    # a batch of serialized sparse tensors to one dense float16 tensor [batch] + shape
+    components = parse_string_tensors(serialized, [3])
+    sparse = tf.io.deserialize_many_sparse(components, dtype=tf.float16)
+    dense = tf.sparse.to_dense(sparse)
+    dense.set_shape([None] + list(shape))
+    return dense
+
+
+def shuffle_records(ds, shuffle_buffer, seed=None):
+    # records are shuffled before decoding, a buffer of serialized records
+    # is much smaller than a buffer of dense float32 feature maps
+    if shuffle_buffer:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    return ds
+
+
+def parse_records(ds, read_tfrecord, read_tfrecords, parse_batch_size):
+    # batch first parsing decodes batches of serialized examples with vectorized ops
+    if parse_batch_size:
+        ds = ds.batch(parse_batch_size)
+        ds = ds.map(read_tfrecords, num_parallel_calls=AUTO)
+        return ds.unbatch()
+    return ds.map(read_tfrecord, num_parallel_calls=AUTO)
+
+
 def read_records_for_imitator(feature_maps_shape, actions_shape, model_name, path,
-                              filenames=None, amplify_probs=False):
+                              filenames=None, amplify_probs=False, parse_batch_size=256, batch_size=None,
+                              shuffle_buffer=10000, seed=None, augment_batch_size=256):
     # read from TFRecords. For optimal performance, read from multiple
     # TFRecord files at once and set the option experimental_deterministic = False
     # to allow order-altering optimizations.
+    features = {
+        "observation": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_1": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_2": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_3": tf.io.FixedLenFeature([], tf.string),
+        "reward": tf.io.FixedLenFeature([], tf.float32),
+    }
 
     def read_tfrecord(example):
-        features = {
-            "observation": tf.io.FixedLenFeature([], tf.string),
-            "action_probs_1": tf.io.FixedLenFeature([], tf.string),
-            "action_probs_2": tf.io.FixedLenFeature([], tf.string),
-            "action_probs_3": tf.io.FixedLenFeature([], tf.string),
-            "reward": tf.io.FixedLenFeature([], tf.float32),
-        }
         # decode the TFRecord
         example = tf.io.parse_single_example(example, features)
 
@@ -655,11 +941,34 @@ def read_records_for_imitator(feature_maps_shape, actions_shape, model_name, pat
 
         return observation, (action_probs_1, action_probs_2, action_probs_3, reward)
 
+    def read_tfrecords(examples):
+        # the same as read_tfrecord for a batch of examples
+        examples = tf.io.parse_example(examples, features)
+
+        observation = parse_sparse_tensors(examples["observation"], feature_maps_shape)
+        observation = tf.cast(observation, dtype=tf.float32)
+        action_probs_1 = parse_tensors(examples["action_probs_1"], tf.float16, actions_shape[0])
+        action_probs_1 = tf.cast(action_probs_1, dtype=tf.float32)
+        action_probs_2 = parse_tensors(examples["action_probs_2"], tf.float16, actions_shape[1])
+        action_probs_2 = tf.cast(action_probs_2, dtype=tf.float32)
+        action_probs_3 = parse_tensors(examples["action_probs_3"], tf.float16, actions_shape[2])
+        action_probs_3 = tf.cast(action_probs_3, dtype=tf.float32)
+        reward = examples["reward"]
+
+        return observation, (action_probs_1, action_probs_2, action_probs_3, reward)
+
+    def read_columns(observation, action_probs_1, action_probs_2, action_probs_3, reward):
+        return tf.cast(observation, dtype=tf.float32), (tf.cast(action_probs_1, dtype=tf.float32),
+                                                        tf.cast(action_probs_2, dtype=tf.float32),
+                                                        tf.cast(action_probs_3, dtype=tf.float32),
+                                                        tf.cast(reward, dtype=tf.float32))
+
     option_no_order = tf.data.Options()
     option_no_order.experimental_deterministic = False
 
     if filenames is None:
-        filenames = tf.io.gfile.glob(path + "*.tfrec")
+        filenames = glob_records(path)
+    filenames, columnar_filenames = split_filenames(filenames)
 
     # test_dataset = tf.data.Dataset.list_files(filenames)
     # test_dataset = test_dataset.interleave(lambda x: tf.data.TFRecordDataset(x),
@@ -680,19 +989,39 @@ def read_records_for_imitator(feature_maps_shape, actions_shape, model_name, pat
 
     # filenames_ds = tf.data.TFRecordDataset(filenames, num_parallel_reads=AUTO)
     # filenames_ds = tf.data.Dataset.list_files(filenames)
-    filenames_ds = tf.data.Dataset.from_tensor_slices(filenames)
-    filenames_ds = filenames_ds.shuffle(len(filenames), reshuffle_each_iteration=True)
-    # filenames_ds = filenames_ds.with_options(option_no_order)
-    ds = filenames_ds.interleave(lambda x: tf.data.TFRecordDataset(x),
-                                 cycle_length=5,
-                                 num_parallel_calls=AUTO
-                                 )
-    ds = ds.map(read_tfrecord, num_parallel_calls=AUTO)
+    columnar_signature = (
+        tf.TensorSpec(shape=feature_maps_shape, dtype=tf.float16),
+        tf.TensorSpec(shape=actions_shape[0], dtype=tf.float16),
+        tf.TensorSpec(shape=actions_shape[1], dtype=tf.float16),
+        tf.TensorSpec(shape=actions_shape[2], dtype=tf.float16),
+        tf.TensorSpec(shape=(), dtype=tf.float16),
+    )
+    datasets = []
+    if filenames:
+        filenames_ds = tf.data.Dataset.from_tensor_slices(filenames)
+        filenames_ds = filenames_ds.shuffle(len(filenames), seed=seed, reshuffle_each_iteration=True)
+        # filenames_ds = filenames_ds.with_options(option_no_order)
+        ds = filenames_ds.interleave(read_tfrecord_file,
+                                     cycle_length=5,
+                                     num_parallel_calls=AUTO
+                                     )
+        ds = shuffle_records(ds, shuffle_buffer, seed)
+        ds = parse_records(ds, read_tfrecord, read_tfrecords, parse_batch_size)
+        datasets.append((ds, len(filenames)))
+    if columnar_filenames:
+        ds = columnar_storage.read_columnar(columnar_filenames, columnar_storage.IMITATOR_COLUMNS,
+                                            columnar_signature, shuffle_buffer=shuffle_buffer, seed=seed)
+        ds = ds.map(read_columns, num_parallel_calls=AUTO)
+        datasets.append((ds, len(columnar_filenames)))
+    ds = merge_datasets(datasets, seed)
     if (model_name == "actor_critic_residual_six_actions" or model_name == "actor_critic_efficient_six_actions" or
             model_name == "actor_critic_residual_shrub"):
         ds = ds.filter(filter_transfer)
-    ds = ds.map(random_reverse, num_parallel_calls=AUTO)
-    ds = ds.map(random_rotate, num_parallel_calls=AUTO)
+    # all 8 symmetries, a random one per example, are applied to batches
+    tables = get_d4_tables(feature_maps_shape[0])
+    ds = augment_records(ds, lambda observations, inputs: random_symmetry_imitator(observations, inputs, tables),
+                         augment_batch_size)
+    batch_merge = None
     if model_name == "actor_critic_residual_shrub":
         ds = ds.map(split_for_shrub, num_parallel_calls=AUTO)
     elif model_name == "actor_critic_residual_switch_shrub":
@@ -700,7 +1029,9 @@ def read_records_for_imitator(feature_maps_shape, actions_shape, model_name, pat
     elif model_name == "actor_critic_residual_six_actions" \
             or model_name == "actor_critic_sep_residual_six_actions" \
             or model_name == "actor_critic_efficient_six_actions":
-        if amplify_probs:
+        if batch_size is not None:
+            batch_merge = merge_actions_amplify_batch if amplify_probs else merge_actions_batch
+        elif amplify_probs:
             ds = ds.map(merge_actions_amplify, num_parallel_calls=AUTO)
         else:
             ds = ds.map(merge_actions, num_parallel_calls=AUTO)
@@ -708,29 +1039,47 @@ def read_records_for_imitator(feature_maps_shape, actions_shape, model_name, pat
         ds = ds.map(split_with_transfer, num_parallel_calls=AUTO)
     else:
         raise NotImplementedError
-    ds = ds.shuffle(10000, reshuffle_each_iteration=True)
+    if batch_size is not None:
+        # with a batch size heads are merged for whole batches
+        ds = ds.batch(batch_size)
+        if batch_merge is not None:
+            ds = ds.map(batch_merge, num_parallel_calls=AUTO)
     return ds
 
 
-def read_records_for_rl(feature_maps_shape, actions_shape, trajectory_steps, model_name, path):
+def read_records_for_rl(feature_maps_shape, actions_shape, trajectory_steps, model_name, path,
+                        parse_batch_size=8, batch_size=None, seed=None):
     # read from TFRecords. For optimal performance, read from multiple
     # TFRecord files at once and set the option experimental_deterministic = False
     # to allow order-altering optimizations.
     episode_length = 360
     total_len = episode_length + trajectory_steps
+    features = {
+        "actions_numbers": tf.io.FixedLenFeature([], tf.string),
+        "actions_probs_1": tf.io.FixedLenFeature([], tf.string),
+        "actions_probs_2": tf.io.FixedLenFeature([], tf.string),
+        "actions_probs_3": tf.io.FixedLenFeature([], tf.string),
+        "observations": tf.io.FixedLenFeature([], tf.string),
+        "rewards": tf.io.FixedLenFeature([], tf.string),
+        "masks": tf.io.FixedLenFeature([], tf.string),
+        "progress_array": tf.io.FixedLenFeature([], tf.string),
+        "final_idx": tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def get_trajectory(actions_numbers, actions_probs_1, actions_probs_2, actions_probs_3, observations,
+                       rewards, masks, progress_array, final_idx):
+        start_idx = tf.random.uniform(shape=(), minval=0, maxval=final_idx + 1, dtype=tf.int64)
+
+        return tf.cast(actions_numbers[start_idx: start_idx + trajectory_steps, :], dtype=tf.int32), \
+               tf.cast(actions_probs_1[start_idx: start_idx + trajectory_steps, :], dtype=tf.float32), \
+               tf.cast(actions_probs_2[start_idx: start_idx + trajectory_steps, :], dtype=tf.float32), \
+               tf.cast(actions_probs_3[start_idx: start_idx + trajectory_steps, :], dtype=tf.float32), \
+               tf.cast(observations[start_idx: start_idx + trajectory_steps, :, :, :], dtype=tf.float32), \
+               tf.cast(rewards[start_idx: start_idx + trajectory_steps], dtype=tf.float32), \
+               tf.cast(masks[start_idx: start_idx + trajectory_steps], dtype=tf.float32), \
+               tf.cast(progress_array[start_idx: start_idx + trajectory_steps], dtype=tf.float32)
 
     def read_tfrecord(example):
-        features = {
-            "actions_numbers": tf.io.FixedLenFeature([], tf.string),
-            "actions_probs_1": tf.io.FixedLenFeature([], tf.string),
-            "actions_probs_2": tf.io.FixedLenFeature([], tf.string),
-            "actions_probs_3": tf.io.FixedLenFeature([], tf.string),
-            "observations": tf.io.FixedLenFeature([], tf.string),
-            "rewards": tf.io.FixedLenFeature([], tf.string),
-            "masks": tf.io.FixedLenFeature([], tf.string),
-            "progress_array": tf.io.FixedLenFeature([], tf.string),
-            "final_idx": tf.io.FixedLenFeature([], tf.int64),
-        }
         # decode the TFRecord
         example = tf.io.parse_single_example(example, features)
 
@@ -762,18 +1111,31 @@ def read_records_for_rl(feature_maps_shape, actions_shape, trajectory_steps, mod
 
         final_idx = example["final_idx"]
         final_idx.set_shape(())
-        start_idx = tf.random.uniform(shape=(), minval=0, maxval=final_idx + 1, dtype=tf.int64)
 
-        return tf.cast(actions_numbers[start_idx: start_idx + trajectory_steps, :], dtype=tf.int32), \
-               tf.cast(actions_probs_1[start_idx: start_idx + trajectory_steps, :], dtype=tf.float32), \
-               tf.cast(actions_probs_2[start_idx: start_idx + trajectory_steps, :], dtype=tf.float32), \
-               tf.cast(actions_probs_3[start_idx: start_idx + trajectory_steps, :], dtype=tf.float32), \
-               tf.cast(observations[start_idx: start_idx + trajectory_steps, :, :, :], dtype=tf.float32), \
-               tf.cast(rewards[start_idx: start_idx + trajectory_steps], dtype=tf.float32), \
-               tf.cast(masks[start_idx: start_idx + trajectory_steps], dtype=tf.float32), \
-               tf.cast(progress_array[start_idx: start_idx + trajectory_steps], dtype=tf.float32)
+        return get_trajectory(actions_numbers, actions_probs_1, actions_probs_2, actions_probs_3, observations,
+                              rewards, masks, progress_array, final_idx)
         # tf.cast(final_idx, dtype=tf.int32),
 
+    def read_tfrecords(examples):
+        # the same as read_tfrecord for a batch of examples, trajectories are cut after unbatching
+        examples = tf.io.parse_example(examples, features)
+
+        actions_numbers = parse_tensors(examples["actions_numbers"], tf.int16, [total_len, len(actions_shape)])
+        actions_probs_1 = parse_tensors(examples["actions_probs_1"], tf.float16,
+                                        [total_len] + list(actions_shape[0]))
+        actions_probs_2 = parse_tensors(examples["actions_probs_2"], tf.float16,
+                                        [total_len] + list(actions_shape[1]))
+        actions_probs_3 = parse_tensors(examples["actions_probs_3"], tf.float16,
+                                        [total_len] + list(actions_shape[2]))
+        observations = parse_sparse_tensors(examples["observations"], [total_len] + list(feature_maps_shape))
+        rewards = parse_tensors(examples["rewards"], tf.float16, [total_len])
+        masks = parse_tensors(examples["masks"], tf.int16, [total_len])
+        progress_array = parse_tensors(examples["progress_array"], tf.float16, [total_len])
+        final_idx = examples["final_idx"]
+
+        return actions_numbers, actions_probs_1, actions_probs_2, actions_probs_3, observations, \
+            rewards, masks, progress_array, final_idx
+
     # option_no_order = tf.data.Options()
     # option_no_order.experimental_deterministic = False
 
@@ -788,37 +1150,110 @@ def read_records_for_rl(feature_maps_shape, actions_shape, trajectory_steps, mod
     filenames = tf.io.gfile.glob(path + "*.tfrec")
     # filenames_ds = tf.data.TFRecordDataset(filenames, num_parallel_reads=AUTO)
     # filenames_ds = filenames_ds.shuffle(len(filenames), reshuffle_each_iteration=True)
-    filenames_ds = tf.data.Dataset.list_files(filenames)
+    filenames_ds = tf.data.Dataset.list_files(filenames, seed=seed)
     # filenames_ds = filenames_ds.repeat(100)
 
-    ds = filenames_ds.interleave(lambda x: tf.data.TFRecordDataset(x),
+    ds = filenames_ds.interleave(read_tfrecord_file,
                                  cycle_length=5,
                                  num_parallel_calls=AUTO
                                  )
-    ds = ds.map(read_tfrecord, num_parallel_calls=AUTO)
-    if model_name == "actor_critic_residual_six_actions":
-        ds = ds.map(merge_actions_rl, num_parallel_calls=AUTO)
+    if parse_batch_size:
+        ds = ds.batch(parse_batch_size)
+        ds = ds.map(read_tfrecords, num_parallel_calls=AUTO)
+        ds = ds.unbatch()
+        ds = ds.map(get_trajectory, num_parallel_calls=AUTO)
     else:
+        ds = ds.map(read_tfrecord, num_parallel_calls=AUTO)
+    if model_name != "actor_critic_residual_six_actions":
         raise NotImplementedError
+    if batch_size is not None:
+        # heads of all steps of a batch of trajectories are merged at once
+        ds = ds.batch(batch_size)
+        ds = ds.map(merge_actions_rl_batch, num_parallel_calls=AUTO)
+    else:
+        ds = ds.map(merge_actions_rl, num_parallel_calls=AUTO)
     return ds
 
 
+def get_rl_pg_columns_signature(feature_maps_shape, actions_shape):
+    # dtypes of columns as they are written by record()
+    return (
+        tf.TensorSpec(shape=len(actions_shape), dtype=tf.int16),
+        tf.TensorSpec(shape=actions_shape[0], dtype=tf.float16),
+        tf.TensorSpec(shape=actions_shape[1], dtype=tf.float16),
+        tf.TensorSpec(shape=actions_shape[2], dtype=tf.float16),
+        tf.TensorSpec(shape=feature_maps_shape, dtype=tf.float16),
+        tf.TensorSpec(shape=(), dtype=tf.float16),
+        tf.TensorSpec(shape=(), dtype=tf.float16),
+    )
+
+
+def read_rl_pg_columns(action_numbers, action_probs_1, action_probs_2, action_probs_3, observation, reward,
+                       progress_value):
+    return tf.cast(action_numbers, dtype=tf.int32), \
+           tf.cast(action_probs_1, dtype=tf.float32), \
+           tf.cast(action_probs_2, dtype=tf.float32), \
+           tf.cast(action_probs_3, dtype=tf.float32), \
+           tf.cast(observation, dtype=tf.float32), \
+           tf.cast(reward, dtype=tf.float32), \
+           tf.cast(progress_value, dtype=tf.float32)
+
+
+def cast_teacher_probs(*teacher_probs):
+    return tuple(tf.cast(item, dtype=tf.float32) for item in teacher_probs)
+
+
+def add_missing_teacher_probs(*inputs):
+    # records without teacher probs, a trainer runs the teacher for them
+    return inputs + (tf.fill(TEACHER_SHAPE, columnar_storage.TEACHER_MISSING),)
+
+
+def decode_rl_pg_examples(examples, feature_maps_shape, actions_shape):
+    """
+    Decodes a batch of serialized pg examples to dense tensors
+    in the order and dtypes of columnar_storage.PG_COLUMNS.
+    """
+    features = {
+        "action_numbers": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_1": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_2": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_3": tf.io.FixedLenFeature([], tf.string),
+        "observation": tf.io.FixedLenFeature([], tf.string),
+        "reward": tf.io.FixedLenFeature([], tf.float32),
+        "progress_value": tf.io.FixedLenFeature([], tf.float32),
+    }
+    examples = tf.io.parse_example(examples, features)
+
+    action_numbers = parse_tensors(examples["action_numbers"], tf.int16, [len(actions_shape)])
+    action_probs_1 = parse_tensors(examples["action_probs_1"], tf.float16, actions_shape[0])
+    action_probs_2 = parse_tensors(examples["action_probs_2"], tf.float16, actions_shape[1])
+    action_probs_3 = parse_tensors(examples["action_probs_3"], tf.float16, actions_shape[2])
+    observation = parse_sparse_tensors(examples["observation"], feature_maps_shape)
+    # rewards and progress values are float16 before writing, the cast is exact
+    reward = tf.cast(examples["reward"], dtype=tf.float16)
+    progress_value = tf.cast(examples["progress_value"], dtype=tf.float16)
+
+    return action_numbers, action_probs_1, action_probs_2, action_probs_3, observation, reward, progress_value
+
+
 def read_records_for_rl_pg(feature_maps_shape, actions_shape, model_name, path,
-                           filenames=None, amplify_probs=False):
+                           filenames=None, amplify_probs=False, parse_batch_size=256, augment=False,
+                           batch_size=None, shuffle_buffer=10000, seed=None, teacher_probs=False,
+                           augment_batch_size=256):
     # read from TFRecords. For optimal performance, read from multiple
     # TFRecord files at once and set the option experimental_deterministic = False
     # to allow order-altering optimizations.
+    features = {
+        "action_numbers": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_1": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_2": tf.io.FixedLenFeature([], tf.string),
+        "action_probs_3": tf.io.FixedLenFeature([], tf.string),
+        "observation": tf.io.FixedLenFeature([], tf.string),
+        "reward": tf.io.FixedLenFeature([], tf.float32),
+        "progress_value": tf.io.FixedLenFeature([], tf.float32),
+    }
 
     def read_tfrecord(example):
-        features = {
-            "action_numbers": tf.io.FixedLenFeature([], tf.string),
-            "action_probs_1": tf.io.FixedLenFeature([], tf.string),
-            "action_probs_2": tf.io.FixedLenFeature([], tf.string),
-            "action_probs_3": tf.io.FixedLenFeature([], tf.string),
-            "observation": tf.io.FixedLenFeature([], tf.string),
-            "reward": tf.io.FixedLenFeature([], tf.float32),
-            "progress_value": tf.io.FixedLenFeature([], tf.float32),
-        }
         # decode the TFRecord
         example = tf.io.parse_single_example(example, features)
 
@@ -854,11 +1289,16 @@ def read_records_for_rl_pg(feature_maps_shape, actions_shape, model_name, path,
 
         return action_numbers, action_probs_1, action_probs_2, action_probs_3, observation, reward, progress_value
 
+    def read_tfrecords(examples):
+        # the same as read_tfrecord for a batch of examples
+        return read_rl_pg_columns(*decode_rl_pg_examples(examples, feature_maps_shape, actions_shape))
+
     option_no_order = tf.data.Options()
     option_no_order.experimental_deterministic = False
 
     if filenames is None:
-        filenames = tf.io.gfile.glob(path + "*.tfrec")
+        filenames = glob_records(path)
+    filenames, columnar_filenames = split_filenames(filenames)
 
     # test_dataset = tf.data.Dataset.list_files(filenames)
     # test_dataset = test_dataset.interleave(lambda x: tf.data.TFRecordDataset(x),
@@ -874,19 +1314,78 @@ def read_records_for_rl_pg(feature_maps_shape, actions_shape, model_name, path,
 
     # filenames_ds = tf.data.TFRecordDataset(filenames, num_parallel_reads=AUTO)
     # filenames_ds = tf.data.Dataset.list_files(filenames)
-    filenames_ds = tf.data.Dataset.from_tensor_slices(filenames)
-    filenames_ds = filenames_ds.shuffle(len(filenames), reshuffle_each_iteration=True)
-    # filenames_ds = filenames_ds.repeat(10)
-    # filenames_ds = filenames_ds.with_options(option_no_order)
-    ds = filenames_ds.interleave(lambda x: tf.data.TFRecordDataset(x),
-                                 cycle_length=5,
-                                 num_parallel_calls=AUTO
-                                 )
-    ds = ds.map(read_tfrecord, num_parallel_calls=AUTO)
-    # ds = ds.map(random_reverse_pg, num_parallel_calls=AUTO)
-    if model_name == "actor_critic_residual_six_actions" or model_name == "actor_critic_sep_residual_six_actions":
-        ds = ds.map(merge_actions_pg, num_parallel_calls=AUTO)
+    columnar_signature = get_rl_pg_columns_signature(feature_maps_shape, actions_shape)
+    columns = columnar_storage.PG_COLUMNS
+    if teacher_probs:
+        # with teacher probs elements get one more tensor, -1 rows are computed by a trainer
+        columnar_signature += (tf.TensorSpec(shape=TEACHER_SHAPE, dtype=tf.float16),)
+        columns += (columnar_storage.TEACHER_COLUMN,)
+    datasets = []
+    if filenames:
+        filenames_ds = tf.data.Dataset.from_tensor_slices(filenames)
+        filenames_ds = filenames_ds.shuffle(len(filenames), seed=seed, reshuffle_each_iteration=True)
+        # filenames_ds = filenames_ds.repeat(10)
+        # filenames_ds = filenames_ds.with_options(option_no_order)
+        ds = filenames_ds.interleave(read_tfrecord_file,
+                                     cycle_length=5,
+                                     num_parallel_calls=AUTO
+                                     )
+        ds = shuffle_records(ds, shuffle_buffer, seed)
+        ds = parse_records(ds, read_tfrecord, read_tfrecords, parse_batch_size)
+        if teacher_probs:
+            ds = ds.map(add_missing_teacher_probs, num_parallel_calls=AUTO)
+        datasets.append((ds, len(filenames)))
+    if columnar_filenames:
+        ds = columnar_storage.read_columnar(columnar_filenames, columns, columnar_signature,
+                                            shuffle_buffer=shuffle_buffer, seed=seed)
+        ds = ds.map(lambda *inputs: read_rl_pg_columns(*inputs[:7]) + cast_teacher_probs(*inputs[7:]),
+                    num_parallel_calls=AUTO)
+        datasets.append((ds, len(columnar_filenames)))
+    ds = merge_datasets(datasets, seed)
+    if augment:
+        # teacher probs are for not transformed observations, they are dropped
+        tables = get_d4_tables(feature_maps_shape[0])
+        ds = augment_records(ds, lambda *inputs: random_symmetry_pg(*inputs[:7], tables), augment_batch_size)
+        if teacher_probs:
+            ds = ds.map(add_missing_teacher_probs, num_parallel_calls=AUTO)
+    if model_name != "actor_critic_residual_six_actions" and model_name != "actor_critic_sep_residual_six_actions":
+        raise NotImplementedError
+    if batch_size is not None:
+        ds = ds.batch(batch_size)
+        ds = ds.map(lambda *inputs: merge_actions_pg_batch(*inputs[:7]) + inputs[7:], num_parallel_calls=AUTO)
     else:
+        ds = ds.map(lambda *inputs: merge_actions_pg(*inputs[:7]) + inputs[7:], num_parallel_calls=AUTO)
+    return ds
+
+
+def read_replay_for_rl_pg(feature_maps_shape, actions_shape, model_name, replay_buffer, sample_size=1000,
+                          batch_size=None):
+    """
+    Makes an endless dataset of records sampled from a replay buffer actor.
+
+    It yields the same elements as read_records_for_rl_pg, batches of them with a batch size.
+    """
+    def data_gen():
+        while True:
+            pieces = ray.get(replay_buffer.sample.remote(sample_size))
+            for columns, layout in pieces:
+                observation = columnar_storage.unpack_observations(columns["observation_bits"],
+                                                                   columns["observation_scalars"], layout)
+                yield tuple(observation if name == "observation" else columns[name]
+                            for name in columnar_storage.PG_COLUMNS)
+
+    chunk_signature = tuple(tf.TensorSpec(shape=[None] + list(spec.shape), dtype=spec.dtype)
+                            for spec in get_rl_pg_columns_signature(feature_maps_shape, actions_shape))
+    ds = tf.data.Dataset.from_generator(data_gen, output_signature=chunk_signature)
+    ds = ds.unbatch()
+    # records of one sample are grouped by chunks
+    ds = ds.shuffle(sample_size)
+    ds = ds.map(read_rl_pg_columns, num_parallel_calls=AUTO)
+    if model_name != "actor_critic_residual_six_actions" and model_name != "actor_critic_sep_residual_six_actions":
         raise NotImplementedError
-    ds = ds.shuffle(10000)
+    if batch_size is not None:
+        ds = ds.batch(batch_size)
+        ds = ds.map(merge_actions_pg_batch, num_parallel_calls=AUTO)
+    else:
+        ds = ds.map(merge_actions_pg, num_parallel_calls=AUTO)
     return ds
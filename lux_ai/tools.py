@@ -1,4 +1,10 @@
+import os
+import json
 import pickle
+import random
+import shutil
+import threading
+import collections.abc
 
 import numpy as np
 import tensorflow as tf
@@ -149,26 +155,106 @@ class StopOnDemand(tf.keras.callbacks.Callback):
 
 
 def add_point(player_data, actions_dict, actions_probs, proc_obs, current_step):
-    for i, (acts, acts_prob, obs) in enumerate(zip(actions_dict.values(),
-                                                   actions_probs.values(),
-                                                   proc_obs.values())):
-        acts = dict(sorted(acts.items()))
-        acts_prob = dict(sorted(acts_prob.items()))
-        obs = dict(sorted(obs.items()))
-        for (k1, action), (k2, action_probs), (k3, observation) in zip(acts.items(),
-                                                                       acts_prob.items(),
-                                                                       obs.items()):
-            assert k1 == k2 == k3
-            # point_value = [action, action_probs, actions_masks[i], observation]
-            point_value = [action, action_probs, observation]
-            if k1 in player_data.keys():
-                player_data[k1].append(point_value, current_step, action[0])
-            else:
-                player_data[k1] = DataValue(action[0].shape[0])
-                player_data[k1].append(point_value, current_step, action[0])
+    for (unit_type, acts), acts_prob, obs in zip(actions_dict.items(), actions_probs.values(), proc_obs.values()):
+        for unit_id, action in acts.items():
+            player_data.add(unit_id, action, acts_prob[unit_id], obs[unit_id], current_step, unit_type)
     return player_data
 
 
+def get_episode_output(player1_data, player2_data, prev_alive_units, game_states, observations, step, only_wins):
+    """
+    Makes a collected episode output: players data, unit rewards and progress.
+
+    Units which died on the last step get negative rewards.
+    """
+    player1_prev_alive_units, player2_prev_alive_units = prev_alive_units
+
+    player1_alive_units_ids = []
+    player1_died_on_last_step_units_ids = []
+    player1_alive_units = [item.id for item in game_states[0].player.units]
+    for unit in player1_prev_alive_units:
+        if unit in player1_alive_units:
+            player1_alive_units_ids.append(unit)
+        else:
+            player1_died_on_last_step_units_ids.append(unit)
+
+    player2_alive_units_ids = []
+    player2_died_on_last_step_units_ids = []
+    player2_alive_units = [item.id for item in game_states[1].player.units]
+    for unit in player2_prev_alive_units:
+        if unit in player2_alive_units:
+            player2_alive_units_ids.append(unit)
+        else:
+            player2_died_on_last_step_units_ids.append(unit)
+
+    reward1 = observations[0]["reward"]
+    reward2 = observations[1]["reward"]
+    unit_rewards = {}
+    if reward1 != reward2:
+        if reward1 > reward2:  # 1 player won
+            win_data = player1_data
+            win_died_on_last_step_units_ids = player1_died_on_last_step_units_ids
+            # win_alive_units_ids = player1_alive_units_ids
+            lose_data = player2_data
+            lose_died_on_last_step_units_ids = player2_died_on_last_step_units_ids
+            lose_alive_units_ids = player2_alive_units_ids
+        else:
+            win_data = player2_data
+            win_died_on_last_step_units_ids = player2_died_on_last_step_units_ids
+            # win_alive_units_ids = player2_alive_units_ids
+            lose_data = player1_data
+            lose_died_on_last_step_units_ids = player1_died_on_last_step_units_ids
+            lose_alive_units_ids = player1_alive_units_ids
+
+        for unit_id in win_data.keys():
+            if unit_id in win_died_on_last_step_units_ids:
+                unit_rewards[unit_id] = tf.constant(-0.33, dtype=tf.float16)
+            else:
+                unit_rewards[unit_id] = tf.constant(1, dtype=tf.float16)
+        for unit_id in lose_data.keys():
+            if unit_id in lose_died_on_last_step_units_ids:
+                unit_rewards[unit_id] = tf.constant(-1, dtype=tf.float16)
+            elif unit_id in lose_alive_units_ids:
+                unit_rewards[unit_id] = tf.constant(0.33, dtype=tf.float16)
+            else:
+                unit_rewards[unit_id] = tf.constant(0, dtype=tf.float16)
+    else:
+        for unit_id in list(player1_data.keys()) + list(player2_data.keys()):
+            if unit_id in player1_died_on_last_step_units_ids + player2_died_on_last_step_units_ids:
+                unit_rewards[unit_id] = tf.constant(-1, dtype=tf.float16)
+            else:
+                unit_rewards[unit_id] = tf.constant(0.33, dtype=tf.float16)
+
+    progress = tf.linspace(0., 1., step + 2)[:-1]
+    progress = tf.cast(progress, dtype=tf.float16)
+
+    # if reward1 > reward2:
+    #     final_reward_1 = tf.constant(1, dtype=tf.float16)
+    #     final_reward_2 = tf.constant(-1, dtype=tf.float16)
+    # elif reward1 < reward2:
+    #     final_reward_2 = tf.constant(1, dtype=tf.float16)
+    #     final_reward_1 = tf.constant(-1, dtype=tf.float16)
+    # else:
+    #     final_reward_1 = final_reward_2 = tf.constant(0, dtype=tf.float16)
+
+    # final_reward_1 = reward1 / REWARD_CAP if reward1 != -1 else 0
+    # final_reward_1 = 2 * final_reward_1 - 1
+    # final_reward_2 = reward2 / REWARD_CAP if reward2 != -1 else 0
+    # final_reward_2 = 2 * final_reward_2 - 1
+
+    if only_wins:
+        if reward1 > reward2:
+            output = (player1_data, None), unit_rewards, progress
+        elif reward1 < reward2:
+            output = (None, player2_data), unit_rewards, progress
+        else:
+            output = (player1_data, player2_data), unit_rewards, progress
+    else:
+        output = (player1_data, player2_data), unit_rewards, progress
+
+    return output
+
+
 def merge_first_two_dimensions(input1, input2):
     (tensor1, tensor2), (tensor3, tensor4) = input1, input2
     tensors = tensor1, tensor2, tensor3, tensor4
@@ -271,13 +357,293 @@ class GlobalVarActor:
         return self.done
 
 
-class DataValue:
-    def __init__(self, length):
-        self.data = []
-        self.step = []
-        self.actions = np.zeros(length)
-
-    def append(self, data, step, action):
-        self.data.append(data)
-        self.step.append(step)
-        self.actions += action
+@ray.remote
+class WeightsStore:
+    def __init__(self, save_path="data/weights/"):
+        """
+        Keeps the latest published weights as an object store reference with a version;
+        subscribers compare versions and get weights without files.
+
+        Published weights are also saved to save_path/{version}.pickle in a background thread.
+
+        Args:
+            save_path: a directory for weights snapshots
+        """
+        os.makedirs(save_path, exist_ok=True)
+        self._save_path = save_path
+        self._version = None
+        self._weights_ref = None
+        self._snapshot_threads = []
+
+    def publish(self, weights_refs, version, save=True):
+        # a reference is passed in a list, otherwise it is resolved to weights
+        self._weights_ref = weights_refs[0]
+        self._version = version
+        if save:
+            thread = threading.Thread(target=self._save, args=(self._weights_ref, version))
+            thread.start()
+            self._snapshot_threads = [item for item in self._snapshot_threads if item.is_alive()] + [thread]
+
+    def _save(self, weights_ref, version):
+        data = ray.get(weights_ref)
+        # readers glob *.pickle, they never see a partial snapshot
+        filename = f"{self._save_path}{version}.pickle"
+        with open(filename + ".tmp", 'wb') as f:
+            pickle.dump(data, f, protocol=4)
+        os.replace(filename + ".tmp", filename)
+
+    def get_version(self):
+        return self._version
+
+    def get_latest(self):
+        # a version and a reference in a list, so it is not resolved
+        return self._version, [self._weights_ref]
+
+    def flush(self):
+        # wait for snapshots on disk
+        for thread in self._snapshot_threads:
+            thread.join()
+        self._snapshot_threads = []
+
+
+def get_new_weights(weights_store, known_version):
+    """
+    Gets weights from a weights store if there is a version newer than known_version.
+
+    Returns:
+        a version and weights, or known_version and None
+    """
+    version = ray.get(weights_store.get_version.remote())
+    if version is None or version == known_version:
+        return known_version, None
+    version, (weights_ref,) = ray.get(weights_store.get_latest.remote())
+    return version, ray.get(weights_ref)
+
+
+class TrainingCheckpoint:
+    def __init__(self, directory, save_steps):
+        """
+        Keeps a learner position in a training cycle: the model, the optimizer, input iterators and a step.
+
+        Input of a cycle, file names and a shuffle seed, is written once to input.json in the directory,
+        a trainer restarted for the same cycle builds the same datasets from it and restores
+        iterators in the middle of an epoch. The directory is removed when the cycle is done.
+
+        Args:
+            directory: a directory for checkpoints of one trainer
+            save_steps: learner steps between checkpoints, 0 to disable checkpoints
+        """
+        self._directory = directory
+        self._save_steps = save_steps
+        self._input_filename = os.path.join(directory, "input.json")
+        self._step = None
+        self._manager = None
+
+    def get_input(self, cycle, filenames=None):
+        """
+        Returns file names and a shuffle seed of the cycle, saved ones if the cycle is resumed.
+        """
+        if not self._save_steps:
+            return filenames, None
+        if os.path.exists(self._input_filename):
+            with open(self._input_filename, "r") as input_file:
+                saved = json.load(input_file)
+            if saved["cycle"] == cycle:
+                return saved["filenames"], saved["seed"]
+        if os.path.exists(self._directory):
+            shutil.rmtree(self._directory)  # checkpoints of another cycle
+        os.makedirs(self._directory)
+        seed = random.randrange(2 ** 31)
+        tmp_filename = self._input_filename + ".tmp"
+        with open(tmp_filename, "w") as input_file:
+            json.dump({"cycle": cycle, "seed": seed, "filenames": filenames}, input_file)
+        os.replace(tmp_filename, self._input_filename)
+        return filenames, seed
+
+    def get_saved_cycle(self):
+        # a cycle which was not finished, None if there is no one
+        if not self._save_steps or not os.path.exists(self._input_filename):
+            return None
+        with open(self._input_filename, "r") as input_file:
+            return json.load(input_file)["cycle"]
+
+    def restore(self, **trackables):
+        """
+        Tracks a model, an optimizer and iterators, restores them from the latest checkpoint if there is one.
+
+        Returns:
+            an amount of learner steps done in the cycle
+        """
+        if not self._save_steps:
+            return 0
+        self._step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        checkpoint = tf.train.Checkpoint(step=self._step, **trackables)
+        self._manager = tf.train.CheckpointManager(checkpoint, self._directory, max_to_keep=1)
+        if self._manager.latest_checkpoint:
+            checkpoint.restore(self._manager.latest_checkpoint)
+            print(f"Resume the cycle from step {int(self._step)}.")
+        return int(self._step)
+
+    def save(self, step):
+        if self._save_steps and step % self._save_steps == 0:
+            self._step.assign(step)
+            self._manager.save(checkpoint_number=step)
+
+    def finish(self):
+        # a done cycle is not resumed
+        if self._save_steps and os.path.exists(self._directory):
+            shutil.rmtree(self._directory)
+
+
+class UnitTrajectory:
+    def __init__(self, points, rows):
+        """
+        A view of one unit points in a trajectory buffer, in the order they were added.
+
+        Args:
+            points: point arrays of the unit type
+            rows: indices of the unit points in the point arrays
+        """
+        self._points = points
+        self._rows = np.array(rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def observations(self):
+        return self._points.take(self._points.observations, self._rows)
+
+    @property
+    def action_numbers(self):
+        # an argmax of every action vector, -1 for empty vectors
+        return self._points.take(self._points.action_numbers, self._rows)
+
+    @property
+    def actions_probs(self):
+        return tuple(self._points.take(item, self._rows) for item in self._points.actions_probs)
+
+    @property
+    def steps(self):
+        return self._points.take(self._points.steps, self._rows)
+
+    @property
+    def actions(self):
+        # amounts of every general action
+        general_actions = self.action_numbers[:, 0]
+        return np.bincount(general_actions[general_actions >= 0],
+                           minlength=self._points.actions_probs[0][0].shape[1]).astype(np.float64)
+
+
+class PointArrays:
+    def __init__(self, chunk_size, actions_n, actions_shape, observation_shape):
+        """
+        Points of one unit type, stored in chunks of arrays.
+
+        A full chunk is kept as it is and a new one is added, points are not copied
+        to larger arrays, so a memory peak is not higher than the points themselves.
+
+        Args:
+            chunk_size: an amount of points in a chunk
+            actions_n: an amount of action vectors of a point
+            actions_shape: shapes of action probs of a point
+            observation_shape: a shape of an observation of a point
+        """
+        self._chunk_size = chunk_size
+        self._actions_n = actions_n
+        self._actions_shape = [tuple(shape) for shape in actions_shape]
+        self._observation_shape = tuple(observation_shape)
+        self.size = 0
+        self.observations = []
+        self.action_numbers = []
+        self.actions_probs = [[] for _ in self._actions_shape]
+        self.steps = []
+
+    def new_row(self):
+        """
+        Returns a chunk index and a row in the chunk for a new point, zeros when allocated.
+        """
+        chunk, row = divmod(self.size, self._chunk_size)
+        if chunk == len(self.observations):
+            # np.zeros pages are not resident until they are written
+            self.observations.append(np.zeros((self._chunk_size,) + self._observation_shape, dtype=np.float16))
+            self.action_numbers.append(np.zeros((self._chunk_size, self._actions_n), dtype=np.int8))
+            for chunks, shape in zip(self.actions_probs, self._actions_shape):
+                chunks.append(np.zeros((self._chunk_size,) + shape, dtype=np.float16))
+            self.steps.append(np.zeros(self._chunk_size, dtype=np.int16))
+        self.size += 1
+        return chunk, row
+
+    def take(self, chunks, rows):
+        if len(chunks) == 1:
+            return chunks[0][rows]
+        output = np.empty((len(rows),) + chunks[0].shape[1:], dtype=chunks[0].dtype)
+        chunk_ids, chunk_rows = np.divmod(rows, self._chunk_size)
+        for chunk_id in np.unique(chunk_ids):
+            mask = chunk_ids == chunk_id
+            output[mask] = chunks[chunk_id][chunk_rows[mask]]
+        return output
+
+
+class TrajectoryBuffer(collections.abc.Mapping):
+    def __init__(self, chunk_size=256):
+        """
+        Points of all units of one player in one game, stored in chunks of arrays
+        instead of lists of small objects; a mapping from unit ids to their trajectories.
+
+        Every unit type has its own point arrays, they are allocated with the first point
+        of the type, when the shapes are known.
+
+        Args:
+            chunk_size: an amount of points in a chunk of arrays
+        """
+        self._chunk_size = chunk_size
+        self._points = {}
+        self._units = {}
+
+    def _get_points(self, unit_id, unit_type, actions_n, actions_shape, observation_shape):
+        if unit_type not in self._points:
+            self._points[unit_type] = PointArrays(self._chunk_size, actions_n, actions_shape, observation_shape)
+        points = self._points[unit_type]
+        if unit_id not in self._units:
+            self._units[unit_id] = (points, [])
+        elif self._units[unit_id][0] is not points:
+            raise ValueError(f"Unit {unit_id} has points of several unit types.")
+        return points, self._units[unit_id][1]
+
+    def add(self, unit_id, action_vectors, action_probs, observation, step, unit_type="workers"):
+        points, unit_rows = self._get_points(unit_id, unit_type, len(action_vectors),
+                                             [np.shape(item) for item in action_probs], np.shape(observation))
+        chunk, row = points.new_row()
+        points.observations[chunk][row] = observation
+        for n, item in enumerate(action_vectors):
+            points.action_numbers[chunk][row, n] = np.argmax(item) if np.count_nonzero(item) else -1
+        for n, item in enumerate(action_probs):
+            points.actions_probs[n][chunk][row] = item
+        points.steps[chunk][row] = step
+        unit_rows.append(points.size - 1)
+
+    def add_numbers(self, unit_id, action_numbers, observation, step, actions_shape, unit_type="workers"):
+        """
+        Adds a point from action numbers, -1 is for no action; action probs are one hot vectors.
+        """
+        points, unit_rows = self._get_points(unit_id, unit_type, len(action_numbers),
+                                             actions_shape, np.shape(observation))
+        chunk, row = points.new_row()
+        points.observations[chunk][row] = observation
+        points.action_numbers[chunk][row] = action_numbers
+        for n, number in enumerate(action_numbers):
+            if number >= 0:
+                points.actions_probs[n][chunk][row, number] = 1  # rows are zeros when allocated
+        points.steps[chunk][row] = step
+        unit_rows.append(points.size - 1)
+
+    def __getitem__(self, unit_id):
+        points, unit_rows = self._units[unit_id]
+        return UnitTrajectory(points, unit_rows)
+
+    def __iter__(self):
+        return iter(self._units)
+
+    def __len__(self):
+        return len(self._units)
@@ -25,11 +25,14 @@ def ac_agent_run(config_in, data_in, current_cycle_in=None, global_var_actor_in=
             self._actions_shape = [item.shape for item in empty_worker_action_vectors]
             self._model_name = config["model_name"]
             self._batch_size = config["batch_size"]
+            self._precision = models.get_precision(config["precision"])
             if self._model_name == "actor_critic_residual_shrub":
+                if self._precision is not None:
+                    raise NotImplementedError
                 self._model = models.actor_critic_residual_shrub(self._actions_shape)
                 self._model_actions_shape = self._actions_shape
             elif self._model_name == "actor_critic_residual_six_actions":
-                self._model = models.actor_critic_residual_six_actions(6)
+                self._model = models.actor_critic_residual_six_actions(6, self._precision, config["shared_trunk"])
                 self._model_actions_shape = 6
             else:
                 raise NotImplementedError
@@ -58,6 +61,10 @@ def ac_agent_run(config_in, data_in, current_cycle_in=None, global_var_actor_in=
             # self._save_interval = config["save_interval"]
 
             self._optimizer = tfa.optimizers.AdamW(weight_decay=1.e-5, learning_rate=config["default_lr"])
+            # float16 gradients underflow without loss scaling, bfloat16 ones do not
+            self._is_loss_scaled = self._precision == "mixed_float16"
+            if self._is_loss_scaled:
+                self._optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self._optimizer)
             self._entropy_c = config["entropy_c"]
             self._entropy_c_decay = config["entropy_c_decay"]
             # self._lambda = config["lambda"]
@@ -68,6 +75,7 @@ def ac_agent_run(config_in, data_in, current_cycle_in=None, global_var_actor_in=
 
             self._current_cycle = current_cycle
             self._global_var_actor = global_var_actor if global_var_actor else None
+            self._checkpoint = tools.TrainingCheckpoint("data/checkpoints/ac/", config["checkpoint_steps"])
 
         def _training_step(self, actions, behaviour_policy_probs, observations, total_rewards, masks, progress):
             print("Tracing")
@@ -233,7 +241,11 @@ def ac_agent_run(config_in, data_in, current_cycle_in=None, global_var_actor_in=
                 entropy_loss = -self._entropy_c * tf.reduce_sum(entropy * foo)
 
                 loss = actor_loss + entropy_loss  # + critic_loss
+                if self._is_loss_scaled:
+                    loss = self._optimizer.get_scaled_loss(loss)
             grads = tape.gradient(loss, self._model.trainable_variables)
+            if self._is_loss_scaled:
+                grads = self._optimizer.get_unscaled_gradients(grads)
             # grads = [tf.clip_by_norm(g, 4.0) for g in grads]
             self._optimizer.apply_gradients(zip(grads, self._model.trainable_variables))
 
@@ -246,21 +258,25 @@ def ac_agent_run(config_in, data_in, current_cycle_in=None, global_var_actor_in=
             else:
                 save_path = f'data/weights/data.pickle'
 
+            # files are globbed by the readers, a resumed cycle needs only the same seed
+            _, seed = self._checkpoint.get_input(self._current_cycle)
             ds_learn = tfrecords_storage.read_records_for_rl(
                 self._feature_maps_shape, self._actions_shape, self._n_points, self._model_name,
-                "data/tfrecords/rl/learn_a/"
+                "data/tfrecords/rl/learn_a/", batch_size=self._batch_size, seed=seed
             )
             ds_storage = tfrecords_storage.read_records_for_rl(
                 self._feature_maps_shape, self._actions_shape, self._n_points, self._model_name,
-                "data/tfrecords/rl/storage/"
+                "data/tfrecords/rl/storage/", batch_size=self._batch_size, seed=seed
             )
-            ds_learn = ds_learn.batch(self._batch_size).prefetch(1)
-            ds_storage = ds_storage.batch(self._batch_size).prefetch(1)
+            ds_learn = ds_learn.prefetch(1)
+            ds_storage = ds_storage.prefetch(1)
 
             storage_iterator = iter(ds_storage)
             learn_iterator = iter(ds_learn)
+            steps_done = self._checkpoint.restore(model=self._model, optimizer=self._optimizer,
+                                                  learn_iterator=learn_iterator, storage_iterator=storage_iterator)
             # for step_counter in range(1, self._iterations_number + 1):
-            for step_counter in itertools.count(1):
+            for step_counter in itertools.count(steps_done + 1):
                 # sampling
                 if step_counter % 3 == 0:
                     sample = next(storage_iterator)
@@ -274,6 +290,7 @@ def ac_agent_run(config_in, data_in, current_cycle_in=None, global_var_actor_in=
                 t1 = time.time()
                 self._training_step(*sample)
                 t2 = time.time()
+                self._checkpoint.save(step_counter)
                 if step_counter % 100 == 0:
                     print(f"Training. Step: {step_counter} Time: {t2 - t1:.2f}.")
 
@@ -283,6 +300,7 @@ def ac_agent_run(config_in, data_in, current_cycle_in=None, global_var_actor_in=
             }
             with open(save_path, 'wb') as f:
                 pickle.dump(data, f, protocol=4)
+            self._checkpoint.finish()
 
             if self._global_var_actor is not None:
                 ray.get(self._global_var_actor.set_done.remote(True))
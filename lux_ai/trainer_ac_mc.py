@@ -1,4 +1,5 @@
-def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None, current_cycle_in=None):
+def ac_mc_agent(config_in, data_in, global_var_actor_in=None, filenames_in=None, current_cycle_in=None,
+                replay_buffer_in=None, weights_store_in=None):
     import abc
     import time
     import pickle
@@ -12,7 +13,7 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
     import ray
     # import reverb
 
-    from lux_ai import models, tools, tfrecords_storage
+    from lux_ai import models, tools, tfrecords_storage, shard_cache, shard_manifest
     from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
 
     physical_devices = tf.config.list_physical_devices('GPU')
@@ -22,18 +23,21 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
     # tf.debugging.enable_check_numerics()
 
     class Agent(abc.ABC):
-        def __init__(self, config, data, global_var_actor=None, filenames=None, current_cycle=None):
+        def __init__(self, config, data, global_var_actor=None, filenames=None, current_cycle=None,
+                     replay_buffer=None, weights_store=None):
 
             self._feature_maps_shape = tools.get_feature_maps_shape(config["environment"])
             self._actions_shape = [item.shape for item in empty_worker_action_vectors]
             self._model_name = config["model_name"]
             self._batch_size = config["batch_size"]
+            self._shuffle_buffer = config["shuffle_buffer"]
+            self._precision = models.get_precision(config["precision"])
             self._model_supervised = models.actor_critic_efficient_six_actions(6)
             if self._model_name == "actor_critic_residual_six_actions":
-                self._model = models.actor_critic_residual_six_actions(6)
+                self._model = models.actor_critic_residual_six_actions(6, self._precision, config["shared_trunk"])
                 self._model_actions_shape = 6
             elif self._model_name == "actor_critic_sep_residual_six_actions":
-                self._model = models.actor_critic_sep_residual_six_actions(6)
+                self._model = models.actor_critic_sep_residual_six_actions(6, self._precision, config["shared_trunk"])
                 self._model_actions_shape = 6
             else:
                 raise NotImplementedError
@@ -46,9 +50,17 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
             self._model(dummy_input)
             self._model_supervised(dummy_input)
             # load weights
-            files = glob.glob("./data/weights/*.pickle")
+            if weights_store is not None:
+                files = []  # the latest weights are in the store
+                version, store_data = tools.get_new_weights(weights_store, None)
+            else:
+                files = glob.glob("./data/weights/*.pickle")
+                version, store_data = None, None
             files_n = len(files)
-            if files_n > 0:
+            if store_data is not None:
+                data = store_data
+                print(f"Continue the model training from weights version {version}.")
+            elif files_n > 0:
                 raw_names = [int(pathlib.Path(file_name).stem) for file_name in files]
                 np_names = np.array(raw_names)
                 last_file_arg_number = np.argmax(np_names)
@@ -66,6 +78,7 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
             with open('data/data_eff.pickle', 'rb') as file:
                 eff_data = pickle.load(file)
             self._model_supervised.set_weights(eff_data['weights'])
+            self._teacher_digest = shard_cache.get_digest('data/data_eff.pickle')
             self._class_weights = tf.constant([[1., 1., 1., 1., 1., 1.]])
 
             # self._n_points = config["n_points"]
@@ -73,6 +86,10 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
             # self._save_interval = config["save_interval"]
 
             self._optimizer = tfa.optimizers.AdamW(weight_decay=1.e-5, learning_rate=config["default_lr"])
+            # float16 gradients underflow without loss scaling, bfloat16 ones do not
+            self._is_loss_scaled = self._precision == "mixed_float16"
+            if self._is_loss_scaled:
+                self._optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self._optimizer)
             self._entropy_c = config["entropy_c"]
             self._entropy_c_decay = config["entropy_c_decay"]
             # self._lambda = config["lambda"]
@@ -84,8 +101,23 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
             self._current_cycle = current_cycle
             self._global_var_actor = global_var_actor
             self._filenames = filenames
-
-        def _training_step(self, actions, behaviour_policy_probs, observations, total_rewards,  progress):
+            self._cache_budget = config["cache_budget"]
+            self._teacher_probs = config["teacher_probs"]
+            self._replay_buffer = replay_buffer
+            self._weights_store = weights_store
+            self._replay_min_size = config["replay_min_size"]
+            self._replay_steps = config["replay_steps"]
+            # records of a replay stream are not on disk, only training from files is resumed
+            self._checkpoint = tools.TrainingCheckpoint(
+                "data/checkpoints/ac_mc/", 0 if replay_buffer is not None else config["checkpoint_steps"])
+
+        def _get_teacher_probs(self, observations, teacher_probs):
+            # rows without precomputed probs, -1, are filled by a forward pass of the teacher
+            probs_supervised, _ = self._model_supervised(observations, training=False)
+            return tf.where(teacher_probs[:, :1] < 0., probs_supervised, teacher_probs)
+
+        def _training_step(self, actions, behaviour_policy_probs, observations, total_rewards,  progress,
+                           teacher_probs=None):
             print("Tracing")
 
             if self._is_debug:
@@ -112,7 +144,12 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
                     rhos = tf.exp(log_rhos)
                     clipped_rhos = tf.minimum(tf.constant(1.), rhos)
 
-                    probs_supervised, _ = self._model_supervised(observations, training=False)
+                    if teacher_probs is None:
+                        probs_supervised, _ = self._model_supervised(observations, training=False)
+                    else:
+                        probs_supervised = tf.cond(tf.reduce_all(teacher_probs >= 0.),
+                                                   lambda: teacher_probs,
+                                                   lambda: self._get_teacher_probs(observations, teacher_probs))
 
                 if self._is_debug:
                     clipped_rhos_v = clipped_rhos.numpy()
@@ -150,25 +187,71 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
                 # entropy_loss = -self._entropy_c * tf.reduce_sum(entropy * foo)
 
                 loss = critic_loss + actor_loss + entropy_loss + 1.e-2 * supervised_loss
+                if self._is_loss_scaled:
+                    loss = self._optimizer.get_scaled_loss(loss)
             grads = tape.gradient(loss, self._model.trainable_variables)
+            if self._is_loss_scaled:
+                grads = self._optimizer.get_unscaled_gradients(grads)
             grads = [tf.clip_by_norm(g, 4.0) for g in grads]
             self._optimizer.apply_gradients(zip(grads, self._model.trainable_variables))
 
+        def set_cycle(self, filenames, current_cycle):
+            # a long-lived trainer gets new files for every cycle
+            self._filenames = filenames
+            self._current_cycle = current_cycle
+
+        def _get_files_dataset(self):
+            filenames = self._filenames
+            if filenames is None:
+                filenames = tfrecords_storage.glob_records("data/tfrecords/rl/storage/")
+            records_counts = shard_manifest.get_record_counts(filenames)
+            if records_counts is not None:
+                print(f"Training epoch: {sum(records_counts)} records in {len(filenames)} files, "
+                      f"{sum(records_counts) // self._batch_size} steps.")
+            if self._cache_budget:
+                # decoded shards of files from previous cycles are reused,
+                # the teacher is frozen, its probs are computed once per record of a cached shard
+                teacher = self._model_supervised if self._teacher_probs else None
+                cache = shard_cache.ShardCache(self._feature_maps_shape, self._actions_shape, self._cache_budget,
+                                               teacher=teacher, teacher_digest=self._teacher_digest)
+                filenames = cache.get_filenames(filenames)
+            # a resumed cycle reads the same files in the same order
+            filenames, seed = self._checkpoint.get_input(self._current_cycle, filenames)
+
+            return tfrecords_storage.read_records_for_rl_pg(
+                self._feature_maps_shape, self._actions_shape, self._model_name,
+                "data/tfrecords/rl/storage/",
+                filenames=filenames, batch_size=self._batch_size, shuffle_buffer=self._shuffle_buffer,
+                seed=seed, teacher_probs=self._teacher_probs
+            )
+
+        def _get_replay_dataset(self):
+            # the buffer keeps records of previous cycles, wait only for the first fill
+            while ray.get(self._replay_buffer.size.remote()) < self._replay_min_size:
+                time.sleep(1)
+            return tfrecords_storage.read_replay_for_rl_pg(
+                self._feature_maps_shape, self._actions_shape, self._model_name, self._replay_buffer,
+                batch_size=self._batch_size
+            )
+
         def do_train(self):
             if self._current_cycle is not None:
                 save_path = f'data/weights/{self._current_cycle}.pickle'
             else:
                 save_path = f'data/weights/data.pickle'
 
-            ds_learn = tfrecords_storage.read_records_for_rl_pg(
-                self._feature_maps_shape, self._actions_shape, self._model_name,
-                "data/tfrecords/rl/storage/",
-                filenames=self._filenames
-            )
-            ds_learn = ds_learn.batch(self._batch_size).prefetch(1)
+            if self._replay_buffer is not None:
+                ds_learn = self._get_replay_dataset()
+            else:
+                ds_learn = self._get_files_dataset()
+            ds_learn = ds_learn.prefetch(1)
             learn_iterator = iter(ds_learn)
+            steps_done = self._checkpoint.restore(model=self._model, optimizer=self._optimizer,
+                                                  iterator=learn_iterator)
 
-            for step_counter in itertools.count(1):
+            for step_counter in itertools.count(steps_done + 1):
+                if self._replay_buffer is not None and step_counter > self._replay_steps:
+                    break  # a replay dataset is endless
                 try:
                     sample = next(learn_iterator)
                 except StopIteration:
@@ -178,6 +261,7 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
                 t1 = time.time()
                 self._training_step(*sample)
                 t2 = time.time()
+                self._checkpoint.save(step_counter)
                 if step_counter % 100 == 0:
                     print(f"Training. Step: {step_counter} Time: {t2 - t1:.2f}.")
                     # if self._global_var_actor is not None:
@@ -189,14 +273,61 @@ def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=N
             data = {
                 'weights': weights,
             }
-            with open(save_path, 'wb') as f:
-                pickle.dump(data, f, protocol=4)
-            time.sleep(1)
+            if self._weights_store is not None:
+                # subscribers take weights from the object store, a snapshot is saved in the background
+                version = self._current_cycle if self._current_cycle is not None else "data"
+                ray.get(self._weights_store.publish.remote([ray.put(data)], version))
+            else:
+                with open(save_path, 'wb') as f:
+                    pickle.dump(data, f, protocol=4)
+                time.sleep(1)
+            self._checkpoint.finish()
 
             if self._global_var_actor is not None:
                 ray.get(self._global_var_actor.set_done.remote(True))
 
             print("RL training is done.")
+            return data
+
+        def do_train_async(self, steps, publish_steps, snapshot_steps):
+            """
+            Trains from a replay buffer while collectors keep playing with previous weights.
+
+            Weights are published to the weights store every publish_steps learner steps,
+            they are saved to disk every snapshot_steps steps.
+            """
+            ds_learn = self._get_replay_dataset()
+            ds_learn = ds_learn.prefetch(1)
+            learn_iterator = iter(ds_learn)
+
+            for step_counter in range(1, steps + 1):
+                sample = next(learn_iterator)
+
+                # training
+                t1 = time.time()
+                self._training_step(*sample)
+                t2 = time.time()
+                if step_counter % 100 == 0:
+                    print(f"Training. Step: {step_counter} Time: {t2 - t1:.2f}.")
+
+                if step_counter % publish_steps == 0 or step_counter == steps:
+                    data = {
+                        'weights': self._model.get_weights(),
+                    }
+                    save = step_counter % snapshot_steps == 0 or step_counter == steps
+                    ray.get(self._weights_store.publish.remote([ray.put(data)], step_counter, save))
+
+            if self._global_var_actor is not None:
+                ray.get(self._global_var_actor.set_done.remote(True))
+
+            print("Asynchronous RL training is done.")
+
+    return Agent(config_in, data_in, global_var_actor_in, filenames_in, current_cycle_in, replay_buffer_in,
+                 weights_store_in)
+
 
-    ac_agent = Agent(config_in, data_in, global_var_actor_in, filenames_in, current_cycle_in)
+def ac_mc_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None, current_cycle_in=None,
+                    replay_buffer_in=None):
+    ac_agent = ac_mc_agent(config_in, data_in, global_var_actor_in, filenames_in, current_cycle_in,
+                           replay_buffer_in)
     ac_agent.do_train()
@@ -27,11 +27,15 @@ def pg_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None
             self._actions_shape = [item.shape for item in empty_worker_action_vectors]
             self._model_name = config["model_name"]
             self._batch_size = config["batch_size"]
+            self._precision = models.get_precision(config["precision"])
+            self._shuffle_buffer = config["shuffle_buffer"]
             if self._model_name == "actor_critic_residual_shrub":
+                if self._precision is not None:
+                    raise NotImplementedError
                 self._model = models.actor_critic_residual_shrub(self._actions_shape)
                 self._model_actions_shape = self._actions_shape
             elif self._model_name == "actor_critic_residual_six_actions":
-                self._model = models.actor_critic_residual_six_actions(6)
+                self._model = models.actor_critic_residual_six_actions(6, self._precision, config["shared_trunk"])
                 self._model_actions_shape = 6
             else:
                 raise NotImplementedError
@@ -61,6 +65,10 @@ def pg_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None
             # self._save_interval = config["save_interval"]
 
             self._optimizer = tfa.optimizers.AdamW(weight_decay=1.e-5, learning_rate=config["default_lr"])
+            # float16 gradients underflow without loss scaling, bfloat16 ones do not
+            self._is_loss_scaled = self._precision == "mixed_float16"
+            if self._is_loss_scaled:
+                self._optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self._optimizer)
             self._entropy_c = config["entropy_c"]
             self._entropy_c_decay = config["entropy_c_decay"]
             # self._lambda = config["lambda"]
@@ -72,6 +80,7 @@ def pg_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None
             self._current_cycle = current_cycle
             self._global_var_actor = global_var_actor
             self._filenames = filenames
+            self._checkpoint = tools.TrainingCheckpoint("data/checkpoints/pg/", config["checkpoint_steps"])
 
         def _training_step(self, actions, behaviour_policy_probs, observations, total_rewards,  progress):
             print("Tracing")
@@ -125,7 +134,11 @@ def pg_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None
                 # entropy_loss = -self._entropy_c * tf.reduce_sum(entropy * foo)
 
                 loss = actor_loss + entropy_loss
+                if self._is_loss_scaled:
+                    loss = self._optimizer.get_scaled_loss(loss)
             grads = tape.gradient(loss, self._model.trainable_variables)
+            if self._is_loss_scaled:
+                grads = self._optimizer.get_unscaled_gradients(grads)
             # grads = [tf.clip_by_norm(g, 4.0) for g in grads]
             self._optimizer.apply_gradients(zip(grads, self._model.trainable_variables))
 
@@ -135,15 +148,23 @@ def pg_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None
             else:
                 save_path = f'data/weights/data.pickle'
 
+            filenames = self._filenames
+            if filenames is None:
+                filenames = tfrecords_storage.glob_records("data/tfrecords/rl/storage/")
+            # a resumed cycle reads the same files in the same order
+            filenames, seed = self._checkpoint.get_input(self._current_cycle, filenames)
             ds_learn = tfrecords_storage.read_records_for_rl_pg(
                 self._feature_maps_shape, self._actions_shape, self._model_name,
                 "data/tfrecords/rl/storage/",
-                filenames=self._filenames
+                filenames=filenames, batch_size=self._batch_size, shuffle_buffer=self._shuffle_buffer,
+                seed=seed
             )
-            ds_learn = ds_learn.batch(self._batch_size).prefetch(1)
+            ds_learn = ds_learn.prefetch(1)
             learn_iterator = iter(ds_learn)
+            steps_done = self._checkpoint.restore(model=self._model, optimizer=self._optimizer,
+                                                  iterator=learn_iterator)
 
-            for step_counter in itertools.count(1):
+            for step_counter in itertools.count(steps_done + 1):
                 try:
                     sample = next(learn_iterator)
                 except StopIteration:
@@ -153,6 +174,7 @@ def pg_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None
                 t1 = time.time()
                 self._training_step(*sample)
                 t2 = time.time()
+                self._checkpoint.save(step_counter)
                 if step_counter % 100 == 0:
                     print(f"Training. Step: {step_counter} Time: {t2 - t1:.2f}.")
                     # if self._global_var_actor is not None:
@@ -166,6 +188,7 @@ def pg_agent_run(config_in, data_in, global_var_actor_in=None, filenames_in=None
             }
             with open(save_path, 'wb') as f:
                 pickle.dump(data, f, protocol=4)
+            self._checkpoint.finish()
 
             print("RL training is done.")
 
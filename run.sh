@@ -1,10 +1,4 @@
 #!/usr/bin/env bash
 
-for i in {1..100}
-do
-  echo "Cycle $i"
-  python main.py
-  sleep 1
-done
-
-echo "The last cycle is $i"
+# cycles run inside one process, see "cycles" in run_configuration.py
+python main.py
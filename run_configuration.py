@@ -3,6 +3,17 @@ CONF_Main = {
     "setup": "rl",
     "model_name": "actor_critic_sep_residual_six_actions",
     "n_points": 40,  # check tfrecords reading transformation merge_rl
+    # or "columnar", memory mapped shards for per step records,
+    # or "packed", columnar shards with bit packed binary observation channels
+    # and uint8 quantized, lossy, scalar channels
+    "storage_format": "tfrecord",
+    "shard_size": None,  # records per file, None for 3000 per step records or 10 trajectories
+    "tfrecord_compression": None,  # or "ZLIB", "GZIP"
+    # six actions models without the unit mask in the trunk, trained and collected with one trunk pass
+    # per player and turn instead of one per unit; weights of the two kinds are not interchangeable
+    "shared_trunk": False,
+    # passes over cycle loops of self imitation and pg rl types, run.sh restarted main.py for every pass
+    "cycle_passes": 100,
 }
 
 CONF_Scrape = {
@@ -14,6 +25,10 @@ CONF_Scrape = {
     "team_name": None,  # "Toad Brigade",
     "only_wins": False,
     "only_top_teams": False,
+    # record formats written from one simulation of a replay and their paths,
+    # e.g. {"imitator": "./data/tfrecords/imitator/train/", "pg": "./data/tfrecords/rl/storage/"},
+    # "rl" is for full trajectories; None to use is_for_rl and is_pg_rl
+    "scrape_targets": None,
 }
 
 CONF_Collect = {
@@ -21,6 +36,8 @@ CONF_Collect = {
     "is_for_rl": True,
     "is_pg_rl": True,
     "only_wins": False,
+    "n_envs": 1,  # games played in lockstep with batched inference
+    "inference_precision": None,  # or "mixed_float16", "mixed_bfloat16"; mixed_float16 is bfloat16 on a cpu
 }
 
 CONF_Evaluate = {
@@ -29,18 +46,37 @@ CONF_Evaluate = {
 
 CONF_Imitate = {
     "batch_size": 300,
+    "shuffle_buffer": 10000,  # serialized records shuffled before decoding
     "self_imitation": False,
     "with_evaluation": True,
 }
 
 CONF_RL = {
-    "rl_type": "continuous_ac_mc",
+    "rl_type": "continuous_ac_mc",  # or "async_ac_mc"
+    "cycles": 100,  # training cycles of continuous rl types
     # "lambda": 0.8,
     "debug": False,
     "default_lr": 1e-5,
     "batch_size": 300,
+    "shuffle_buffer": 10000,  # serialized records shuffled before decoding
+    "checkpoint_steps": 1000,  # learner steps between checkpoints of a cycle, 0 to disable resuming
+    "precision": None,  # or "mixed_float16" with loss scaling, "mixed_bfloat16"; residual models only
     # "iterations_number": 1000,
     # "save_interval": 100,
     "entropy_c": 1e-5,
     "entropy_c_decay": 0.3,
+    "cache_budget": 0,  # bytes of decoded shards kept in data/cache/ between cycles, 0 to decode every cycle
+    # supervised model probs are stored in cached shards, not computed every step; needs cache_budget,
+    # records of other files get the probs from a forward pass of the supervised model as without it
+    "teacher_probs": False,
+    "replay_stream": False,  # collectors send records to an in memory buffer, the learner samples from it
+    "replay_capacity": 300000,  # records
+    "replay_min_size": 30000,  # records to collect before the first training step
+    "replay_steps": 3000,  # training steps per cycle with a replay stream
+    "persist_collected": True,  # also store collected records to disk with a replay stream
+    "async_storage_pieces": 10,  # rotated storage directories per collector of async_ac_mc
+    "async_piece_episodes": 100,  # episodes per storage directory of async_ac_mc
+    "async_steps": 300000,  # learner steps of async_ac_mc
+    "weights_refresh_steps": 500,  # learner steps between weights publications for collectors
+    "weights_snapshot_steps": 10000,  # learner steps between weights saved to disk
 }
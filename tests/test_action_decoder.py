@@ -0,0 +1,129 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("lux_gym")
+
+from lux_gym.envs.lux.action_vectors_new import worker_action_vector, dir_action_vector, res_action_vector
+from lux_gym.envs.lux.action_vectors_new import empty_worker_action_vectors
+
+from lux_ai import action_decoder
+
+
+class Position:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def direction_to(self, target):
+        if target.x > self.x:
+            return "e"
+        if target.x < self.x:
+            return "w"
+        if target.y > self.y:
+            return "s"
+        if target.y < self.y:
+            return "n"
+        return "c"
+
+
+class Unit:
+    def __init__(self, x, y, worker=True):
+        self.pos = Position(x, y)
+        self._worker = worker
+
+    def is_worker(self):
+        return self._worker
+
+
+def old_worker_actions(player_actions, units_active, units_all):
+    """
+    Worker action numbers as the scraper got them before EpisodeActions:
+    check_actions, update_units_actions and the worker branches of get_actions_dict.
+    """
+    actions = [action for action in player_actions if action.split(" ")[1] in units_active]
+    units_with_actions = [action.split(" ")[1] for action in actions]
+    actions += [f"m {unit_id} c" for unit_id in units_active if unit_id not in units_with_actions]
+
+    actions_dict = {}
+    for action in actions:
+        action_list = action.split(" ")
+        action_type, unit_name = action_list[0], action_list[1]
+        action_vectors = empty_worker_action_vectors.copy()
+        if action_type == "m":
+            if not units_active[unit_name].is_worker():
+                continue
+            direction = action_list[2]
+            if direction == "c":
+                action_vectors[0] = worker_action_vector["idle"]
+            else:
+                action_vectors[0] = worker_action_vector["m"]
+                action_vectors[1] = dir_action_vector[direction]
+        elif action_type == "t":
+            if not units_active[unit_name].is_worker():
+                continue
+            destination = units_all.get(action_list[2])
+            if destination is None:
+                action_vectors[0] = worker_action_vector["idle"]
+            else:
+                action_vectors[0] = worker_action_vector["t"]
+                action_vectors[1] = dir_action_vector[units_active[unit_name].pos.direction_to(destination.pos)]
+                action_vectors[2] = res_action_vector[action_list[3]]
+        elif action_type == "bcity":
+            action_vectors[0] = worker_action_vector["bcity"]
+        elif action_type == "p":
+            action_vectors[0] = worker_action_vector["idle"]
+        actions_dict[unit_name] = [np.argmax(item) if np.count_nonzero(item) else -1 for item in action_vectors]
+    return actions_dict
+
+
+def new_worker_actions(steps, step, units_active, units_all):
+    episode_actions = action_decoder.EpisodeActions(steps, 0)
+    actions = episode_actions.get_worker_actions(step, units_active, units_all)
+    return {unit_id: list(action_numbers) for unit_id, action_numbers in actions.items()}
+
+
+def test_episode_actions_match_old_decoder():
+    units_all = {
+        "u_1": Unit(3, 3),
+        "u_2": Unit(4, 3),
+        "u_3": Unit(3, 5),
+        "u_4": Unit(6, 6),
+        "u_5": Unit(1, 1, worker=False),
+        "u_6": Unit(7, 7),
+        "u_7": Unit(2, 2),
+    }
+    # u_6 is on cooldown
+    units_active = {unit_id: unit for unit_id, unit in units_all.items() if unit_id != "u_6"}
+    player_actions = [
+        "m u_1 n",
+        "m u_1 w",  # the last action of a unit wins
+        "t u_2 u_1 wood 100",  # a transfer to the west
+        "t u_3 u_9 coal 10",  # no destination unit, idle
+        "p u_4",  # pillage is replaced by idle
+        "m u_5 e",  # a cart
+        "m u_6 s",  # an inactive unit
+        "r 3 4",  # a city tile
+        "dc 1 2 3",  # an annotation
+        # u_7 has no actions and is idle
+    ]
+    steps = [[None, None], [player_actions, None]]
+
+    old_actions = old_worker_actions(player_actions, units_active, units_all)
+    new_actions = new_worker_actions(steps, 1, units_active, units_all)
+
+    assert new_actions == old_actions
+    assert set(new_actions) == {"u_1", "u_2", "u_3", "u_4", "u_7"}
+    assert new_actions["u_1"][:2] == [action_decoder.GENERAL_CODES["m"], action_decoder.DIRECTION_CODES["w"]]
+    assert new_actions["u_2"] == [action_decoder.GENERAL_CODES["t"], action_decoder.DIRECTION_CODES["w"],
+                                  action_decoder.RESOURCE_CODES["wood"]]
+    assert new_actions["u_3"] == new_actions["u_4"] == new_actions["u_7"] == list(action_decoder.IDLE_NUMBERS)
+
+
+def test_episode_actions_keep_steps_apart():
+    units_all = {"u_1": Unit(3, 3), "u_2": Unit(3, 4)}
+    steps = [[["m u_1 n"], None], [None, ["m u_1 s"]], [["bcity u_2", "m u_1 e"], None]]
+
+    assert new_worker_actions(steps, 0, units_all, units_all) == old_worker_actions(["m u_1 n"], units_all, units_all)
+    assert new_worker_actions(steps, 1, units_all, units_all) == old_worker_actions([], units_all, units_all)
+    assert new_worker_actions(steps, 2, units_all, units_all) == old_worker_actions(["bcity u_2", "m u_1 e"],
+                                                                                    units_all, units_all)
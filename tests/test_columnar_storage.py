@@ -0,0 +1,49 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("tensorflow")
+pytest.importorskip("ray")
+
+from lux_ai import columnar_storage
+
+
+def make_observations(records_n=20):
+    rng = np.random.default_rng(0)
+    observations = np.zeros((records_n, 8, 8, 5), dtype=np.float16)
+    observations[..., 0] = rng.integers(0, 2, size=(records_n, 8, 8))
+    observations[..., 2] = rng.integers(0, 2, size=(records_n, 8, 8))
+    observations[..., 1] = rng.random((records_n, 8, 8))
+    observations[..., 3] = rng.random((records_n, 8, 8)) * 10 - 5
+    # channel 4 is all zeros, a binary channel
+    return observations
+
+
+def test_pack_keeps_binary_channels_and_bounds_scalar_error():
+    observations = make_observations()
+
+    packed, layout = columnar_storage.pack_observations(observations)
+    unpacked = columnar_storage.unpack_observations(packed["observation_bits"], packed["observation_scalars"],
+                                                    layout, dtype=np.float32)
+
+    assert layout["bits_channels"] == [0, 2, 4]
+    assert layout["scalar_channels"] == [1, 3]
+    np.testing.assert_array_equal(unpacked[..., [0, 2, 4]], observations[..., [0, 2, 4]])
+    for channel in layout["scalar_channels"]:
+        values = observations[..., channel].astype(np.float32)
+        bound = (values.max() - values.min()) / 510
+        assert np.max(np.abs(unpacked[..., channel] - values)) <= bound * (1 + 1e-5)
+
+
+def test_packed_shard_reads_unpacked_observations(tmp_path):
+    observations = make_observations()
+    reward = np.arange(len(observations), dtype=np.float16)
+    filename = str(tmp_path / "shard") + columnar_storage.SHARD_SUFFIX
+
+    columnar_storage.write_shard({"observation": observations, "reward": reward}, filename, pack=True)
+    shard = columnar_storage.load_shard(filename, ("observation", "reward"))
+
+    packed, layout = columnar_storage.pack_observations(observations)
+    expected = columnar_storage.unpack_observations(packed["observation_bits"], packed["observation_scalars"], layout)
+    assert shard["observation"].shape == observations.shape
+    np.testing.assert_array_equal(shard["observation"][3:7], expected[3:7])
+    np.testing.assert_array_equal(shard["reward"], reward)
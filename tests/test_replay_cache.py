@@ -0,0 +1,64 @@
+import os
+import json
+
+from lux_ai import replay_cache
+
+
+def make_replay(seed=7, steps_n=3):
+    steps = []
+    for step in range(steps_n):
+        updates = [f"rp 0 {step}", f"u 0 0 u_1 {step} 1 0 0 0 0"]
+        steps.append([
+            {"action": ["m u_1 n"] if step else None, "observation": {"updates": updates}},
+            {"action": [], "observation": {}},
+        ])
+    return {
+        "version": "3.1.0",
+        "info": {"TeamNames": ["team a", "team b"], "EpisodeId": 1},
+        "rewards": [10, 20],
+        "configuration": {"seed": seed, "episodeSteps": 361},
+        "steps": steps,
+    }
+
+
+def write_replay(file_name, data):
+    with open(file_name, "w") as write_file:
+        json.dump(data, write_file)
+
+
+def test_load_replay_keeps_what_the_scraper_uses(tmp_path):
+    file_name = str(tmp_path / "123.json")
+    data = make_replay()
+    write_replay(file_name, data)
+
+    replay = replay_cache.load_replay(file_name, str(tmp_path / "cache"))
+
+    assert replay["version"] == "3.1.0"
+    assert replay["info"] == {"TeamNames": ["team a", "team b"]}
+    assert replay["rewards"] == [10, 20]
+    assert replay["configuration"] == {"seed": 7}
+    assert replay["episode_length"] == 3
+    assert replay["steps"] == [
+        (step[0]["action"], step[1]["action"], replay_cache.get_updates_digest(step[0]["observation"]["updates"]))
+        for step in data["steps"]
+    ]
+
+
+def test_cache_is_read_while_the_replay_is_not_modified(tmp_path):
+    file_name = str(tmp_path / "123.json")
+    cache_path = str(tmp_path / "cache")
+    write_replay(file_name, make_replay(seed=7))
+    replay_cache.load_replay(file_name, cache_path)
+    cache_filename = replay_cache.get_cache_filename(file_name, cache_path)
+    assert os.path.exists(cache_filename)
+
+    # the same size and mtime, the cache is used
+    stat = os.stat(file_name)
+    write_replay(file_name, make_replay(seed=8))
+    os.utime(file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert replay_cache.load_header(file_name, cache_path)["configuration"]["seed"] == 7
+
+    # a modified replay is parsed again
+    os.utime(file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert replay_cache.load_header(file_name, cache_path)["configuration"]["seed"] == 8
+    assert replay_cache.load_replay(file_name, cache_path)["configuration"]["seed"] == 8
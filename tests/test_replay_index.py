@@ -0,0 +1,56 @@
+import os
+import json
+
+from lux_ai import replay_index
+
+
+def write_replay(file_name, team_names, version="3.1.0"):
+    data = {
+        "version": version,
+        "info": {"TeamNames": team_names},
+        "rewards": [1, 2],
+        "configuration": {"seed": 5},
+        "steps": [[{"action": None, "observation": {"updates": []}}, {"action": None, "observation": {}}]],
+    }
+    with open(file_name, "w") as write_file:
+        json.dump(data, write_file)
+
+
+def make_index(tmp_path, monkeypatch):
+    # headers are cached relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return replay_index.ReplayIndex(str(tmp_path / "index" / "replays.sqlite"))
+
+
+def test_select_filters_by_version_and_teams(tmp_path, monkeypatch):
+    index = make_index(tmp_path, monkeypatch)
+    file_names = [str(tmp_path / f"{n}.json") for n in range(4)]
+    write_replay(file_names[0], ["a", "b"])
+    write_replay(file_names[1], ["b", "c"])
+    write_replay(file_names[2], ["a", "c"], version="3.0.0")
+    write_replay(file_names[3], ["c", "d"])
+    index.update(file_names)
+
+    assert index.select("3.1.0") == [file_names[0], file_names[1], file_names[3]]
+    assert index.select("3.1.0", team_name="b") == [file_names[0], file_names[1]]
+    assert index.select("3.1.0", top_teams={"b", "c", "d"}) == [file_names[1], file_names[3]]
+    assert index.select("3.0.0", team_name="a") == [file_names[2]]
+    index.close()
+
+
+def test_update_follows_modified_and_removed_files(tmp_path, monkeypatch):
+    index = make_index(tmp_path, monkeypatch)
+    file_names = [str(tmp_path / f"{n}.json") for n in range(2)]
+    for file_name in file_names:
+        write_replay(file_name, ["a", "b"])
+    index.update(file_names)
+
+    write_replay(file_names[0], ["c", "d"])
+    stat = os.stat(file_names[0])
+    os.utime(file_names[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    index.update(file_names[:1])
+
+    assert index.select("3.1.0") == [file_names[0]]
+    assert index.select("3.1.0", team_name="c") == [file_names[0]]
+    assert index.select("3.1.0", team_name="a") == []
+    index.close()
@@ -0,0 +1,42 @@
+from lux_ai import shard_manifest
+
+
+def touch(filename):
+    with open(filename, "w"):
+        pass
+
+
+def test_manifest_keeps_the_last_entry_of_existing_shards(tmp_path):
+    filenames = [str(tmp_path / f"shard_{n}.tfrec") for n in range(3)]
+    for n, filename in enumerate(filenames):
+        touch(filename)
+        shard_manifest.add_shard(filename, 10 + n, {"team": "a", "cycle": n})
+    # a shard written again replaces its entry
+    shard_manifest.add_shard(filenames[0], 5)
+    # an interrupted writer leaves a partial line
+    with open(shard_manifest.get_manifest_filename(str(tmp_path)), "a") as manifest_file:
+        manifest_file.write('{"shard": "shard_')
+    # an entry of a removed shard is skipped
+    shard_manifest.add_shard(str(tmp_path / "removed.tfrec"), 7)
+
+    entries = shard_manifest.read_manifest(str(tmp_path))
+
+    assert sorted(entries) == sorted(filenames)
+    assert entries[filenames[0]]["records"] == 5
+    assert entries[filenames[0]]["team"] is None
+    assert entries[filenames[2]]["records"] == 12
+    assert entries[filenames[2]]["team"] == "a"
+    assert entries[filenames[2]]["cycle"] == 2
+
+
+def test_record_counts_of_shards_from_several_directories(tmp_path):
+    filenames = []
+    for directory in ("one", "two"):
+        (tmp_path / directory).mkdir()
+        filename = str(tmp_path / directory / "shard.tfrec")
+        touch(filename)
+        shard_manifest.add_shard(filename, len(filenames) + 3)
+        filenames.append(filename)
+
+    assert shard_manifest.get_record_counts(filenames) == [3, 4]
+    assert shard_manifest.get_record_counts(filenames[:1] + [str(tmp_path / "one" / "missing.tfrec")]) is None
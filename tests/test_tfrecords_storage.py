@@ -0,0 +1,90 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("ray")
+
+from lux_ai import tfrecords_storage
+
+FEATURE_MAPS_SHAPE = (8, 8, 3)
+ACTIONS_SHAPE = [(4,), (4,), (3,)]
+
+
+def write_imitator_records(filename, records_n):
+    with tf.io.TFRecordWriter(filename) as writer:
+        for i in range(records_n):
+            observation = np.zeros(FEATURE_MAPS_SHAPE, dtype=np.float16)
+            observation[i % 8, i % 8, 0] = 1
+            action_probs = (tf.constant([1, 0, 0, 0], dtype=tf.float16),
+                            tf.constant([0, 1, 0, 0], dtype=tf.float16),
+                            tf.constant([0, 0, 0], dtype=tf.float16))
+            writer.write(tfrecords_storage.serialize_imitator(tf.sparse.from_dense(tf.constant(observation)),
+                                                              action_probs,
+                                                              tf.constant(1, dtype=tf.float16)))
+
+
+def test_imitator_augmentation_without_parse_batches(tmp_path):
+    filename = str(tmp_path / "records.tfrec")
+    write_imitator_records(filename, 10)
+
+    ds = tfrecords_storage.read_records_for_imitator(FEATURE_MAPS_SHAPE, ACTIONS_SHAPE,
+                                                     "actor_critic_residual_six_actions", str(tmp_path),
+                                                     filenames=[filename], parse_batch_size=None,
+                                                     augment_batch_size=4)
+    records = list(ds)
+
+    assert len(records) == 10
+    for observation, (probs, reward) in records:
+        assert observation.shape == FEATURE_MAPS_SHAPE
+        # a symmetry moves the unit but keeps it on the map
+        assert float(tf.reduce_sum(observation[:, :, 0])) == 1
+        # a move in one direction stays a move in one direction
+        assert probs.shape == (6,)
+        assert float(tf.reduce_max(probs[:4])) > 0.9
+
+
+def write_pg_records(filename, records_n):
+    rng = np.random.default_rng(0)
+    with tf.io.TFRecordWriter(filename) as writer:
+        for i in range(records_n):
+            observation = np.zeros(FEATURE_MAPS_SHAPE, dtype=np.float16)
+            observation[i % 8, i % 8, 0] = 1
+            observation[:, :, 1] = rng.random(FEATURE_MAPS_SHAPE[:2])
+            action_numbers = tf.constant([0, i % 4, -1], dtype=tf.int16)
+            action_probs = tuple(tf.constant(rng.random(shape), dtype=tf.float16) for shape in ACTIONS_SHAPE)
+            writer.write(tfrecords_storage.serialize_pg(action_numbers, action_probs,
+                                                        tf.sparse.from_dense(tf.constant(observation)),
+                                                        tf.constant(i / records_n, dtype=tf.float16),
+                                                        tf.constant(i / records_n, dtype=tf.float16)))
+
+
+def test_parse_tensors_matches_parse_tensor():
+    rng = np.random.default_rng(0)
+    for dtype, shape in ((tf.float16, [4]), (tf.float16, [3, 5]), (tf.int16, [3]), (tf.float32, [2, 2])):
+        values = tf.constant(rng.integers(-8, 8, size=[6] + shape), dtype=dtype)
+        serialized = tf.stack([tf.io.serialize_tensor(item) for item in values])
+
+        parsed = tfrecords_storage.parse_tensors(serialized, dtype, shape)
+
+        assert parsed.dtype == dtype
+        np.testing.assert_array_equal(parsed.numpy(), values.numpy())
+
+
+def test_batched_pg_parse_matches_record_parse(tmp_path):
+    filename = str(tmp_path / "records.tfrec")
+    write_pg_records(filename, 10)
+
+    def read(parse_batch_size):
+        ds = tfrecords_storage.read_records_for_rl_pg(FEATURE_MAPS_SHAPE, ACTIONS_SHAPE,
+                                                      "actor_critic_residual_six_actions", str(tmp_path),
+                                                      filenames=[filename], parse_batch_size=parse_batch_size,
+                                                      shuffle_buffer=None)
+        return list(ds)
+
+    records = read(None)
+    batched_records = read(4)
+
+    assert len(records) == len(batched_records) == 10
+    for record, batched_record in zip(records, batched_records):
+        for item, batched_item in zip(record, batched_record):
+            np.testing.assert_array_equal(item.numpy(), batched_item.numpy())
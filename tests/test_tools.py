@@ -0,0 +1,65 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("tensorflow")
+pytest.importorskip("ray")
+pytest.importorskip("gym")
+pytest.importorskip("lux_gym")
+
+from lux_ai import tools
+
+ACTIONS_SHAPE = [(6,), (4,), (3,)]
+OBSERVATION_SHAPE = (4, 4, 2)
+
+
+def one_hot(number, size):
+    vector = np.zeros(size, dtype=np.float16)
+    if number >= 0:
+        vector[number] = 1
+    return vector
+
+
+def test_trajectory_buffer_keeps_unit_points_across_chunks():
+    buffer = tools.TrajectoryBuffer(chunk_size=3)
+    expected = {"u_1": [], "u_2": []}
+    for step in range(5):
+        for unit_id in ("u_1", "u_2"):
+            numbers = [step % 6, step % 4 if step % 2 else -1, -1]
+            observation = np.full(OBSERVATION_SHAPE, step + (unit_id == "u_2") * 10, dtype=np.float16)
+            if step % 2:
+                buffer.add_numbers(unit_id, numbers, observation, step, ACTIONS_SHAPE)
+            else:
+                vectors = [one_hot(number, shape[0]) for number, shape in zip(numbers, ACTIONS_SHAPE)]
+                buffer.add(unit_id, vectors, vectors, observation, step)
+            expected[unit_id].append((numbers, observation, step))
+
+    assert list(buffer) == ["u_1", "u_2"]
+    for unit_id, points in expected.items():
+        trajectory = buffer[unit_id]
+        assert len(trajectory) == 5
+        np.testing.assert_array_equal(trajectory.action_numbers, [numbers for numbers, _, _ in points])
+        np.testing.assert_array_equal(trajectory.observations, [observation for _, observation, _ in points])
+        np.testing.assert_array_equal(trajectory.steps, [step for _, _, step in points])
+        for n, shape in enumerate(ACTIONS_SHAPE):
+            np.testing.assert_array_equal(trajectory.actions_probs[n],
+                                          [one_hot(numbers[n], shape[0]) for numbers, _, _ in points])
+        np.testing.assert_array_equal(trajectory.actions, [1, 1, 1, 1, 1, 0])
+
+
+def test_trajectory_buffer_rejects_a_unit_of_several_types():
+    buffer = tools.TrajectoryBuffer()
+    observation = np.zeros(OBSERVATION_SHAPE, dtype=np.float16)
+    buffer.add_numbers("u_1", [0, 0, -1], observation, 0, ACTIONS_SHAPE)
+
+    with pytest.raises(ValueError):
+        buffer.add_numbers("u_1", [0, 0, -1], observation, 1, ACTIONS_SHAPE, unit_type="carts")
+
+
+def test_point_arrays_take_rows_of_several_chunks():
+    points = tools.PointArrays(2, 3, ACTIONS_SHAPE, OBSERVATION_SHAPE)
+    for step in range(5):
+        chunk, row = points.new_row()
+        assert (chunk, row) == divmod(step, 2)
+        points.steps[chunk][row] = step
+
+    np.testing.assert_array_equal(points.take(points.steps, np.array([4, 0, 3, 1])), [4, 0, 3, 1])